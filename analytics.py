@@ -0,0 +1,225 @@
+from array import array
+from heapq import nlargest
+from math import ceil
+from typing import Dict, List, Optional, Sequence
+
+from classes import Machine
+from leases import Lease
+
+try:
+    import numpy
+except ImportError:  # the aggregates fall back to plain Python loops over the same columns
+    numpy = None
+
+
+class FleetFrame:
+    """
+    The catalogue and the rentals of a machine exported into typed columns, one row per vehicle
+        model and one per lease, with the model of every row as a reference into names
+
+    The aggregates group whole columns at once; with NumPy installed the columns are wrapped
+        without copying and grouped with bincount, otherwise they are grouped in one pass each
+
+    A live frame listens to the stock and the leases of the machine (it is machine.fleet_frame):
+        the vehicles and the leases that changed are only looked at again by the next query, a
+        vehicle updates its row, a lease opened appends one and a lease closed updates its own, so
+        the columns are built once
+
+    Usage:
+        frame = FleetFrame(machine, live=True)
+        frame.top('revenue', 5)
+    """
+    METRICS = ('rentals', 'revenue', 'utilization', 'distance')
+
+    def __init__(self, machine: Machine, live: bool = False):
+        self.machine = machine
+        self._pending_vehicles = set()
+        self._pending_leases: Dict[int, Lease] = {}
+        self._stale = False
+        self._build()
+
+        if live:
+            machine.stock.subscribe(self._pending_vehicles.add)
+            machine.leases.subscribe(self._lease_changed)
+            machine.fleet_frame = self
+
+    def _build(self) -> None:
+        self.names: List[str] = []
+        self.model = array('q')
+        self.price = array('d')
+        self.mileage = array('q')
+        self.stock = array('q')
+        self.rental_model = array('q')
+        self.distance = array('q')
+        self.revenue = array('q')
+        self.is_open = array('q')
+        self._refs: Dict[str, int] = {}
+        self._rows: Dict[int, int] = {}
+        self._open_rows: Dict[int, int] = {}
+
+        for vehicle_id, entry in self.machine.stock.items():
+            self._set_vehicle(vehicle_id, entry)
+
+        for leases in (self.machine.leases.open_leases, self.machine.leases.closed_leases):
+            for lease in leases.values():
+                self._set_lease(lease)
+
+    def _lease_changed(self, lease: Optional[Lease]) -> None:
+        if lease is None:
+            self._stale = True
+        else:
+            self._pending_leases[lease.id] = lease
+
+    def _refresh(self) -> None:
+        """
+        Apply the vehicles and the leases that changed since the last query, everything again when
+            the leases were restored or a vehicle was renamed (its rentals count for another model)
+        """
+        while self._pending_vehicles and not self._stale:
+            vehicle_id = self._pending_vehicles.pop()
+            self._set_vehicle(vehicle_id, self.machine.stock[vehicle_id])
+
+        while self._pending_leases and not self._stale:
+            _, lease = self._pending_leases.popitem()
+            self._set_lease(lease)
+
+        if self._stale:
+            self._stale = False
+            self._pending_vehicles.clear()
+            self._pending_leases.clear()
+            self._build()
+
+    def _set_vehicle(self, vehicle_id: int, entry: dict) -> None:
+        vehicle = entry['vehicle']
+        ref = self._refs.get(vehicle.name)
+        if ref is None:
+            ref = self._refs[vehicle.name] = len(self.names)
+            self.names.append(vehicle.name)
+
+        row = self._rows.get(vehicle_id)
+
+        if row is None:
+            self._rows[vehicle_id] = len(self.model)
+            self.model.append(ref)
+            self.price.append(vehicle.price)
+            self.mileage.append(vehicle.mileage)
+            self.stock.append(entry['stock'])
+            return
+
+        if self.model[row] != ref:
+            self._stale = True
+
+        self.model[row] = ref
+        self.price[row] = vehicle.price
+        self.mileage[row] = vehicle.mileage
+        self.stock[row] = entry['stock']
+
+    def _set_lease(self, lease: Lease) -> None:
+        """
+        Add the row of a lease, or update it when it was open, only open leases remember their row
+        """
+        row = self._open_rows.pop(lease.id, None)
+        distance = 0 if lease.is_open else lease.end_mileage - lease.start_mileage
+
+        if row is None:
+            row = len(self.rental_model)
+            self.rental_model.append(self.model[self._rows[lease.vehicle_id]])
+            self.is_open.append(lease.is_open)
+            self.distance.append(distance)
+            self.revenue.append(lease.price)
+        else:
+            self.is_open[row] = lease.is_open
+            self.distance[row] = distance
+
+        if lease.is_open:
+            self._open_rows[lease.id] = row
+
+    def _group_sum(self, keys: array, values: array) -> List[float]:
+        """
+        The sum of values per model
+        """
+        if numpy is not None:
+            return numpy.bincount(numpy.frombuffer(keys, dtype=numpy.int64), numpy.frombuffer(values, dtype=numpy.int64),
+                                  minlength=len(self.names)).tolist()
+
+        totals = [0] * len(self.names)
+        for key, value in zip(keys, values):
+            totals[key] += value
+
+        return totals
+
+    def _group_count(self, keys: array) -> List[int]:
+        if numpy is not None:
+            return numpy.bincount(numpy.frombuffer(keys, dtype=numpy.int64), minlength=len(self.names)).tolist()
+
+        counts = [0] * len(self.names)
+        for key in keys:
+            counts[key] += 1
+
+        return counts
+
+    def metric(self, name: str) -> List[float]:
+        """
+        A metric per model (by model position in names): rentals, revenue (the prices paid in euros,
+            the mileage charges are not collected), utilization (share of the units out on rent) or
+            distance (km driven on returned rentals)
+        """
+        self._refresh()
+
+        if name == 'rentals':
+            return self._group_count(self.rental_model)
+
+        if name == 'revenue':
+            return [total / 100 for total in self._group_sum(self.rental_model, self.revenue)]
+
+        if name == 'distance':
+            return self._group_sum(self.rental_model, self.distance)
+
+        if name == 'utilization':
+            rented = self._group_sum(self.rental_model, self.is_open)
+            in_stock = self._group_sum(self.model, self.stock)
+            return [out / (out + stock) if out + stock else 0.0 for out, stock in zip(rented, in_stock)]
+
+        raise ValueError(f'Unknown metric {name}')
+
+    def per_model(self, name: str) -> Dict[str, float]:
+        values = self.metric(name)
+        return dict(zip(self.names, values))
+
+    def top(self, name: str, n: int = 10) -> List[tuple]:
+        """
+        The n models with the highest value of a metric as (model, value)
+        """
+        values = self.metric(name)
+        return [(self.names[ref], values[ref]) for ref in nlargest(n, range(len(values)), key=values.__getitem__)]
+
+    def mileage_percentiles(self, percentiles: Sequence[float] = (50, 90, 99)) -> Dict[float, int]:
+        """
+        The catalogue mileage at each percentile (nearest rank)
+        """
+        self._refresh()
+
+        if not self.mileage:
+            return {}
+
+        values = numpy.sort(numpy.frombuffer(self.mileage, dtype=numpy.int64)).tolist() if numpy is not None else \
+            sorted(self.mileage)
+
+        return {percentile: values[max(0, min(len(values), ceil(percentile / 100 * len(values))) - 1)]
+                for percentile in percentiles}
+
+
+def report(machine: Machine, query: str = 'revenue', n: int = 10) -> str:
+    """
+    A string representation of an analytics query: mileage percentiles or the top n models by one
+        of FleetFrame.METRICS
+    """
+    frame = machine.fleet_frame or FleetFrame(machine, live=True)
+
+    if query == 'mileage':
+        return '\n'.join(f'p{percentile:g} - {mileage}km' for percentile, mileage in frame.mileage_percentiles().items())
+
+    if query not in FleetFrame.METRICS:
+        return f"{query} is not a valid query, use mileage or {', '.join(FleetFrame.METRICS)}."
+
+    return '\n'.join(f'{model} - {value:g}' for model, value in frame.top(query, n))
@@ -0,0 +1,157 @@
+"""
+Non-interactive driver for a Machine: reads operations as JSON lines and writes one JSON result line
+per operation, e.g.
+
+    {"op": "rent", "id": 1}                    -> {"op": "rent", "ok": true}
+    {"op": "insert", "coin": 20}               -> {"op": "insert", "ok": true, "paid": 20.0, "enough": true}
+    {"op": "finish", "force": false}           -> {"op": "finish", "ok": true, "change": 0.0, "lease": 1}
+    {"op": "cancel"}                           -> {"op": "cancel", "ok": true}
+    {"op": "return", "id": 1, "mileage": 500}  -> {"op": "return", "ok": true}
+    {"op": "return", "lease": 1, "mileage": 500}
+
+Usage: python batch.py [requests.jsonl|-] [-o results.jsonl] [--vehicles vehicles.json] [--change change.json]
+"""
+import argparse
+import json
+import sys
+from typing import Iterable, Iterator, Optional
+
+from classes import Machine
+from commands import Command, CommandRegistry
+from loader import Loader
+from runner import CHANGE_FN, VEHICLES_FN
+
+
+def rent(command: Command, machine: Machine) -> dict:
+    if machine.current_sale is not None:
+        return {'ok': False, 'error': 'A sale is already in progress.'}
+    if not machine.start_sale(*command.args):
+        return {'ok': False, 'error': 'The vehicle is sold out.'}
+    return {'ok': True}
+
+
+def insert(command: Command, machine: Machine) -> dict:
+    if machine.current_sale is None:
+        return {'ok': False, 'error': 'Please select a vehicle first.'}
+    try:
+        machine.insert_coin(*command.args)
+    except ValueError:
+        return {'ok': False, 'error': 'Invalid coin.'}
+    return {'ok': True, 'paid': machine.cashier.current_amount, 'enough': machine.is_enough_money()}
+
+
+def finish(command: Command, machine: Machine) -> dict:
+    if not machine.is_enough_money():
+        return {'ok': False, 'error': 'Not enough money inserted.'}
+    force = bool(command.args and command.args[0])
+    change = machine.finish_sale(force=force)
+    if change is None and not force:
+        return {'ok': False, 'error': 'No change available.'}
+    return {'ok': True, 'change': change, 'lease': machine.last_lease.id}
+
+
+def cancel(command: Command, machine: Machine) -> dict:
+    machine.cancel_sale()
+    return {'ok': True}
+
+
+def return_vehicle(command: Command, machine: Machine) -> dict:
+    lease = machine.return_lease(*command.args) if command.name == 'return_lease' else \
+        machine.return_vehicle(*command.args)
+    if lease is None:
+        return {'ok': False, 'error': 'The vehicle cannot be returned.'}
+    return {'ok': True, 'lease': lease.id, 'mileage_charge': lease.mileage_charge / 100}
+
+
+# operation name -> (handler, required fields and their types, optional fields and their types)
+OPERATIONS = {
+    'rent': (rent, (('id', int), ), ()),
+    'insert': (insert, (('coin', float), ), ()),
+    'finish': (finish, (), (('force', bool), )),
+    'cancel': (cancel, (), ()),
+    'return': (return_vehicle, (('id', int), ('mileage', int)), ()),
+    'return_lease': (return_vehicle, (('lease', int), ('mileage', int)), ())
+}
+
+REGISTRY = CommandRegistry()
+
+for name, (handler, required, optional) in OPERATIONS.items():
+    REGISTRY.register(name, handler, [kind for _, kind in required], [kind for _, kind in optional])
+
+
+def parse_operation(request: dict) -> Optional[Command]:
+    """
+    The typed command of a JSON operation, None when it is not valid
+    """
+    name = request.get('op')
+    if name == 'return' and 'lease' in request:
+        name = 'return_lease'
+
+    if name not in OPERATIONS:
+        return None
+
+    _, required, optional = OPERATIONS[name]
+    fields = [field for field, _ in required] + [field for field, _ in optional if field in request]
+
+    if any(field not in request for field in fields):
+        return None
+
+    return REGISTRY.build(name, [request[field] for field in fields])
+
+
+def apply_operation(machine: Machine, request: dict) -> dict:
+    """
+    Apply a single operation to the machine and describe the outcome
+    """
+    command = parse_operation(request)
+
+    if command is None:
+        return {'ok': False, 'error': f'{request.get("op")} is not a valid operation.'}
+
+    return REGISTRY.dispatch(command, machine)
+
+
+def run_batch(machine: Machine, lines: Iterable[str]) -> Iterator[str]:
+    """
+    Apply every JSON line operation in order, yielding one JSON line result per operation
+    """
+    for line in lines:
+        if not line.strip():
+            continue
+
+        try:
+            request = json.loads(line)
+            result = {'op': request.get('op'), **apply_operation(machine, request)}
+        except (KeyError, ValueError, AttributeError) as error:
+            result = {'op': None, 'ok': False, 'error': f'Invalid request: {error!r}'}
+
+        yield json.dumps(result)
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description='Replay JSON line operations against a machine')
+    parser.add_argument('requests', nargs='?', default='-', help='JSON lines file with the operations (- for stdin)')
+    parser.add_argument('-o', '--output', default='-', help='JSON lines file for the results (- for stdout)')
+    parser.add_argument('--vehicles', default=VEHICLES_FN)
+    parser.add_argument('--change', default=CHANGE_FN)
+    args = parser.parse_args(argv)
+
+    machine = Machine(verbose=False)
+    loader = Loader(args.vehicles, args.change)
+    loader.reload_vehicles(machine)
+    loader.reload_change(machine)
+
+    infile = sys.stdin if args.requests == '-' else open(args.requests, 'r')
+    outfile = sys.stdout if args.output == '-' else open(args.output, 'w')
+
+    try:
+        outfile.writelines(f'{result}\n' for result in run_batch(machine, infile))
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+        if outfile is not sys.stdout:
+            outfile.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+"""
+Benchmarks of the cashier and machine hot paths on synthetic fleets, drawers and transaction streams
+
+Every benchmark reports ops/sec and latency percentiles; results can be saved as a baseline and later
+runs compared against it, failing when a benchmark got slower than the tolerance allows.
+
+Usage: python bench.py [--scale 1.0] [--seed 0] [--baseline bench_baseline.json] [--save-baseline]
+                       [--tolerance 0.25] [--only name ...]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from catalogue import compile_catalogue, load_catalogue
+from classes import Cashier, Machine, Vehicle
+from loader import Loader
+
+COINS = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0]
+BASELINE_FN = 'bench_baseline.json'
+
+
+def generate_fleet(size: int, rng: random.Random) -> Iterator[Tuple[Vehicle, int]]:
+    """
+    Synthetic vehicles with their stock
+    """
+    for vehicle_id in range(1, size + 1):
+        yield Vehicle(vehicle_id, f'Model {vehicle_id % 997}', rng.randint(5, 300) + rng.choice([0, 0.5, 0.99]),
+                      rng.randint(0, 200000)), rng.randint(0, 50)
+
+
+def generate_drawer(rng: random.Random, depth: int = 500) -> List[Tuple[float, int]]:
+    """
+    A synthetic coin drawer with up to depth coins of every denomination
+    """
+    return [(coin, rng.randint(depth // 2, depth)) for coin in COINS]
+
+
+def generate_transactions(size: int, fleet_size: int, rng: random.Random) -> Iterator[Tuple[int, List[float]]]:
+    """
+    Synthetic sales: the vehicle id and the coins inserted
+    """
+    for _ in range(size):
+        yield rng.randint(1, fleet_size), [rng.choice([5.0, 10.0, 20.0, 50.0]) for _ in range(rng.randint(1, 8))]
+
+
+def build_machine(fleet_size: int, rng: random.Random) -> Machine:
+    machine = Machine(verbose=False)
+
+    for vehicle, stock in generate_fleet(fleet_size, rng):
+        machine.add_vehicle(vehicle, stock)
+
+    for coin, number in generate_drawer(rng):
+        machine.add_change(coin, number)
+
+    return machine
+
+
+def measure(operation: Callable[[], object], repeat: int) -> Dict[str, float]:
+    """
+    Run an operation repeat times, the throughput and latency percentiles (in microseconds)
+    """
+    timings = []
+    clock = time.perf_counter_ns
+
+    for _ in range(repeat):
+        start = clock()
+        operation()
+        timings.append(clock() - start)
+
+    timings.sort()
+    total = sum(timings) or 1
+
+    def percentile(fraction: float) -> float:
+        return timings[min(len(timings) - 1, int(fraction * len(timings)))] / 1000
+
+    return {
+        'ops': repeat,
+        'ops_per_sec': repeat * 1e9 / total,
+        'p50_us': percentile(0.5),
+        'p95_us': percentile(0.95),
+        'p99_us': percentile(0.99)
+    }
+
+
+def bench_calculate_change(scale: float, rng: random.Random) -> Dict[str, float]:
+    cashier = Cashier(verbose=False)
+    for coin, number in generate_drawer(rng):
+        cashier.add_change(coin, number)
+
+    prices = [rng.randint(100, 30000) / 100 for _ in range(256)]
+    state = {'index': 0}
+
+    def operation():
+        price = prices[state['index'] % len(prices)]
+        state['index'] += 1
+        cashier.current_amount = price + rng.randint(0, 5000) / 100
+        cashier.calculate_change(price)
+        cashier.cancel_sale()
+
+    return measure(operation, int(20000 * scale))
+
+
+def bench_finish_sale(scale: float, rng: random.Random) -> Dict[str, float]:
+    fleet_size = int(10000 * scale) or 1
+    machine = build_machine(fleet_size, rng)
+    transactions = generate_transactions(int(20000 * scale), fleet_size, rng)
+
+    def operation():
+        vehicle_id, coins = next(transactions)
+        if not machine.stock.is_available(vehicle_id):
+            machine.stock.set_stock(vehicle_id, 10)
+        machine.start_sale(vehicle_id)
+        for coin in coins:
+            if machine.is_enough_money():
+                break
+            machine.insert_coin(coin)
+        while not machine.is_enough_money():
+            machine.insert_coin(50.0)
+        if machine.finish_sale() is None:
+            machine.finish_sale(force=True)
+
+    return measure(operation, int(20000 * scale))
+
+
+def bench_get_list(scale: float, rng: random.Random) -> Dict[str, float]:
+    fleet_size = int(50000 * scale) or 1
+    machine = build_machine(fleet_size, rng)
+
+    def operation():
+        vehicle_id = rng.randint(1, fleet_size)
+        machine.stock.set_stock(vehicle_id, rng.randint(0, 50))
+        machine.get_list()
+
+    return measure(operation, int(200 * scale) or 1)
+
+
+def bench_get_list_filtered(scale: float, rng: random.Random) -> Dict[str, float]:
+    fleet_size = int(50000 * scale) or 1
+    machine = build_machine(fleet_size, rng)
+
+    return measure(lambda: machine.get_list(in_stock=True, max_price=rng.randint(5, 300), limit=50),
+                   int(5000 * scale) or 1)
+
+
+def bench_search(scale: float, rng: random.Random) -> Dict[str, float]:
+    fleet_size = int(50000 * scale) or 1
+    machine = build_machine(fleet_size, rng)
+    machine.search('model')
+
+    return measure(lambda: machine.search(f'modle {rng.randint(0, 996)}'), int(5000 * scale) or 1)
+
+
+def write_sources(directory: str, scale: float, rng: random.Random) -> Tuple[str, str]:
+    vehicles_fn = os.path.join(directory, 'vehicles.json')
+    change_fn = os.path.join(directory, 'change.json')
+
+    with open(vehicles_fn, 'w') as outfile:
+        json.dump({str(vehicle.id): {'name': vehicle.name, 'stock': stock, 'price': vehicle.price,
+                                     'mileage': vehicle.mileage}
+                   for vehicle, stock in generate_fleet(int(20000 * scale) or 1, rng)}, outfile, indent=2)
+
+    with open(change_fn, 'w') as outfile:
+        json.dump([{'value': coin, 'number': number} for coin, number in generate_drawer(rng)], outfile)
+
+    return vehicles_fn, change_fn
+
+
+def bench_parse_vehicles(scale: float, rng: random.Random) -> Dict[str, float]:
+    with tempfile.TemporaryDirectory() as directory:
+        vehicles_fn, change_fn = write_sources(directory, scale, rng)
+
+        return measure(lambda: Loader(vehicles_fn, change_fn).reload_vehicles(Machine(verbose=False)), 5)
+
+
+def bench_load_catalogue(scale: float, rng: random.Random) -> Dict[str, float]:
+    with tempfile.TemporaryDirectory() as directory:
+        vehicles_fn, change_fn = write_sources(directory, scale, rng)
+        cache_fn = os.path.join(directory, 'catalogue.bin')
+        compile_catalogue(vehicles_fn, change_fn, cache_fn)
+
+        return measure(lambda: load_catalogue(Machine(verbose=False), Loader(vehicles_fn, change_fn), cache_fn), 5)
+
+
+BENCHMARKS = {
+    'calculate_change': bench_calculate_change,
+    'finish_sale': bench_finish_sale,
+    'get_list': bench_get_list,
+    'get_list_filtered': bench_get_list_filtered,
+    'search': bench_search,
+    'parse_vehicles': bench_parse_vehicles,
+    'load_catalogue': bench_load_catalogue
+}
+
+
+def run_benchmarks(names: List[str], scale: float = 1.0, seed: int = 0) -> Dict[str, Dict[str, float]]:
+    return {name: BENCHMARKS[name](scale, random.Random(seed)) for name in names}
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]],
+            tolerance: float) -> List[str]:
+    """
+    The benchmarks whose throughput dropped more than tolerance (a fraction) below the baseline
+    """
+    return [
+        f'{name}: {result["ops_per_sec"]:.0f} ops/sec vs {baseline[name]["ops_per_sec"]:.0f} baseline'
+        for name, result in results.items()
+        if name in baseline and result['ops_per_sec'] < baseline[name]['ops_per_sec'] * (1 - tolerance)
+    ]
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the cashier and machine hot paths')
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiplier of the synthetic data sizes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', default=BASELINE_FN)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed throughput drop, as a fraction')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.only, args.scale, args.seed)
+
+    for name, result in results.items():
+        print(f'{name:<20} {result["ops_per_sec"]:>12.1f} ops/sec  p50 {result["p50_us"]:>10.1f}us  '
+              f'p95 {result["p95_us"]:>10.1f}us  p99 {result["p99_us"]:>10.1f}us')
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        return 0
+
+    with open(args.baseline, 'r') as infile:
+        regressions = compare(results, json.load(infile), args.tolerance)
+
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+"""
+Compiled catalogue cache: vehicles.json and change.json packed in fixed size binary records so a
+start does not have to parse JSON
+
+Layout (little endian): a header with the SHA-256 of both source files and the number of records,
+the vehicle records, the coin records and a blob with the UTF-8 vehicle names. The cache is only
+used while both hashes match the sources, otherwise the machine is loaded from JSON and the cache
+compiled again.
+"""
+import mmap
+import os
+import struct
+from hashlib import sha256
+from typing import Optional, Tuple
+
+from classes import Machine, Vehicle
+from loader import Loader, coin_key, entry_hash, iter_json_entries
+
+MAGIC = b'RMCAT001'
+# magic, vehicles.json SHA-256, change.json SHA-256, number of vehicles, number of coins
+HEADER = struct.Struct('<8s32s32sII')
+# id, price, whether the price is a whole number in the source, mileage, stock, entry hash, name offset,
+# name length
+VEHICLE = struct.Struct('<qd?qqQII')
+# value, number, entry hash
+COIN = struct.Struct('<dqQ')
+
+
+def file_digest(fn: str) -> bytes:
+    with open(fn, 'rb') as infile:
+        return sha256(infile.read()).digest()
+
+
+def compile_catalogue(vehicles_fn: str, change_fn: str, cache_fn: str) -> bool:
+    """
+    Write the cache of the sources, returns False when a source changed while it was compiled
+    """
+    vehicles_digest, change_digest = file_digest(vehicles_fn), file_digest(change_fn)
+    vehicles, coins, names = [], [], bytearray()
+
+    for id, raw, value in iter_json_entries(vehicles_fn):
+        name = value['name'].encode()
+        vehicles.append(VEHICLE.pack(int(id), value['price'], isinstance(value['price'], int), value['mileage'],
+                                     value['stock'], entry_hash(raw), len(names), len(name)))
+        names += name
+
+    for _, raw, coin in iter_json_entries(change_fn):
+        coins.append(COIN.pack(coin['value'], coin['number'], entry_hash(raw)))
+
+    if (vehicles_digest, change_digest) != (file_digest(vehicles_fn), file_digest(change_fn)):
+        return False
+
+    tmp_fn = f'{cache_fn}.tmp'
+
+    with open(tmp_fn, 'wb') as outfile:
+        outfile.write(HEADER.pack(MAGIC, vehicles_digest, change_digest, len(vehicles), len(coins)))
+        outfile.writelines(vehicles)
+        outfile.writelines(coins)
+        outfile.write(names)
+    os.replace(tmp_fn, cache_fn)
+
+    return True
+
+
+def load_catalogue(machine: Machine, loader: Loader, cache_fn: str) -> bool:
+    """
+    Load the machine from the cache when it matches the loader sources, priming the loader so a
+        reload only applies what changed afterwards; returns False when the cache cannot be used
+    """
+    try:
+        with open(cache_fn, 'rb') as infile, mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            entries = _read(view, file_digest(loader.vehicles_fn), file_digest(loader.change_fn))
+    except (OSError, ValueError, struct.error):
+        return False
+
+    if entries is None:
+        return False
+
+    vehicles, coins = entries
+    vehicle_hashes, coin_hashes = {}, {}
+
+    for vehicle, stock, raw_hash in vehicles:
+        machine.add_vehicle(vehicle, stock)
+        vehicle_hashes[str(vehicle.id)] = raw_hash
+
+    for value, number, raw_hash in coins:
+        machine.add_change(value, number)
+        coin_hashes[coin_key(value)] = raw_hash
+
+    loader.prime(loader.vehicles_fn, vehicle_hashes)
+    loader.prime(loader.change_fn, coin_hashes)
+
+    return True
+
+
+def _read(view: mmap.mmap, vehicles_digest: bytes, change_digest: bytes) -> Optional[Tuple[list, list]]:
+    magic, cached_vehicles, cached_change, vehicle_count, coin_count = HEADER.unpack_from(view, 0)
+
+    if (magic, cached_vehicles, cached_change) != (MAGIC, vehicles_digest, change_digest):
+        return None
+
+    coins_start = HEADER.size + vehicle_count * VEHICLE.size
+    names_start = coins_start + coin_count * COIN.size
+
+    with memoryview(view) as buffer:
+        vehicles = [
+            (Vehicle(id, str(buffer[names_start + offset:names_start + offset + length], 'utf-8'),
+                     int(price) if whole else price, mileage), stock, raw_hash)
+            for id, price, whole, mileage, stock, raw_hash, offset, length
+            in VEHICLE.iter_unpack(buffer[HEADER.size:coins_start])
+        ]
+        coins = list(COIN.iter_unpack(buffer[coins_start:names_start]))
+
+    return vehicles, coins
+
+
+def fast_start(machine: Machine, loader: Loader, cache_fn: str) -> bool:
+    """
+    Load the machine from the cache, or from the JSON sources compiling the cache for the next
+        start; returns whether the cache was used
+    """
+    if load_catalogue(machine, loader, cache_fn):
+        return True
+
+    loader.reload_vehicles(machine)
+    loader.reload_change(machine)
+    compile_catalogue(loader.vehicles_fn, loader.change_fn, cache_fn)
+
+    return False
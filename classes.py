@@ -1,7 +1,20 @@
-from typing import NamedTuple, Union
+from collections import deque
+from contextlib import nullcontext
+from itertools import accumulate
+from math import gcd
+from threading import RLock
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+from inventory import Inventory
+from leases import Lease, LeaseTable
+from pricing import PricingEngine, Quote
+from rendering import Listing
+from search import SearchIndex
 
 
 class Vehicle(object):
+    __slots__ = ('id', 'name', 'price', 'mileage')
+
     def __init__(self, id: int, name: str, price: float, mileage: int):
         self.id = id
         self.name = name
@@ -17,79 +30,452 @@ class CurrentSaleInfo(NamedTuple):
     price: float
 
 
+def to_cents(value: Union[str, float]) -> int:
+    """
+    Convert a euro amount into integer cents, absorbing float drift (0.1 + 0.2 -> 30)
+    """
+    return int(round(float(value) * 100))
+
+
+class ChangeSolver:
+    """
+    Bounded coin change solver working in integer cents
+
+    Keeps one DP layer per denomination (ascending) where layer i holds the fewest coins needed to
+    pay every amount up to the current limit using only the first i + 1 denominations, together
+    with how many coins of that denomination were taken. When a coin count changes only the layers
+    from that denomination onwards are recomputed, and while the drawer is unchanged a lookup is
+    O(number of denominations).
+
+    When the denominations are canonical (like the euro ones, where always taking the largest coin
+    gives the fewest coins) and no coin count gets in the way of doing so, the breakdown is taken
+    greedily without touching the layers at all. Otherwise a bounded branch and bound search usually
+    proves the fewest coins in a few hundred steps, the layers are only built when it cannot.
+    """
+    UNREACHABLE = float('inf')
+    SEARCH_BUDGET = 2000
+
+    def __init__(self):
+        self._coins: List[int] = []
+        self._counts: List[int] = []
+        self._best: List[list] = []
+        self._taken: List[List[int]] = []
+        self._total = 0
+        self._limit = 0
+        self._dirty = 0
+        self._canonical = False
+
+    def set_count(self, coin: int, number: int) -> None:
+        """
+        Record the number of coins available for a denomination (in cents)
+        """
+        try:
+            index = self._coins.index(coin)
+        except ValueError:
+            index = len([value for value in self._coins if value < coin])
+            self._coins.insert(index, coin)
+            self._counts.insert(index, number)
+            self._best.insert(index, [])
+            self._taken.insert(index, [])
+            self._canonical = self._is_canonical()
+        else:
+            if self._counts[index] == number:
+                return
+            self._total -= coin * self._counts[index]
+            self._counts[index] = number
+
+        self._total += coin * number
+
+        self._dirty = min(self._dirty, index)
+
+    @property
+    def total(self) -> int:
+        """
+        The total amount of change the solver can pay out (in cents)
+        """
+        return self._total
+
+    def solve(self, amount: int) -> Optional[Dict[int, int]]:
+        """
+        The breakdown {coin: number} using the fewest coins that pays exactly amount (in cents),
+            or None when the coins available cannot make that amount
+        """
+        if amount == 0:
+            return {}
+
+        if amount < 0 or not self._coins or amount > self.total:
+            return None
+
+        # only multiples of the coins left can be paid, like 0.01 once the 0.01 and 0.02 coins are gone
+        if amount % gcd(*(coin for coin, count in zip(self._coins, self._counts) if count)):
+            return None
+
+        breakdown = self._greedy(amount)
+
+        if breakdown is not None:
+            return breakdown
+
+        proved, breakdown = self._search(amount)
+
+        if proved:
+            return breakdown
+
+        if amount > self._limit:
+            self._limit = max(amount, min(self._limit * 2, self.total))
+            self._dirty = 0
+        elif self._dirty < len(self._coins):
+            # the layers rebuilt only need to reach this amount, the ones kept are at least as long
+            self._limit = amount
+
+        if self._dirty < len(self._coins):
+            self._build(self._dirty)
+            self._dirty = len(self._coins)
+
+        if self._best[-1][amount] == self.UNREACHABLE:
+            return None
+
+        breakdown = {}
+
+        for index in reversed(range(len(self._coins))):
+            number = self._taken[index][amount]
+            if number:
+                breakdown[self._coins[index]] = number
+                amount -= number * self._coins[index]
+
+        return breakdown
+
+    def _greedy(self, amount: int) -> Optional[Dict[int, int]]:
+        """
+        The greedy breakdown of amount, None when the denominations are not canonical or there are
+            not enough coins of one of them to take as many as greedy would
+        """
+        if not self._canonical:
+            return None
+
+        breakdown = {}
+
+        for index in reversed(range(len(self._coins))):
+            number, amount = divmod(amount, self._coins[index])
+            if number:
+                if number > self._counts[index]:
+                    return None
+                breakdown[self._coins[index]] = number
+
+        return breakdown
+
+    def _search(self, amount: int) -> Tuple[bool, Optional[Dict[int, int]]]:
+        """
+        Depth-first branch and bound over the denominations from the largest, trying the most coins
+            of each first and pruning branches that cannot pay the rest or cannot beat the best
+            breakdown found; returns whether the search finished within SEARCH_BUDGET branches
+            (the breakdown found is then the fewest coins) and the breakdown
+        """
+        coins, counts = self._coins, self._counts
+        reach = list(accumulate(coin * count for coin, count in zip(coins, counts)))
+        taken = [0] * len(coins)
+        best, best_number, branches = None, self.UNREACHABLE, 0
+
+        def visit(index: int, rest: int, number: int) -> bool:
+            nonlocal best, best_number, branches
+
+            if rest == 0:
+                if number < best_number:
+                    best, best_number = {coins[i]: n for i, n in enumerate(taken) if n}, number
+                return True
+
+            if index < 0 or rest > reach[index] or number - (-rest // coins[index]) >= best_number:
+                return True
+
+            branches += 1
+            if branches > self.SEARCH_BUDGET:
+                return False
+
+            coin = coins[index]
+            for taken[index] in range(min(counts[index], rest // coin), -1, -1):
+                if not visit(index - 1, rest - taken[index] * coin, number + taken[index]):
+                    return False
+            taken[index] = 0
+
+            return True
+
+        return visit(len(coins) - 1, amount, 0), best
+
+    def _is_canonical(self) -> bool:
+        """
+        Whether greedy gives the fewest coins for every amount, checking that each denomination
+            extends the canonical system below it (one-point theorem of Magazine, Nemhauser and
+            Trotter); systems it cannot prove canonical are treated as not canonical
+        """
+        if not self._coins or self._coins[0] != 1:
+            return False
+
+        for index in range(1, len(self._coins) - 1):
+            coin, following = self._coins[index], self._coins[index + 1]
+            multiple = -(-following // coin)
+            rest, number = multiple * coin - following, 1
+
+            for smaller in reversed(self._coins[:index + 1]):
+                taken, rest = divmod(rest, smaller)
+                number += taken
+
+            if number > multiple:
+                return False
+
+        return True
+
+    def _build(self, start: int) -> None:
+        """
+        Recompute the layers from start onwards, each one in O(limit) using a sliding window
+            minimum over every residue class of the denomination
+        """
+        size = self._limit + 1
+
+        for index in range(start, len(self._coins)):
+            coin, count = self._coins[index], self._counts[index]
+
+            if index == 0:
+                previous = [self.UNREACHABLE] * size
+                previous[0] = 0
+            else:
+                previous = self._best[index - 1]
+
+            if not count or coin * count >= size:
+                # none or as many coins as any amount up to the limit can take, no window to slide
+                best, taken = previous[:size], [0] * size
+                for amount in range(coin, size if count else 0):
+                    value = best[amount - coin] + 1
+                    if value < best[amount]:
+                        best[amount] = value
+                        taken[amount] = taken[amount - coin] + 1
+
+                self._best[index] = best
+                self._taken[index] = taken
+                continue
+
+            best = [self.UNREACHABLE] * size
+            taken = [0] * size
+
+            for residue in range(min(coin, size)):
+                window = deque()
+                for step, amount in enumerate(range(residue, size, coin)):
+                    value = previous[amount] - step
+                    while window and window[-1][1] >= value:
+                        window.pop()
+                    window.append((step, value))
+                    while window[0][0] < step - count:
+                        window.popleft()
+
+                    first_step, first_value = window[0]
+                    if first_value != self.UNREACHABLE:
+                        best[amount] = first_value + step
+                        taken[amount] = step - first_step
+
+            self._best[index] = best
+            self._taken[index] = taken
+
+
 class Cashier:
+    """
+    The coin drawer and the coins inserted for the current sale, both as counts per denomination
+        (in cents)
+
+    The coins inserted can already be given as change of the sale, they go into the drawer when the
+        sale is finished and back to the customer when it is cancelled
+
+    VALID_COINS are the denominations of the drawer and VALID_NOTES the notes it also takes, both in
+        cents
+    """
     VALID_COINS = [1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0, 200.0, 500.0]
+    VALID_NOTES = [1000.0, 2000.0, 5000.0, 10000.0, 20000.0]
+    _VALID_CENTS = frozenset(int(coin) for coin in VALID_COINS + VALID_NOTES)
 
-    def __init__(self):
+    def __init__(self, debug: bool = False, verbose: bool = True, thread_safe: bool = False):
+        self.debug = debug
+        self.verbose = verbose
+        self._drawer_lock = RLock() if thread_safe else nullcontext()
         self._change = {}
+        self._total_change = 0
+        self._solver = ChangeSolver()
+        self._pending_change = None
+        self._due = 0
+        self._inserted = {}
         self._total_sold = 0.0
         self.current_amount = 0.0
 
+    @classmethod
+    def to_coin(cls, coin_value: Union[str, float]) -> int:
+        """
+        The denomination (in cents) of a coin or note inserted (in euros), ValueError when it is not
+            one of VALID_COINS or VALID_NOTES
+        """
+        coin = to_cents(coin_value)
+
+        if coin not in cls._VALID_CENTS:
+            raise ValueError(f'{coin_value} is not a valid coin')
+
+        return coin
+
     def add_change(self, coin_value: Union[str, float], number: Union[str, int]) -> None:
         """
         Populate the available change by adding a coin value and the number of coins available
         """
         try:
-            self._change[float(coin_value) * 100] = int(number)
+            coin, number = to_cents(coin_value), int(number)
+            with self._drawer_lock:
+                self._set_coins(coin, number)
         except ValueError:
-            print('Cannot insert change.')
+            self._log('Cannot insert change.')
             raise
 
-    def calculate_change(self, price: float) -> float:
+    def _log(self, message: str) -> None:
+        if self.verbose:
+            print(message)
+
+    def _set_coins(self, coin: int, number: int) -> None:
         """
-        Check if the coins available are enough or fit the change needed
+        Single entry point for every change to the coin counts so the solver tables stay in sync
         """
+        self._total_change += coin * (number - self._change.get(coin, 0))
+        self._change[coin] = number
+        self._solver.set_count(coin, number + self._inserted.get(coin, 0))
 
-        change = self.current_amount - price
-        change_to_calculate = change
+        if self.debug:
+            self._check_total_change()
 
-        if change_to_calculate == 0.0:
-            return change
-
-        if self.total_change < change_to_calculate:
-            return None
+    def _check_total_change(self) -> None:
+        """
+        Debug check that the running total matches the coins in the drawer
+        """
+        total = sum(coin * number for coin, number in self._change.items())
+        if total != self._total_change:
+            raise AssertionError(f'Running total change {self._total_change} does not match the drawer {total}')
 
-        for value in reversed(self.VALID_COINS):
-            number_coins_needed = int(change_to_calculate / value)
-            if number_coins_needed != 0 and self._change[value] != 0:
-                if number_coins_needed <= self._change[value]:
-                    self._change[value] -= number_coins_needed
-                    change_coin_available = value * number_coins_needed
-                else:
-                    change_coin_available = value * self._change[value]
-                    self._change[value] = 0
+    def calculate_change(self, price: float) -> Optional[float]:
+        """
+        Check if the coins available are enough or fit the change needed
 
-                change_to_calculate -= change_coin_available
+        The coin breakdown is only reserved for the current sale, the drawer is untouched until
+            the sale is finished
+        """
+        with self._drawer_lock:
+            self._due = to_cents(self.current_amount) - to_cents(price)
+            pending = self._pending_change = self._solver.solve(self._due)
 
-            if change_to_calculate == 0.0:
-                return change
+        if pending is None:
+            return None
 
-        return None
+        return sum(coin * number for coin, number in pending.items()) / 100
 
     def insert_coin(self, coin_value: str) -> None:
         """
         Simulate the coin inserted by the customer/buyer
         """
         try:
-            self.current_amount += float(coin_value)
+            coin = self.to_coin(coin_value)
         except ValueError:
-            print('Invalid coin.')
+            self._log('Invalid coin.')
             raise
 
-    def finish_sale(self) -> None:
+        with self._drawer_lock:
+            number = self._inserted[coin] = self._inserted.get(coin, 0) + 1
+            self._solver.set_count(coin, self._change.get(coin, 0) + number)
+
+        self.current_amount += coin / 100
+
+    def finish_sale(self, force: bool = False) -> Optional[Dict[int, int]]:
         """
         Close a sale and reset the current sale state
             (total sold so far and the current amount inserted tracker)
+
+        The change reserved by calculate_change is checked against the drawer when it is paid out
+            and solved again when the coins went meanwhile (change set, another session); when
+            there is no change any more the sale is left open unless forced
+
+        Returns the coins paid out as change, None when there were none
         """
-        self._total_sold += self.current_amount
+        with self._drawer_lock:
+            breakdown = self._pending_change
+
+            if breakdown is not None and not self._has_coins(breakdown):
+                breakdown = self._solver.solve(self._due)
+
+                if breakdown is None and not force:
+                    return None
+
+            inserted, self._inserted = self._inserted, {}
+            self._credit(inserted)
+            self._pay_out(breakdown or {})
+            self._total_sold += self.current_amount
+
+        self._pending_change = None
         self.current_amount = 0.0
 
-    def cancel_sale(self) -> None:
+        return breakdown
+
+    def _has_coins(self, breakdown: Dict[int, int]) -> bool:
         """
-        Cancel a sale which means reset the current amount inserted tracker
+        Whether the drawer and the coins inserted still have the coins of a breakdown
+        """
+        return all(self._change.get(coin, 0) + self._inserted.get(coin, 0) >= number
+                   for coin, number in breakdown.items())
+
+    def settle(self, paid: int, price: int, force: bool = False,
+               coins: Optional[Dict[int, int]] = None) -> Optional[Dict[int, int]]:
         """
+        Close a sale tracked outside of the cashier (amounts in cents) in one step: credits the
+            coins inserted, pays out the change (possibly with those coins) and books the amount
+            paid, or leaves the drawer untouched when there is no change for it unless forced
+
+        Returns the coins paid out as change, None when there was no change available
+        """
+        coins = coins or {}
+
+        with self._drawer_lock:
+            self._credit(coins)
+            breakdown = self._solver.solve(paid - price)
+
+            if breakdown is None and not force:
+                self._pay_out(coins)
+                return None
+
+            self._pay_out(breakdown or {})
+            self._total_sold += paid / 100
+
+        return breakdown
+
+    def record_sale(self, paid: int, breakdown: Dict[int, int], coins: Optional[Dict[int, int]] = None) -> None:
+        """
+        Book a sale already decided (amounts in cents): credits the coins inserted, pays out the
+            coins given as change and adds the amount paid to the total sold
+        """
+        with self._drawer_lock:
+            self._credit(coins or {})
+            self._pay_out(breakdown)
+            self._total_sold += paid / 100
+
+    def _credit(self, coins: Dict[int, int]) -> None:
+        for coin, number in coins.items():
+            self._set_coins(coin, self._change.get(coin, 0) + number)
+
+    def _pay_out(self, breakdown: Dict[int, int]) -> None:
+        for coin, number in breakdown.items():
+            self._set_coins(coin, self._change[coin] - number)
+
+    def cancel_sale(self) -> Dict[int, int]:
+        """
+        Cancel a sale which means reset the current amount inserted tracker, returns the coins
+            inserted (in cents) back to the customer
+        """
+        with self._drawer_lock:
+            inserted, self._inserted = self._inserted, {}
+            for coin in inserted:
+                self._solver.set_count(coin, self._change.get(coin, 0))
+
+        self._pending_change = None
         self.current_amount = 0.0
 
+        return inserted
+
     @property
     def total(self) -> float:
         """
@@ -100,9 +486,26 @@ class Cashier:
     @property
     def total_change(self) -> float:
         """
-        The total amount of change available
+        The total amount of change available, kept as a running total in cents
+        """
+        if self.debug:
+            self._check_total_change()
+
+        return self._total_change / 100
+
+    @property
+    def inserted(self) -> Dict[int, int]:
+        """
+        The coins (in cents) inserted for the current sale
         """
-        return sum([value * number for value, number in self._change.items()])
+        return self._inserted
+
+    @property
+    def pending_change(self) -> Optional[Dict[int, int]]:
+        """
+        The coins (in cents) reserved as change for the current sale
+        """
+        return self._pending_change
 
     @property
     def change(self) -> dict:
@@ -114,47 +517,91 @@ class Cashier:
 
 class Machine:
 
-    def __init__(self):
-        self.stock = {}
-        self.cashier = Cashier()
+    def __init__(self, stock: Optional[Inventory] = None, verbose: bool = True, thread_safe: bool = False):
+        """
+        With thread_safe, Sessions of the machine can be used from many threads: the stock is
+            locked per vehicle, the coin drawer and the lease table have locks of their own
+        """
+        self.verbose = verbose
+        self.stock = Inventory(thread_safe=thread_safe) if stock is None else stock
+        self.listing = Listing(self.stock)
+        self.search_index = SearchIndex(self.stock)
+        self.cashier = Cashier(verbose=verbose, thread_safe=thread_safe)
         self.current_sale = None
-        self.rented = {}
+        self.current_quote = None
+        self.current_reservation = None
+        self.last_lease = None
+        self.leases = LeaseTable(thread_safe=thread_safe)
+        self.pricing = PricingEngine()
+        self.reservations = None
+        self.ledger = None
+        self.journal = None
+        self.metrics = None
+        self.fleet_frame = None
         self.options = {
             'rv': 'Reload Vehicle Stock',
             'rc': 'Reload Change',
             'help': 'All options',
-            'list': 'List all vehicles available',
+            'list': 'List all vehicles available, in stock under [max price] if given',
             'info': 'Info about vehicle with [id]',
             'rent': 'Rent a vehicle with [id]',
             'return': 'Return a vehicle [id] with [mileage]'
         }
+        self._options_text = None
+
+    def _log(self, message: str) -> None:
+        if self.verbose:
+            print(message)
+
+    def _record(self, event: dict, logged: Optional[Callable[[], None]] = None) -> None:
+        """
+        Append a state change to the journal, when the machine has one; logged is called once it is
+            in the log, before any snapshot can be taken
+        """
+        if self.journal is not None:
+            self.journal.append(event, logged)
+        elif logged is not None:
+            logged()
 
     def add_vehicle(self, vehicle: Vehicle, stock: int) -> None:
         """
         Add a vehicle to the machine stock
         """
         if isinstance(vehicle, Vehicle):
-            self.stock[vehicle.id] = {
-                'vehicle': vehicle,
-                'stock': stock
-            }
+            self.stock.add(vehicle, stock)
+            self._record({'e': 'vehicle', 'id': vehicle.id, 'name': vehicle.name, 'price': vehicle.price,
+                          'mileage': vehicle.mileage, 'stock': stock})
 
     def add_change(self, coin_value: float, number: int) -> None:
         """
         Used as a proxy to add change to the cashier
         """
         self.cashier.add_change(coin_value, number)
+        self._record({'e': 'change', 'coin': to_cents(coin_value), 'number': int(number)})
 
-    def start_sale(self, option: str) -> bool:
+    def start_sale(self, option: str, reservation: Optional[int] = None) -> bool:
         """
-        Set the current sale as the vehicle the user has chosen
+        Set the current sale as the vehicle the user has chosen, picking up a reservation if given
+            (see reservations.py); a unit is held for it like a Session does (see Inventory.hold)
         """
         option = int(option)
+        vehicle = self.stock[option]['vehicle']
+
+        if not self.stock.is_available(option):
+            return False
+
+        if self.reservations is not None and not self.reservations.can_rent(option, reservation):
+            return False
 
-        if self.stock[option]['stock'] == 0:
+        if not self.stock.hold(option):
             return False
 
-        self.current_sale = self.stock[int(option)]['vehicle']
+        if self.current_sale is not None:
+            self.stock.release(self.current_sale.id, True)
+
+        self.current_sale = vehicle
+        self.current_quote = self.pricing.quote(vehicle)
+        self.current_reservation = reservation
 
         return True
 
@@ -163,7 +610,7 @@ class Machine:
         Simulate the coin inserted by the customer/buyer
         """
         if self.current_sale is None:
-            print('Please select a vehicle first.')
+            self._log('Please select a vehicle first.')
             return
 
         self.cashier.insert_coin(value)
@@ -175,7 +622,7 @@ class Machine:
         if self.current_sale is None:
             return False
 
-        return self.cashier.current_amount >= self.current_sale.price
+        return to_cents(self.cashier.current_amount) >= self.current_quote.price
 
     def finish_sale(self, force: bool = False) -> float:
         """
@@ -184,71 +631,194 @@ class Machine:
         A sale can be forced to finish if there is no change but the buyer still wants the rent
             the vehicle
         """
-        change = self.cashier.calculate_change(self.current_sale.price)
+        change = self.cashier.calculate_change(self.current_quote.price / 100)
 
         if change is not None or force:
-            print(f'\nYou just bought a {self.current_sale.name} and '
-                  f'got €{change if change is not None else 0.0} change.')
+            paid, coins = to_cents(self.cashier.current_amount), dict(self.cashier.inserted)
+            # the drawer can change between the calculation and the payout, the cashier checks it
+            breakdown = self.cashier.finish_sale(force)
+
+            if breakdown is None and change is not None:
+                if not force:
+                    return None
+                change = None
+
+            self.last_lease = self.commit_sale(self.current_sale, paid, breakdown or {}, coins, self.current_quote,
+                                               self.current_reservation, held=True)
+
+            self._log(f'\nYou just bought a {self.current_sale.name} and '
+                      f'got €{change if change is not None else 0.0} change. Your lease is {self.last_lease.id}.')
 
-            self.stock[self.current_sale.id]['stock'] -= 1
-            self.rented[self.current_sale.id] = self.current_sale
             self.current_sale = None
-            self.cashier.finish_sale()
+            self.current_quote = None
+            self.current_reservation = None
 
         return change
 
-    def return_vehicle(self, vehicle_id: str, mileage: str):
+    def commit_sale(self, vehicle: Vehicle, paid: int, breakdown: Dict[int, int],
+                    coins: Optional[Dict[int, int]] = None, quote: Optional[Quote] = None,
+                    reservation: Optional[int] = None, held: bool = False) -> Lease:
         """
-        Return a vehicle with new mileage
+        Open the lease of a sale whose stock and change are settled and journal it, releasing its
+            unit when it was held (see Inventory.hold)
         """
-        try:
-            vehicle = self.rented[int(vehicle_id)]
-            if int(mileage) <= vehicle.mileage:
-                print('A vehicle returned cannot have less/equal mileage.')
-                return
-        except KeyError:
-            print(f'Vehicle {vehicle_id} is not rented')
-            return
+        quote = quote or self.pricing.quote(vehicle)
+        lease = self.record_rental(vehicle, quote, reservation)
+        event = {'e': 'sale', 'id': vehicle.id, 'paid': paid, 'change': breakdown, 'coins': coins or {},
+                 'quote': list(quote), 'lease': lease.id}
+
+        if reservation is not None:
+            event['reservation'] = reservation
 
-        self.stock[int(vehicle_id)]['stock'] += 1
-        self.stock[int(vehicle_id)]['vehicle'].mileage = int(mileage)
-        self.rented.pop(int(vehicle_id))
+        if self.ledger is not None:
+            event['t'] = self.ledger.record(vehicle.id, paid, sum(coin * number for coin, number in breakdown.items()))
 
-        print(f'Vehicle {vehicle_id} returned successfully with new mileage {mileage}')
+        self._record(event, (lambda: self.stock.release(vehicle.id, False)) if held else None)
 
-    def cancel_sale(self) -> None:
+        return lease
+
+    def record_rental(self, vehicle: Vehicle, quote: Optional[Quote] = None,
+                      reservation: Optional[int] = None) -> Lease:
         """
-        Cancel a sale in the case there is no change and the user does not want to rent the vehicle
+        Open a lease for the unit of the vehicle that left the machine with a finished sale, on the
+            terms of its quote, and hold its unit in the reservations
         """
+        quote = quote or self.pricing.quote(vehicle)
+        lease = self.leases.open(vehicle.id, vehicle.mileage, quote.km_allowance, quote.per_km, quote.price)
+
+        if self.reservations is not None:
+            self.reservations.rent(lease.id, vehicle.id, reservation)
+
+        return lease
+
+    def return_vehicle(self, vehicle_id: str, mileage: str) -> Optional[Lease]:
+        """
+        Return a vehicle with new mileage, closing the oldest open lease of that vehicle; returns
+            the closed lease (see return_lease)
+        """
+        lease = self.leases.oldest_open(int(vehicle_id))
+
+        if lease is None:
+            self._log(f'Vehicle {vehicle_id} is not rented')
+            return None
+
+        return self.return_lease(lease.id, mileage)
+
+    def return_lease(self, lease_id: Union[str, int], mileage: Union[str, int]) -> Optional[Lease]:
+        """
+        Return the unit of a lease with new mileage, the catalogue vehicle is left untouched;
+            returns the closed lease, with the mileage_charge due, None when it cannot be returned
+        """
+        lease = self.leases.get(int(lease_id))
+
+        if lease is None or not lease.is_open:
+            self._log(f'Lease {lease_id} is not open')
+            return None
+
+        if self.leases.close(lease.id, int(mileage)) is None:
+            self._log('A vehicle returned cannot have less/equal mileage.')
+            return None
+
+        self.stock.put_back(lease.vehicle_id)
+        if self.reservations is not None:
+            self.reservations.release(lease.id)
+        self._record({'e': 'return', 'lease': lease.id, 'mileage': int(mileage)})
+
+        self._log(f'Vehicle {lease.vehicle_id} returned successfully with new mileage {mileage}')
+
+        if lease.mileage_charge:
+            self._log(f'€{lease.mileage_charge / 100} is due for the km over the {lease.km_allowance}km included.')
+
+        return lease
+
+    def cancel_sale(self) -> Dict[int, int]:
+        """
+        Cancel a sale in the case there is no change and the user does not want to rent the vehicle,
+            returns the coins inserted (in cents)
+        """
+        if self.current_sale is not None:
+            self.stock.release(self.current_sale.id, True)
+
         self.current_sale = None
-        self.cashier.cancel_sale()
+        self.current_quote = None
+        self.current_reservation = None
+        returned = self.cashier.cancel_sale()
+
+        if returned:
+            self._log('Returned ' + ', '.join(f'{number} x €{coin / 100}' for coin, number in sorted(returned.items())))
+
+        return returned
 
     def get_current_sale_info(self) -> CurrentSaleInfo:
         """
-        The amount paid by the buyer and the selected vehicle price
+        The amount paid by the buyer and the price quoted for the selected vehicle
+        """
+        return CurrentSaleInfo(self.cashier.current_amount, self.current_quote.price / 100)
+
+    def add_option(self, command: str, description: str) -> None:
+        """
+        Add an option to the menu
         """
-        return CurrentSaleInfo(self.cashier.current_amount, self.current_sale.price)
+        self.options[command] = description
+        self._options_text = None
 
     def get_options(self) -> str:
         """
-        A string representation of the option (menu) the user can select from
+        A string representation of the option (menu) the user can select from, rendered once
         """
-        return '\n'.join([f'{command} - {description}' for command, description in self.options.items()])
+        if self._options_text is None:
+            self._options_text = '\n'.join([f'{command} - {description}' for command, description in self.options.items()])
 
-    def get_list(self) -> str:
+        return self._options_text
+
+    def get_list(self, in_stock: bool = False, max_price: Optional[float] = None, offset: int = 0,
+                 limit: Optional[int] = None) -> str:
+        """
+        A string representation of a page of the vehicles, optionally only the ones in stock
+            and/or up to a price
         """
-        A string representation of the options (menu) the user can select from
+        if not in_stock and max_price is None and offset == 0 and limit is None:
+            return self.listing.full()
+
+        return self.listing.render(self.stock.query_ids(in_stock=in_stock, max_price=max_price, offset=offset,
+                                                        limit=limit))
+
+    def iter_list(self, in_stock: bool = False, max_price: Optional[float] = None) -> Iterator[str]:
         """
-        return '\n'.join([f'{vehicles["vehicle"]} - (Stock: {vehicles["stock"]})' for vehicles in self.stock.values()])
+        The same as get_list in chunks of lines, to stream big catalogues
+        """
+        if not in_stock and max_price is None:
+            yield from self.listing.iter_chunks()
+            return
+
+        offset = 0
+
+        while True:
+            vehicle_ids = self.stock.query_ids(in_stock=in_stock, max_price=max_price, offset=offset,
+                                               limit=self.listing.CHUNK_SIZE)
+            if not vehicle_ids:
+                return
+
+            yield self.listing.render(vehicle_ids)
+            offset += len(vehicle_ids)
+
+    def search(self, query: str, limit: int = 10) -> str:
+        """
+        A string representation of the vehicles in stock whose name best matches a query
+        """
+        vehicle_ids = self.search_index.search(query, limit)
+
+        if not vehicle_ids:
+            return f'No vehicle in stock matches {query}.'
+
+        return self.listing.render(vehicle_ids)
 
     def get_vehicle_info(self, vehicle_id: str) -> str:
         """
         A string representation of the vehicle
         """
-        vehicle = self.stock.get(int(vehicle_id), None)
-
-        if vehicle:
-            return f'{vehicle["vehicle"]}'
+        if int(vehicle_id) in self.stock:
+            return self.listing.info(int(vehicle_id))
 
         return f'No vehicle with ID {vehicle_id} found.'
 
@@ -258,7 +828,7 @@ class Machine:
         """
         return option.split(' ')[0].lower() in self.options
 
-    def total_change(self) -> bool:
+    def total_change(self) -> float:
         """
         The total change available in the cashier
         """
@@ -308,9 +878,17 @@ class Machine:
     @staticmethod
     def is_list_option(option: str) -> bool:
         """
-        Checks if the option inserted by the user is to list all vehicle
+        Checks if the option inserted by the user is to list all vehicle or the ones in stock under a price
         """
-        return option.lower() == 'list'
+        try:
+            command, *price = option.split(' ')
+            if len(price) > 1:
+                return False
+            [float(value) for value in price]
+        except ValueError:
+            return False
+
+        return command.lower() == 'list'
 
     @staticmethod
     def is_info_option(option: str) -> bool:
@@ -344,3 +922,109 @@ class Machine:
             return False
 
         return command.lower() == 'return'
+
+
+class Session:
+    """
+    A sale in progress of one customer among many sharing the same machine
+
+    Starting a sale reserves a unit of the vehicle in the shared stock and the coins inserted stay
+        in the session, the shared drawer is only touched when the sale is finished (commit) and
+        the reserved unit goes back to the stock when the sale is cancelled (rollback)
+    """
+
+    def __init__(self, machine: Machine):
+        self.machine = machine
+        self.vehicle = None
+        self.quote = None
+        self.reservation = None
+        self.lease = None
+        self.amount = 0
+        self.coins = {}
+
+    def start_sale(self, vehicle_id: Union[str, int], reservation: Optional[int] = None) -> bool:
+        """
+        Reserve a unit of the vehicle for this session, False when it is sold out or kept for a
+            booking (see reservations.py)
+        """
+        if self.vehicle is not None:
+            return False
+
+        vehicle = self.machine.stock[int(vehicle_id)]['vehicle']
+        reservations = self.machine.reservations
+
+        if reservations is not None and not reservations.can_rent(vehicle.id, reservation):
+            return False
+
+        if not self.machine.stock.hold(vehicle.id):
+            return False
+
+        self.vehicle = vehicle
+        self.quote = self.machine.pricing.quote(vehicle)
+        self.reservation = reservation
+
+        return True
+
+    def insert_coin(self, value: Union[str, float]) -> None:
+        """
+        Simulate the coin inserted by the customer/buyer, ValueError when it is not a valid coin
+        """
+        coin = Cashier.to_coin(value)
+        self.coins[coin] = self.coins.get(coin, 0) + 1
+        self.amount += coin
+
+    @property
+    def paid(self) -> float:
+        """
+        The amount inserted so far in this session
+        """
+        return self.amount / 100
+
+    @property
+    def price(self) -> float:
+        """
+        The price quoted for the vehicle of this session
+        """
+        return self.quote.price / 100
+
+    def is_enough_money(self) -> bool:
+        """
+        Check if the amount inserted by the customer is enough
+        """
+        return self.vehicle is not None and self.amount >= self.quote.price
+
+    def finish_sale(self, force: bool = False) -> Optional[float]:
+        """
+        Commit the sale when there is change available or is forced to finish
+        """
+        breakdown = self.machine.cashier.settle(self.amount, self.quote.price, force, self.coins)
+
+        if breakdown is None and not force:
+            return None
+
+        self.lease = self.machine.commit_sale(self.vehicle, self.amount, breakdown or {}, self.coins, self.quote,
+                                              self.reservation, held=True)
+        self.vehicle = None
+        self.quote = None
+        self.reservation = None
+        self.amount = 0
+        self.coins = {}
+
+        return None if breakdown is None else sum(coin * number for coin, number in breakdown.items()) / 100
+
+    def cancel_sale(self) -> Dict[int, int]:
+        """
+        Roll the sale back, the reserved unit goes back to the stock and the coins inserted (in
+            cents) are returned
+        """
+        if self.vehicle is not None:
+            self.machine.stock.release(self.vehicle.id, True)
+
+        returned = self.coins
+        self.vehicle = None
+        self.quote = None
+        self.reservation = None
+        self.amount = 0
+        self.coins = {}
+
+        return returned
@@ -0,0 +1,144 @@
+from typing import Callable, Dict, NamedTuple, Optional, Sequence, Tuple
+
+
+class Command(NamedTuple):
+    name: str
+    args: tuple
+
+
+class CommandSpec(NamedTuple):
+    handler: Optional[Callable]
+    required: Tuple[Callable, ...]
+    optional: Tuple[Callable, ...]
+    description: str
+    # the converter of any number of arguments after the optional ones, None when there are none
+    rest: Optional[Callable] = None
+
+
+# The arguments of the Machine.options commands: (required converters, optional converters) and
+# the converter of any further arguments if the command takes them
+MACHINE_ARGUMENTS = {
+    'list': ((), (float, )),
+    'info': ((int, ), ()),
+    'rent': ((int, ), (int, )),
+    'return': ((int, int), ()),
+    'metrics': ((), (str, )),
+    'stats': ((), (str, int)),
+    'reserve': ((int, float, float), ()),
+    'free': ((int, float, float), ()),
+    'unreserve': ((int, ), ()),
+    'revenue': ((), (float, int)),
+    'search': ((str, ), (), str)
+}
+
+
+def _to_int(token: str) -> Optional[int]:
+    digits = token[1:] if token[:1] in '+-' else token
+    return int(token) if digits.isdecimal() else None
+
+
+def _to_float(token: str) -> Optional[float]:
+    integer, _, fraction = (token[1:] if token[:1] in '+-' else token).partition('.')
+    if (integer or fraction) and (not integer or integer.isdecimal()) and (not fraction or fraction.isdecimal()):
+        return float(token)
+    return None
+
+
+def _to_bool(token: str) -> Optional[bool]:
+    return {'true': True, 'false': False, '1': True, '0': False}.get(str(token).lower())
+
+
+_CONVERTERS = {int: _to_int, float: _to_float, bool: _to_bool, str: str}
+
+
+class CommandRegistry:
+    """
+    Commands by name with the type of their arguments and the handler that applies them
+
+    A line is tokenized once into a typed Command (or None when it is not valid) and dispatched to
+        the handler of its name, so new commands only need to be registered
+    """
+
+    def __init__(self):
+        self._specs: Dict[str, CommandSpec] = {}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._specs
+
+    def register(self, name: str, handler: Optional[Callable] = None, required: Sequence[Callable] = (),
+                 optional: Sequence[Callable] = (), description: str = '', rest: Optional[Callable] = None) -> None:
+        """
+        Register a command with the converters of its arguments: the required ones, the optional
+            ones and, when rest is given, any number of arguments after them
+        """
+        self._specs[name] = CommandSpec(handler, tuple(required), tuple(optional), description, rest)
+
+    def handle(self, name: str, handler: Callable) -> None:
+        """
+        Set the handler of a registered command
+        """
+        self._specs[name] = self._specs[name]._replace(handler=handler)
+
+    def parse(self, option: str) -> Optional[Command]:
+        """
+        The typed command of a line like 'return 1 300', None when it is not a valid command
+        """
+        tokens = option.split()
+
+        if not tokens:
+            return None
+
+        return self.build(tokens[0].lower(), tokens[1:])
+
+    def build(self, name: str, args: Sequence) -> Optional[Command]:
+        """
+        The typed command from a name and its raw arguments, None when they are not valid
+        """
+        spec = self._specs.get(name)
+
+        if spec is None or len(args) < len(spec.required):
+            return None
+
+        converters = spec.required + spec.optional
+        extra = len(args) - len(converters)
+
+        if extra > 0:
+            if spec.rest is None:
+                return None
+            converters += (spec.rest, ) * extra
+
+        values = []
+
+        for converter, arg in zip(converters, args):
+            value = arg if type(arg) is converter else _CONVERTERS.get(converter, converter)(str(arg))
+            if value is None:
+                return None
+            values.append(value)
+
+        return Command(name, tuple(values))
+
+    def dispatch(self, command: Command, *context):
+        """
+        Apply a command with its handler, the context is passed along to the handler
+        """
+        return self._specs[command.name].handler(command, *context)
+
+    def describe(self) -> str:
+        """
+        A string representation of the commands (menu) the user can select from
+        """
+        return '\n'.join([f'{name} - {spec.description}' for name, spec in self._specs.items()])
+
+
+def machine_registry(options: Dict[str, str], handlers: Optional[Dict[str, Callable]] = None) -> CommandRegistry:
+    """
+    A registry with the commands of Machine.options and their arguments
+    """
+    handlers = handlers or {}
+    registry = CommandRegistry()
+
+    for name, description in options.items():
+        required, optional, *rest = MACHINE_ARGUMENTS.get(name, ((), ()))
+        registry.register(name, handlers.get(name), required, optional, description, *rest)
+
+    return registry
@@ -0,0 +1,231 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Iterator, Optional, Tuple
+
+from classes import Vehicle
+from inventory import Inventory
+
+
+class VehicleView(Vehicle):
+    """
+    A Vehicle backed by a row of a CompactInventory, reads and writes go straight to the columns
+    """
+    __slots__ = ('_inventory', '_row')
+
+    def __init__(self, inventory: 'CompactInventory', row: int):
+        self._inventory = inventory
+        self._row = row
+
+    @property
+    def id(self) -> int:
+        return self._inventory._ids[self._row]
+
+    @property
+    def name(self) -> str:
+        return self._inventory._names[self._inventory._name_refs[self._row]]
+
+    @property
+    def price(self) -> float:
+        return self._inventory._prices[self._row]
+
+    @property
+    def mileage(self) -> int:
+        return self._inventory._mileages[self._row]
+
+    @mileage.setter
+    def mileage(self, mileage: int) -> None:
+        self._inventory._mileages[self._row] = mileage
+
+
+class RowIndex:
+    """
+    The rows of a CompactInventory sorted by (price, id) in bounded buckets of row numbers (arrays)
+        like a SortedIndex, the keys are read from the columns: a SortedIndex without a tuple per
+        vehicle, bar the last key of every bucket
+    """
+    LOAD = 512
+
+    def __init__(self, inventory: 'CompactInventory'):
+        self._inventory = inventory
+        self._buckets = []
+        self._maxes = []
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self) -> Iterator[Tuple[float, int]]:
+        return map(self._key, self.rows())
+
+    def rows(self) -> Iterator[int]:
+        for bucket in self._buckets:
+            yield from bucket
+
+    def _key(self, row: int) -> Tuple[float, int]:
+        return self._inventory._prices[row], self._inventory._ids[row]
+
+    def add(self, key: Tuple[float, int]) -> None:
+        row = self._inventory._rows[key[1]]
+        self._len += 1
+
+        if not self._buckets:
+            self._buckets.append(array('L', [row]))
+            self._maxes.append(key)
+            return
+
+        index = min(bisect_left(self._maxes, key), len(self._maxes) - 1)
+        bucket = self._buckets[index]
+        bucket.insert(bisect_left(bucket, key, key=self._key), row)
+        self._maxes[index] = self._key(bucket[-1])
+
+        if len(bucket) > 2 * self.LOAD:
+            self._buckets.insert(index + 1, bucket[self.LOAD:])
+            self._maxes.insert(index + 1, self._key(bucket[-1]))
+            del bucket[self.LOAD:]
+            self._maxes[index] = self._key(bucket[-1])
+
+    def discard(self, key: Tuple[float, int]) -> None:
+        index = bisect_left(self._maxes, key)
+        if index == len(self._maxes):
+            return
+
+        bucket = self._buckets[index]
+        position = bisect_left(bucket, key, key=self._key)
+        if position == len(bucket) or self._key(bucket[position]) != key:
+            return
+
+        self._len -= 1
+        del bucket[position]
+
+        if bucket:
+            self._maxes[index] = self._key(bucket[-1])
+        else:
+            del self._buckets[index]
+            del self._maxes[index]
+
+    def range(self, low: tuple, high: tuple, offset: int = 0,
+              limit: Optional[int] = None) -> Iterator[Tuple[float, int]]:
+        """
+        The keys between low and high (inclusive), skipping the first offset ones, at most limit
+        """
+        index = bisect_left(self._maxes, low)
+        if index == len(self._maxes):
+            return
+
+        position = bisect_left(self._buckets[index], low, key=self._key)
+
+        while index < len(self._buckets) and offset >= len(self._buckets[index]) - position:
+            offset -= len(self._buckets[index]) - position
+            index, position = index + 1, 0
+
+        position += offset
+
+        while index < len(self._buckets) and limit != 0:
+            bucket = self._buckets[index]
+            end = bisect_right(bucket, high, position, key=self._key)
+            if limit is not None:
+                end = min(end, position + limit)
+                limit -= end - position
+
+            yield from map(self._key, bucket[position:end])
+
+            if end < len(bucket):
+                return
+
+            index, position = index + 1, 0
+
+
+class CompactInventory(Inventory):
+    """
+    An Inventory that keeps the fleet in typed arrays (id, price, mileage, stock and a reference
+        into an interned name table) instead of one Vehicle and one dict per model
+
+    The price indexes are buckets of rows sorted by the price column (see RowIndex) and a vehicle is
+        available when its stock is, so apart from the id to row dict nothing is kept per vehicle
+        but the columns: about 170 bytes per vehicle against about 520 for an Inventory
+
+    Vehicles added are copied into the columns and dropped, VehicleView objects are handed out on
+        demand, e.g. Machine(stock=CompactInventory())
+    """
+
+    def __init__(self, thread_safe: bool = False):
+        super().__init__(thread_safe)
+        self._rows = {}
+        self._ids = array('q')
+        self._prices = array('d')
+        self._mileages = array('q')
+        self._stocks = array('q')
+        self._name_refs = array('L')
+        self._names = []
+        self._name_table = {}
+        self._available = None
+        self._by_price = RowIndex(self)
+        self._available_by_price = RowIndex(self)
+
+    def __getitem__(self, vehicle_id: int) -> dict:
+        row = self._rows[vehicle_id]
+
+        return {
+            'vehicle': VehicleView(self, row),
+            'stock': self._stocks[row]
+        }
+
+    def __contains__(self, vehicle_id: int) -> bool:
+        return vehicle_id in self._rows
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._rows)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def _store(self, vehicle, stock: int) -> None:
+        name_ref = self._name_table.get(vehicle.name)
+        if name_ref is None:
+            name_ref = self._name_table[vehicle.name] = len(self._names)
+            self._names.append(vehicle.name)
+
+        row = self._rows.get(vehicle.id)
+        if row is None:
+            self._rows[vehicle.id] = len(self._ids)
+            self._ids.append(vehicle.id)
+            self._prices.append(vehicle.price)
+            self._mileages.append(vehicle.mileage)
+            self._stocks.append(stock)
+            self._name_refs.append(name_ref)
+            return
+
+        self._prices[row] = vehicle.price
+        self._mileages[row] = vehicle.mileage
+        self._stocks[row] = stock
+        self._name_refs[row] = name_ref
+
+    def _stock(self, vehicle_id: int) -> int:
+        return self._stocks[self._rows[vehicle_id]]
+
+    def _write_stock(self, vehicle_id: int, stock: int) -> None:
+        self._stocks[self._rows[vehicle_id]] = stock
+
+    def _price(self, vehicle_id: int) -> float:
+        return self._prices[self._rows[vehicle_id]]
+
+    def is_available(self, vehicle_id: int) -> bool:
+        row = self._rows.get(vehicle_id)
+        return row is not None and self._stocks[row] > 0
+
+    @property
+    def available(self) -> frozenset:
+        with self._index_lock:
+            return frozenset(self._ids[row] for row in self._available_by_price.rows())
+
+    def _mark_available(self, vehicle_id: int) -> None:
+        self._available_by_price.add((self._price(vehicle_id), vehicle_id))
+
+    def _mark_unavailable(self, vehicle_id: int) -> None:
+        self._available_by_price.discard((self._price(vehicle_id), vehicle_id))
+
+    def _unindex(self, vehicle_id: int) -> None:
+        if self.is_available(vehicle_id):
+            self._mark_unavailable(vehicle_id)
+
+        self._by_price.discard((self._price(vehicle_id), vehicle_id))
@@ -0,0 +1,214 @@
+"""
+Many machines sharded over a pool of worker processes, each worker owns the machines (stock and
+cashier drawer) of its shard, so operations on different shards run on different cores
+
+    with Fleet(workers=4) as fleet:
+        fleet.add_machine('lisbon-1', parse_vehicles(), parse_change())
+        fleet.apply('lisbon-1', {'op': 'rent', 'id': 1})
+        fleet.run([{'machine': 'lisbon-1', 'op': 'insert', 'coin': 20}, ...])
+        fleet.total_revenue()
+"""
+import multiprocessing
+import os
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+
+from batch import apply_operation
+from classes import Machine, Vehicle
+
+
+def revenue(machine: Machine) -> float:
+    return machine.cashier.total
+
+
+def model_stock(machine: Machine, name: str) -> int:
+    name = name.lower()
+    return sum(entry['stock'] for entry in machine.stock.values() if entry['vehicle'].name.lower() == name)
+
+
+def change_available(machine: Machine) -> float:
+    return machine.total_change()
+
+
+# Queries run on every machine of a shard, by name so they can be sent to the workers
+QUERIES = {
+    'revenue': revenue,
+    'model_stock': model_stock,
+    'change_available': change_available
+}
+
+
+def _apply(machines: Dict[Hashable, Machine], machine_id: Hashable, request: dict) -> dict:
+    """
+    Apply an operation to a machine of the shard, a failing operation is reported in its result
+        (as run_batch does) so the other results of the shard are kept
+    """
+    if machine_id not in machines:
+        return {'ok': False, 'error': f'No machine with ID {machine_id} found.'}
+
+    try:
+        return apply_operation(machines[machine_id], request)
+    except (KeyError, ValueError, AttributeError) as error:
+        return {'ok': False, 'error': f'Invalid request: {error!r}'}
+
+
+def _serve_shard(connection) -> None:
+    """
+    The loop of a worker process: applies the messages received to the machines of its shard
+    """
+    machines: Dict[Hashable, Machine] = {}
+
+    while True:
+        kind, payload = connection.recv()
+
+        if kind == 'stop':
+            break
+
+        try:
+            if kind == 'add':
+                machine_id, vehicles, change = payload
+                machine = machines[machine_id] = Machine(verbose=False)
+                for vehicle, stock in vehicles:
+                    machine.add_vehicle(vehicle, stock)
+                for coin, number in change:
+                    machine.add_change(coin, number)
+                result = None
+            elif kind == 'apply':
+                result = [_apply(machines, machine_id, request) for machine_id, request in payload]
+            elif kind == 'query':
+                name, args = payload
+                result = {machine_id: QUERIES[name](machine, *args) for machine_id, machine in machines.items()}
+            else:
+                raise ValueError(f'Unknown fleet message {kind}')
+        except Exception as error:
+            connection.send(('error', error))
+        else:
+            connection.send(('ok', result))
+
+    connection.close()
+
+
+class Fleet:
+    """
+    Routes every operation to the worker that owns its machine by machine id, and runs queries
+        over the whole fleet on every worker at once, aggregating the results
+    """
+
+    def __init__(self, workers: Optional[int] = None):
+        self._connections = []
+        self._processes = []
+
+        for _ in range(workers or os.cpu_count() or 1):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_serve_shard, args=(child, ), daemon=True)
+            process.start()
+            child.close()
+            self._connections.append(parent)
+            self._processes.append(process)
+
+    def __enter__(self) -> 'Fleet':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def shard(self, machine_id: Hashable) -> int:
+        """
+        The worker that owns a machine
+        """
+        return hash(machine_id) % len(self._connections)
+
+    def _call(self, shards: Iterable[Tuple[int, tuple]]) -> list:
+        """
+        Send a message to each of the shards, then wait for all of them, so they work in parallel
+        """
+        shards = list(shards)
+
+        for shard, message in shards:
+            self._connections[shard].send(message)
+
+        replies = [self._connections[shard].recv() for shard, _ in shards]
+
+        for status, result in replies:
+            if status == 'error':
+                raise result
+
+        return [result for _, result in replies]
+
+    def add_machine(self, machine_id: Hashable, vehicles: Iterable[Tuple[Vehicle, int]] = (),
+                    change: Iterable[Tuple[float, int]] = ()) -> None:
+        """
+        Create a machine in its worker with the given stock and coins
+        """
+        self._call([(self.shard(machine_id), ('add', (machine_id, list(vehicles), list(change))))])
+
+    def apply(self, machine_id: Hashable, request: dict) -> dict:
+        """
+        Apply a single batch operation (see batch.py) to a machine
+        """
+        return self._call([(self.shard(machine_id), ('apply', [(machine_id, request)]))])[0][0]
+
+    def run(self, requests: Iterable[dict]) -> List[dict]:
+        """
+        Apply batch operations tagged with their 'machine', the operations of every shard are
+            applied in order and the shards in parallel; returns the results in request order
+        """
+        batches: Dict[int, list] = {}
+        positions: Dict[int, List[int]] = {}
+
+        for position, request in enumerate(requests):
+            request = dict(request)
+            machine_id = request.pop('machine', None)
+            shard = self.shard(machine_id)
+            batches.setdefault(shard, []).append((machine_id, request))
+            positions.setdefault(shard, []).append(position)
+
+        results = [None] * sum(len(batch) for batch in batches.values())
+        replies = self._call([(shard, ('apply', batch)) for shard, batch in batches.items()])
+
+        for shard, reply in zip(batches, replies):
+            for position, result in zip(positions[shard], reply):
+                results[position] = result
+
+        return results
+
+    def query(self, name: str, *args) -> dict:
+        """
+        The result of a query (see QUERIES) for every machine in the fleet by machine id
+        """
+        results = {}
+
+        for reply in self._call([(shard, ('query', (name, args))) for shard in range(len(self._connections))]):
+            results.update(reply)
+
+        return results
+
+    def total_revenue(self) -> float:
+        """
+        The amount collected by the whole fleet
+        """
+        return sum(self.query('revenue').values())
+
+    def model_stock(self, name: str) -> int:
+        """
+        The units of a model (by vehicle name) in stock across the fleet
+        """
+        return sum(self.query('model_stock', name).values())
+
+    def low_on_change(self, threshold: float) -> List[Hashable]:
+        """
+        The machines with less than threshold of change available
+        """
+        return [machine_id for machine_id, total in self.query('change_available').items() if total < threshold]
+
+    def close(self) -> None:
+        """
+        Stop the workers, their machines are discarded
+        """
+        for connection in self._connections:
+            connection.send(('stop', None))
+            connection.close()
+
+        for process in self._processes:
+            process.join()
+
+        self._connections, self._processes = [], []
@@ -0,0 +1,124 @@
+from typing import Dict, Iterable, List
+
+from classes import ChangeSolver, Machine, to_cents
+
+# What customers usually insert for a price (in cents): the exact amount or the price rounded up to
+# one of these steps (a coin or a note)
+PAYMENT_STEPS = (100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+def likely_change(price: int) -> List[int]:
+    """
+    The change (in cents) the likely payments of a price (in cents) need, 0 for the exact amount
+    """
+    return sorted({0} | {-price % step for step in PAYMENT_STEPS})
+
+
+class ChangeForecast:
+    """
+    Which prices of the stock the coins in the drawer can still give change for, given what
+        customers usually insert, and the coins to reload so they all can
+
+    It works on a copy of the drawer taken when it is created, so it can be kept around to check
+        many vehicles; create a new one once the drawer changed
+    """
+
+    def __init__(self, machine: Machine):
+        self._machine = machine
+        self._drawer = dict(machine.cashier.change)
+        self._solver = ChangeSolver()
+        self._payable = {}
+
+        for coin, number in self._drawer.items():
+            self._solver.set_count(coin, number)
+
+    def can_pay(self, change: int) -> bool:
+        """
+        Whether the drawer can pay an amount of change (in cents)
+        """
+        payable = self._payable.get(change)
+
+        if payable is None:
+            payable = self._payable[change] = self._solver.solve(change) is not None
+
+        return payable
+
+    def failing_change(self, price: float) -> List[int]:
+        """
+        The likely change amounts of a price the drawer cannot pay (in cents)
+        """
+        return [change for change in likely_change(to_cents(price)) if not self.can_pay(change)]
+
+    def success_rate(self, price: float) -> float:
+        """
+        The share of the likely payments of a price the drawer can give change for
+        """
+        changes = likely_change(to_cents(price))
+        return (len(changes) - len(self.failing_change(price))) / len(changes)
+
+    def at_risk(self, threshold: float = 1.0) -> Dict[int, float]:
+        """
+        The vehicles in stock whose success rate (at their quoted price) is below threshold, by vehicle id
+        """
+        rates = {}
+
+        for vehicle_id in sorted(self._machine.stock.available):
+            rate = self.success_rate(self._quoted(vehicle_id))
+            if rate < threshold:
+                rates[vehicle_id] = rate
+
+        return rates
+
+    def _quoted(self, vehicle_id: int) -> float:
+        return self._machine.pricing.quote(self._machine.stock[vehicle_id]['vehicle']).price / 100
+
+    def reload_plan(self, prices: Iterable[float] = None) -> Dict[int, int]:
+        """
+        The coins (in cents) to add so every likely change of the prices (the prices of the vehicles
+            in stock by default) can be paid
+
+        Each amount is paid as far as possible with the coins in the drawer, largest first, and the
+            rest with new coins; the plan holds, per coin, the most any single amount needs, so a
+            sale at any of the prices can be paid after the reload
+        """
+        if prices is None:
+            prices = [self._quoted(vehicle_id) for vehicle_id in self._machine.stock.available]
+
+        coins = sorted(self._drawer, reverse=True)
+        plan = {}
+
+        for change in sorted({change for price in set(prices) for change in self.failing_change(price)}):
+            remaining, extra = change, {}
+
+            for coin in coins:
+                remaining -= coin * min(self._drawer[coin], remaining // coin)
+
+            for coin in coins:
+                if remaining >= coin:
+                    extra[coin], remaining = divmod(remaining, coin)
+
+            if remaining:
+                # the denominations of the drawer cannot make this amount at all
+                continue
+
+            for coin, number in extra.items():
+                plan[coin] = max(plan.get(coin, 0), number)
+
+        return dict(sorted(plan.items()))
+
+
+def describe(forecast: ChangeForecast, machine: Machine, threshold: float = 1.0) -> str:
+    """
+    A string representation of the vehicles at risk and the reload plan
+    """
+    lines = [
+        f'{machine.get_vehicle_info(vehicle_id)} - change available for {rate:.0%} of the usual payments'
+        for vehicle_id, rate in forecast.at_risk(threshold).items()
+    ] or ['Change is available for every vehicle in stock.']
+
+    plan = forecast.reload_plan()
+
+    if plan:
+        lines.append('Reload: ' + ', '.join(f'{number} x €{coin / 100}' for coin, number in plan.items()))
+
+    return '\n'.join(lines)
@@ -0,0 +1,323 @@
+from bisect import bisect_left, bisect_right, insort
+from collections.abc import Mapping
+from contextlib import nullcontext
+from itertools import islice
+from threading import Lock, RLock
+from typing import Callable, Dict, Iterator, List, Optional
+
+
+class SortedIndex:
+    """
+    A sorted collection of keys kept as a list of bounded buckets, so inserts and removals only
+        shift one bucket instead of the whole index
+    """
+    LOAD = 512
+
+    def __init__(self):
+        self._buckets = []
+        self._maxes = []
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self) -> Iterator[tuple]:
+        for bucket in self._buckets:
+            yield from bucket
+
+    def add(self, key: tuple) -> None:
+        self._len += 1
+
+        if not self._buckets:
+            self._buckets.append([key])
+            self._maxes.append(key)
+            return
+
+        index = min(bisect_left(self._maxes, key), len(self._maxes) - 1)
+        bucket = self._buckets[index]
+        insort(bucket, key)
+        self._maxes[index] = bucket[-1]
+
+        if len(bucket) > 2 * self.LOAD:
+            self._buckets.insert(index + 1, bucket[self.LOAD:])
+            self._maxes.insert(index + 1, bucket[-1])
+            del bucket[self.LOAD:]
+            self._maxes[index] = bucket[-1]
+
+    def discard(self, key: tuple) -> None:
+        index = bisect_left(self._maxes, key)
+        if index == len(self._maxes):
+            return
+
+        bucket = self._buckets[index]
+        position = bisect_left(bucket, key)
+        if position == len(bucket) or bucket[position] != key:
+            return
+
+        self._len -= 1
+        del bucket[position]
+
+        if bucket:
+            self._maxes[index] = bucket[-1]
+        else:
+            del self._buckets[index]
+            del self._maxes[index]
+
+    def range(self, low: tuple, high: tuple, offset: int = 0, limit: Optional[int] = None) -> Iterator[tuple]:
+        """
+        The keys between low and high (inclusive), skipping the first offset ones, at most limit
+        """
+        index = bisect_left(self._maxes, low)
+        if index == len(self._maxes):
+            return
+
+        position = bisect_left(self._buckets[index], low)
+
+        while index < len(self._buckets) and offset >= len(self._buckets[index]) - position:
+            offset -= len(self._buckets[index]) - position
+            index, position = index + 1, 0
+
+        position += offset
+
+        while index < len(self._buckets) and limit != 0:
+            bucket = self._buckets[index]
+            end = bisect_right(bucket, high, position)
+            if limit is not None:
+                end = min(end, position + limit)
+                limit -= end - position
+
+            yield from bucket[position:end]
+
+            if end < len(bucket):
+                return
+
+            index, position = index + 1, 0
+
+
+class Inventory(Mapping):
+    """
+    The machine stock, a mapping of vehicle id to {'vehicle': Vehicle, 'stock': int}
+
+    Alongside the entries it keeps the set of in-stock ids and (price, id) indexes sorted by price
+        for the whole catalogue and for the in-stock vehicles only, all updated incrementally so
+        availability and price queries never scan the catalogue
+
+    With thread_safe every vehicle gets its own lock around its stock count, so units of different
+        vehicles are taken and put back in parallel, and the shared indexes have a separate lock
+        that is only taken when a vehicle goes in or out of stock (always after the vehicle lock)
+    """
+    _NO_LOCK = nullcontext()
+    # the vehicles.json the vehicles are read from on demand (see lazy.py), None when they are all
+    # held by the inventory
+    vehicles_fn = None
+
+    def __init__(self, thread_safe: bool = False):
+        self.thread_safe = thread_safe
+        self._locks = {}
+        self._index_lock = RLock() if thread_safe else self._NO_LOCK
+        self._listeners = []
+        self._entries = {}
+        self._held: Dict[int, int] = {}
+        self._available = set()
+        self._by_price = SortedIndex()
+        self._available_by_price = SortedIndex()
+
+    def __getitem__(self, vehicle_id: int) -> dict:
+        return self._entries[vehicle_id]
+
+    def __contains__(self, vehicle_id: int) -> bool:
+        return vehicle_id in self._entries
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._entries)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, vehicle, stock: int) -> None:
+        """
+        Add a vehicle to the stock, replacing the entry if the id is already known
+        """
+        if self.thread_safe:
+            self._locks.setdefault(vehicle.id, Lock())
+
+        with self._vehicle_lock(vehicle.id), self._index_lock:
+            if vehicle.id in self:
+                self._unindex(vehicle.id)
+
+            self._store(vehicle, stock)
+            self._by_price.add((vehicle.price, vehicle.id))
+
+            if stock > 0:
+                self._mark_available(vehicle.id)
+
+        self._notify(vehicle.id)
+
+    def subscribe(self, listener: Callable[[int], None]) -> None:
+        """
+        Call listener with the vehicle id every time a vehicle is added/replaced or its stock changes
+        """
+        self._listeners.append(listener)
+
+    def set_stock(self, vehicle_id: int, stock: int) -> None:
+        """
+        Set the number of units available of a vehicle, keeping the availability indexes in sync
+        """
+        with self._vehicle_lock(vehicle_id):
+            self._set_stock(vehicle_id, stock)
+
+    def take(self, vehicle_id: int) -> bool:
+        """
+        Remove one unit of a vehicle from the stock, False when it is sold out
+        """
+        with self._vehicle_lock(vehicle_id):
+            stock = self._stock(vehicle_id)
+
+            if stock <= 0:
+                return False
+
+            self._set_stock(vehicle_id, stock - 1)
+
+        return True
+
+    def put_back(self, vehicle_id: int) -> None:
+        """
+        Add one unit of a vehicle back to the stock
+        """
+        with self._vehicle_lock(vehicle_id):
+            self._set_stock(vehicle_id, self._stock(vehicle_id) + 1)
+
+    def hold(self, vehicle_id: int) -> bool:
+        """
+        Take a unit of a vehicle for a sale in progress, False when it is sold out
+
+        The unit is counted as held until the sale is journaled or rolled back (see release), so
+            counts still has it
+        """
+        with self._vehicle_lock(vehicle_id):
+            stock = self._stock(vehicle_id)
+
+            if stock <= 0:
+                return False
+
+            self._held[vehicle_id] = self._held.get(vehicle_id, 0) + 1
+            self._set_stock(vehicle_id, stock - 1)
+
+        return True
+
+    def release(self, vehicle_id: int, put_back: bool) -> None:
+        """
+        Stop holding a unit: it is sold (journaled) or, with put_back, back in stock
+        """
+        with self._vehicle_lock(vehicle_id):
+            held = self._held[vehicle_id] - 1
+
+            if held:
+                self._held[vehicle_id] = held
+            else:
+                del self._held[vehicle_id]
+
+            if put_back:
+                self._set_stock(vehicle_id, self._stock(vehicle_id) + 1)
+
+    def counts(self) -> Dict[int, int]:
+        """
+        The units of every vehicle as journaled: the ones in stock and the ones held by sales in
+            progress, read from the counts only (no Vehicle is looked at)
+        """
+        counts = {}
+
+        for vehicle_id in list(self):
+            with self._vehicle_lock(vehicle_id):
+                counts[vehicle_id] = self._stock(vehicle_id) + self._held.get(vehicle_id, 0)
+
+        return counts
+
+    def is_available(self, vehicle_id: int) -> bool:
+        """
+        Checks if there is at least one unit of the vehicle in stock
+        """
+        return vehicle_id in self._available
+
+    @property
+    def available(self) -> frozenset:
+        """
+        The ids of every vehicle in stock
+        """
+        with self._index_lock:
+            return frozenset(self._available)
+
+    def query(self, in_stock: bool = False, min_price: Optional[float] = None, max_price: Optional[float] = None,
+              offset: int = 0, limit: Optional[int] = None) -> List[dict]:
+        """
+        A page of stock entries, optionally only the ones in stock and/or within a price range
+
+        The whole catalogue comes in catalogue order, any filtered query comes sorted by price
+        """
+        with self._index_lock:
+            return [self[vehicle_id] for vehicle_id in self.query_ids(in_stock, min_price, max_price, offset, limit)]
+
+    def query_ids(self, in_stock: bool = False, min_price: Optional[float] = None, max_price: Optional[float] = None,
+                  offset: int = 0, limit: Optional[int] = None) -> List[int]:
+        """
+        The ids of the vehicles of a query page, see query
+        """
+        stop = None if limit is None else offset + limit
+
+        with self._index_lock:
+            if not in_stock and min_price is None and max_price is None:
+                return list(islice(self, offset, stop))
+
+            index = self._available_by_price if in_stock else self._by_price
+            keys = index.range((-float('inf'), ) if min_price is None else (min_price, ),
+                               (float('inf'), ) if max_price is None else (max_price, float('inf')), offset, limit)
+
+            return [vehicle_id for _, vehicle_id in keys]
+
+    def _vehicle_lock(self, vehicle_id: int):
+        return self._locks[vehicle_id] if self.thread_safe else self._NO_LOCK
+
+    def _notify(self, vehicle_id: int) -> None:
+        for listener in self._listeners:
+            listener(vehicle_id)
+
+    def _set_stock(self, vehicle_id: int, stock: int) -> None:
+        was_available = self._stock(vehicle_id) > 0
+        self._write_stock(vehicle_id, stock)
+        self._notify(vehicle_id)
+
+        if stock > 0 and not was_available:
+            with self._index_lock:
+                self._mark_available(vehicle_id)
+        elif stock <= 0 and was_available:
+            with self._index_lock:
+                self._mark_unavailable(vehicle_id)
+
+    def _store(self, vehicle, stock: int) -> None:
+        self._entries[vehicle.id] = {
+            'vehicle': vehicle,
+            'stock': stock
+        }
+
+    def _stock(self, vehicle_id: int) -> int:
+        return self._entries[vehicle_id]['stock']
+
+    def _write_stock(self, vehicle_id: int, stock: int) -> None:
+        self._entries[vehicle_id]['stock'] = stock
+
+    def _price(self, vehicle_id: int) -> float:
+        return self._entries[vehicle_id]['vehicle'].price
+
+    def _mark_available(self, vehicle_id: int) -> None:
+        self._available.add(vehicle_id)
+        self._available_by_price.add((self._price(vehicle_id), vehicle_id))
+
+    def _mark_unavailable(self, vehicle_id: int) -> None:
+        self._available.discard(vehicle_id)
+        self._available_by_price.discard((self._price(vehicle_id), vehicle_id))
+
+    def _unindex(self, vehicle_id: int) -> None:
+        if vehicle_id in self._available:
+            self._mark_unavailable(vehicle_id)
+
+        self._by_price.discard((self._price(vehicle_id), vehicle_id))
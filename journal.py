@@ -0,0 +1,272 @@
+import json
+import os
+import time
+from threading import RLock, Timer
+from typing import Callable, Optional
+
+from classes import Machine, Vehicle, to_cents
+from loader import iter_json_entries
+from pricing import Quote
+
+LOG_FN = 'journal.log'
+SNAPSHOT_FN = 'snapshot.json'
+
+
+class Journal:
+    """
+    Write-ahead log of the machine state changes (vehicles and change added, sales finished,
+        vehicles returned and bookings) as JSON lines, with periodic snapshots of the whole state
+
+    Appends are group committed: the log is flushed and fsynced once sync_every events are pending
+        or sync_interval seconds passed since the last sync, whichever comes first, and a timer
+        syncs pending events sync_interval seconds after the first of them when no append does, so
+        a crash loses at most sync_interval seconds of events. Every
+        snapshot_every events the state is written to a snapshot and the log starts over; each event
+        carries a sequence number so a log left behind by a crash mid-snapshot is not replayed twice
+
+    Usage:
+        journal = Journal('state')
+        journal.recover(machine)  # snapshot + log tail, then machine.journal = journal
+    """
+
+    def __init__(self, directory: str, sync_every: int = 64, sync_interval: float = 0.05,
+                 snapshot_every: Optional[int] = 100000):
+        os.makedirs(directory, exist_ok=True)
+        self.log_fn = os.path.join(directory, LOG_FN)
+        self.snapshot_fn = os.path.join(directory, SNAPSHOT_FN)
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.snapshot_every = snapshot_every
+        self.machine = None
+        self._lock = RLock()
+        self._log = None
+        self._seq = 0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._timer = None
+        self._since_snapshot = 0
+
+    def recover(self, machine: Machine) -> int:
+        """
+        Restore the machine from the last snapshot and the events logged after it, then start
+            journaling its changes; returns how many events were replayed
+        """
+        snapshot_seq = 0
+
+        if os.path.exists(self.snapshot_fn):
+            with open(self.snapshot_fn, 'r') as infile:
+                snapshot = json.load(infile)
+            restore_snapshot(machine, snapshot)
+            snapshot_seq = self._seq = snapshot['seq']
+
+        replayed, end = 0, 0
+
+        if os.path.exists(self.log_fn):
+            with open(self.log_fn, 'rb') as infile:
+                for line in infile:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError('Unterminated event')
+                        event = json.loads(line)
+                    except ValueError:
+                        # a torn write at the end of the log from a crash
+                        break
+                    end += len(line)
+                    if event['seq'] <= snapshot_seq:
+                        continue
+                    replay_event(machine, event)
+                    self._seq = event['seq']
+                    replayed += 1
+
+            # drop the torn tail so the next events do not end up on its line
+            if end < os.path.getsize(self.log_fn):
+                with open(self.log_fn, 'r+b') as outfile:
+                    outfile.truncate(end)
+                    os.fsync(outfile.fileno())
+
+        self._since_snapshot = replayed
+        self._log = open(self.log_fn, 'a')
+        self.machine = machine
+        machine.journal = self
+
+        return replayed
+
+    def append(self, event: dict, logged: Optional[Callable[[], None]] = None) -> None:
+        """
+        Log an event, syncing the log when the group commit window is full; logged is called once
+            the event is in the log, before a snapshot can be taken
+        """
+        with self._lock:
+            self._seq += 1
+            self._log.write(json.dumps({'seq': self._seq, **event}, separators=(',', ':')) + '\n')
+            self._unsynced += 1
+            self._since_snapshot += 1
+
+            if logged is not None:
+                logged()
+
+            if self._unsynced >= self.sync_every or time.monotonic() - self._last_sync >= self.sync_interval:
+                self.sync()
+            elif self._timer is None:
+                self._timer = Timer(self.sync_interval, self._sync_pending)
+                self._timer.daemon = True
+                self._timer.start()
+
+            if self.snapshot_every is not None and self._since_snapshot >= self.snapshot_every:
+                self.snapshot()
+
+    def sync(self) -> None:
+        """
+        Make every event logged so far durable
+        """
+        with self._lock:
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            self._unsynced = 0
+            self._last_sync = time.monotonic()
+            self._cancel_timer()
+
+    def _sync_pending(self) -> None:
+        with self._lock:
+            self._timer = None
+
+            if self._log is not None and self._unsynced:
+                self.sync()
+
+    def _cancel_timer(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def snapshot(self) -> None:
+        """
+        Write the whole machine state atomically and start an empty log
+        """
+        with self._lock:
+            self.sync()
+
+            snapshot = take_snapshot(self.machine)
+            snapshot['seq'] = self._seq
+            tmp_fn = f'{self.snapshot_fn}.tmp'
+
+            with open(tmp_fn, 'w') as outfile:
+                json.dump(snapshot, outfile, separators=(',', ':'))
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            os.replace(tmp_fn, self.snapshot_fn)
+
+            self._log.close()
+            self._log = open(self.log_fn, 'w')
+            self._since_snapshot = 0
+
+    def close(self) -> None:
+        """
+        Sync the log and stop journaling the machine
+        """
+        with self._lock:
+            if self._log is not None:
+                self.sync()
+                self._log.close()
+                self._log = None
+
+            if self.machine is not None:
+                self.machine.journal = None
+                self.machine = None
+
+
+def take_snapshot(machine: Machine) -> dict:
+    """
+    The state of a machine: stock, coins in the drawer, total sold, leases, bookings and revenue
+    """
+    counts, catalogue = machine.stock.counts(), machine.stock.vehicles_fn
+    # a lazy inventory only has the vehicles that differ from its catalogue built, and the counts
+    vehicle_ids = counts if catalogue is None else machine.stock.pinned()
+
+    return {
+        'vehicles': [
+            [vehicle.id, vehicle.name, vehicle.price, vehicle.mileage, counts[vehicle.id]]
+            for vehicle in (machine.stock[vehicle_id]['vehicle'] for vehicle_id in vehicle_ids)
+        ],
+        **({'catalogue': catalogue, 'stock': [[vehicle_id, count] for vehicle_id, count in counts.items()]}
+           if catalogue is not None else {}),
+        'change': [[coin, number] for coin, number in machine.cashier.change.items()],
+        'total_sold': machine.cashier.total,
+        'leases': machine.leases.snapshot(),
+        **({'reservations': machine.reservations.snapshot()} if machine.reservations is not None else {}),
+        **({'ledger': machine.ledger.snapshot()} if machine.ledger is not None else {})
+    }
+
+
+def restore_snapshot(machine: Machine, snapshot: dict) -> None:
+    """
+    Load a snapshot into an empty machine, or one whose LazyInventory has the catalogue of the
+        snapshot opened
+    """
+    if 'catalogue' in snapshot:
+        add_catalogue(machine, snapshot['catalogue'])
+
+    for id, name, price, mileage, stock in snapshot['vehicles']:
+        machine.stock.add(Vehicle(id, name, price, mileage), stock)
+
+    for id, stock in snapshot.get('stock', ()):
+        if id in machine.stock:
+            machine.stock.set_stock(id, stock)
+
+    for coin, number in snapshot['change']:
+        machine.cashier.add_change(coin / 100, number)
+
+    machine.cashier.record_sale(to_cents(snapshot['total_sold']), {})
+    machine.leases.restore(snapshot['leases'])
+
+    if machine.reservations is not None:
+        machine.reservations.restore(snapshot.get('reservations', {'next_id': 1, 'bookings': []}))
+
+    if machine.ledger is not None:
+        machine.ledger.restore(snapshot.get('ledger', {'all': [], 'models': {}}))
+
+
+def add_catalogue(machine: Machine, vehicles_fn: str) -> None:
+    """
+    Add the vehicles of the catalogue a lazy machine started from (see lazy.py) that the machine
+        does not have, nothing for a machine that has it opened lazily
+    """
+    if machine.stock.vehicles_fn is not None:
+        return
+
+    for id, _, value in iter_json_entries(vehicles_fn):
+        if int(id) not in machine.stock:
+            machine.stock.add(Vehicle(int(id), value['name'], value['price'], value['mileage']), value['stock'])
+
+
+def replay_event(machine: Machine, event: dict) -> None:
+    """
+    Apply a logged event to the machine state, the machine must not be journaling
+    """
+    kind = event['e']
+
+    if kind == 'vehicle':
+        machine.stock.add(Vehicle(event['id'], event['name'], event['price'], event['mileage']), event['stock'])
+    elif kind == 'change':
+        machine.cashier.add_change(event['coin'] / 100, event['number'])
+    elif kind == 'sale':
+        machine.stock.take(event['id'])
+        vehicle = machine.stock[event['id']]['vehicle']
+        machine.record_rental(vehicle, Quote(*event['quote']) if 'quote' in event else None, event.get('reservation'))
+        machine.cashier.record_sale(event['paid'], {int(coin): number for coin, number in event['change'].items()},
+                                    {int(coin): number for coin, number in event.get('coins', {}).items()})
+        # sales are timed only when the machine that journaled them had a Ledger
+        if machine.ledger is not None and 't' in event:
+            machine.ledger.replay(event)
+    elif kind == 'return':
+        lease = machine.leases.close(event['lease'], event['mileage'])
+        machine.stock.put_back(lease.vehicle_id)
+        if machine.reservations is not None:
+            machine.reservations.release(lease.id)
+    elif kind == 'catalogue':
+        add_catalogue(machine, event['fn'])
+    elif kind in ('reserve', 'unreserve'):
+        # bookings only matter to a machine with a ReservationBook
+        if machine.reservations is not None:
+            machine.reservations.replay(event)
+    else:
+        raise ValueError(f'Unknown journal event {kind}')
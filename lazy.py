@@ -0,0 +1,267 @@
+"""
+Lazy catalogue: the machine starts from a sidecar index of vehicles.json (the byte range of every
+vehicle with its price, stock and entry hash) and only builds a Vehicle from the memory-mapped
+source the first time a sale, an info or a listing needs it
+
+Index layout (little endian): a header with the modification time and size of the source it was
+built from and the number of records, then the records. The index is built again whenever the
+source changed.
+"""
+import json
+import mmap
+import os
+import struct
+from collections import OrderedDict
+from contextlib import nullcontext
+from threading import Lock, RLock
+from typing import Dict, Iterator, List, Tuple
+
+from classes import Machine, Vehicle
+from inventory import Inventory
+from loader import Loader, entry_hash, iter_json_entries
+
+MAGIC = b'RMIDX001'
+# magic, source modification time (ns), source size, number of vehicles
+HEADER = struct.Struct('<8sqqI')
+# id, offset, length, price, whether the price is a whole number in the source, stock, entry hash
+RECORD = struct.Struct('<qQId?qQ')
+
+
+def source_signature(fn: str) -> Tuple[int, int]:
+    stat = os.stat(fn)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def build_index(vehicles_fn: str, index_fn: str) -> None:
+    """
+    Index every vehicle of the source by its byte range, reading it as latin-1 so offsets are bytes
+    """
+    signature, records = source_signature(vehicles_fn), []
+
+    for id, raw, value, offset in iter_json_entries(vehicles_fn, encoding='latin-1', offsets=True):
+        records.append(RECORD.pack(int(id), offset, len(raw), value['price'], isinstance(value['price'], int),
+                                   value['stock'], entry_hash(raw.encode('latin-1').decode())))
+
+    tmp_fn = f'{index_fn}.tmp'
+
+    with open(tmp_fn, 'wb') as outfile:
+        outfile.write(HEADER.pack(MAGIC, *signature, len(records)))
+        outfile.writelines(records)
+    os.replace(tmp_fn, index_fn)
+
+
+def read_index(vehicles_fn: str, index_fn: str) -> Iterator[tuple]:
+    """
+    The records of the index of the source, built first when missing or stale
+    """
+    for attempt in range(2):
+        try:
+            with open(index_fn, 'rb') as infile:
+                data = infile.read()
+            magic, mtime_ns, size, count = HEADER.unpack_from(data, 0)
+        except (OSError, struct.error):
+            magic = None
+
+        if magic == MAGIC and (mtime_ns, size) == source_signature(vehicles_fn):
+            return RECORD.iter_unpack(data[HEADER.size:HEADER.size + count * RECORD.size])
+
+        build_index(vehicles_fn, index_fn)
+
+    raise ValueError(f'{index_fn} cannot be built for {vehicles_fn}')
+
+
+class LazyInventory(Inventory):
+    """
+    An Inventory over a vehicles.json it does not parse: the price and the stock of every vehicle
+        come from the index (so availability and price queries work as usual) and a Vehicle is
+        built from its bytes in the memory-mapped source on first use, keeping at most capacity of
+        them alive (least recently used go first)
+
+    Vehicles added after opening the source (reloads, the journal) that differ from it are kept in
+        memory. The source should be replaced rather than rewritten in place while it is open; when
+        it changed anyway it is indexed and mapped again before the next Vehicle is built
+
+    Usage:
+        machine = Machine(stock=LazyInventory(capacity=1024))
+        lazy_start(machine, loader, 'state/vehicles.idx')
+    """
+
+    def __init__(self, thread_safe: bool = False, capacity: int = 1024):
+        super().__init__(thread_safe)
+        self.capacity = capacity
+        self.vehicles_fn = None
+        self.index_fn = None
+        self._cache_lock = RLock() if thread_safe else nullcontext()
+        self._cache = OrderedDict()
+        self._pinned: Dict[int, Vehicle] = {}
+        self._rows = {}
+        self._offsets = []
+        self._lengths = []
+        self._prices = []
+        self._stocks = []
+        self._source = None
+        self._signature = None
+
+    def __getitem__(self, vehicle_id: int) -> dict:
+        row = self._rows[vehicle_id]
+
+        return {
+            'vehicle': self.vehicle(vehicle_id),
+            'stock': self._stocks[row]
+        }
+
+    def __contains__(self, vehicle_id: int) -> bool:
+        return vehicle_id in self._rows
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._rows)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def open(self, vehicles_fn: str, index_fn: str) -> Dict[str, int]:
+        """
+        Add every vehicle of the source with its stock (the vehicles already known are kept as they
+            are), returns the hashes of the entries by id (for Loader.prime)
+        """
+        self.vehicles_fn, self.index_fn = vehicles_fn, index_fn
+        hashes = {}
+
+        for id, offset, length, price, whole, stock, raw_hash in self._map():
+            hashes[str(id)] = raw_hash
+
+            if id in self._rows:
+                continue
+
+            if self.thread_safe:
+                self._locks.setdefault(id, Lock())
+
+            with self._index_lock:
+                self._rows[id] = len(self._offsets)
+                self._offsets.append(offset)
+                self._lengths.append(length)
+                self._prices.append(int(price) if whole else price)
+                self._stocks.append(stock)
+                self._by_price.add((self._prices[-1], id))
+                if stock > 0:
+                    self._mark_available(id)
+
+            self._notify(id)
+
+        return hashes
+
+    def _map(self) -> list:
+        """
+        Map the source and point the known vehicles at their bytes, the index records
+        """
+        records = list(read_index(self.vehicles_fn, self.index_fn))
+
+        with open(self.vehicles_fn, 'rb') as infile:
+            source = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(infile.fileno()).st_size \
+                else b''
+            self._signature = source_signature(self.vehicles_fn)
+
+        if isinstance(self._source, mmap.mmap):
+            self._source.close()
+        self._source = source
+
+        # vehicles no longer in the source cannot be built anymore
+        self._offsets = [-1] * len(self._offsets)
+
+        for id, offset, length, *_ in records:
+            row = self._rows.get(id)
+            if row is not None:
+                self._offsets[row], self._lengths[row] = offset, length
+
+        return records
+
+    def vehicle(self, vehicle_id: int) -> Vehicle:
+        """
+        The vehicle with an id, built from the source when it is not in memory
+        """
+        vehicle = self._pinned.get(vehicle_id)
+
+        if vehicle is not None:
+            return vehicle
+
+        with self._cache_lock:
+            vehicle = self._cache.get(vehicle_id)
+
+            if vehicle is not None:
+                self._cache.move_to_end(vehicle_id)
+                return vehicle
+
+            vehicle = self._cache[vehicle_id] = self._read(vehicle_id)
+
+            if len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+
+        return vehicle
+
+    def _read(self, vehicle_id: int) -> Vehicle:
+        if source_signature(self.vehicles_fn) != self._signature:
+            self._map()
+
+        row = self._rows[vehicle_id]
+        offset = self._offsets[row]
+
+        if offset < 0:
+            raise KeyError(f'Vehicle {vehicle_id} is no longer in {self.vehicles_fn}')
+
+        value = json.loads(self._source[offset:offset + self._lengths[row]])
+
+        return Vehicle(vehicle_id, value['name'], value['price'], value['mileage'])
+
+    def pinned(self) -> List[int]:
+        """
+        The ids of the vehicles kept in memory because they differ from the source
+        """
+        return list(self._pinned)
+
+    @property
+    def live(self) -> int:
+        """
+        The number of vehicles built from the source that are alive
+        """
+        return len(self._cache)
+
+    def _store(self, vehicle, stock: int) -> None:
+        row = self._rows.get(vehicle.id)
+
+        if row is None:
+            row = self._rows[vehicle.id] = len(self._offsets)
+            self._offsets.append(-1)
+            self._lengths.append(0)
+            self._prices.append(vehicle.price)
+            self._stocks.append(stock)
+        else:
+            self._prices[row], self._stocks[row] = vehicle.price, stock
+
+        with self._cache_lock:
+            self._cache.pop(vehicle.id, None)
+
+        if self._offsets[row] >= 0 and self._same(self._read(vehicle.id), vehicle):
+            self._pinned.pop(vehicle.id, None)
+        else:
+            self._pinned[vehicle.id] = vehicle
+
+    @staticmethod
+    def _same(source: Vehicle, vehicle: Vehicle) -> bool:
+        return (source.name, source.price, source.mileage) == (vehicle.name, vehicle.price, vehicle.mileage)
+
+    def _stock(self, vehicle_id: int) -> int:
+        return self._stocks[self._rows[vehicle_id]]
+
+    def _write_stock(self, vehicle_id: int, stock: int) -> None:
+        self._stocks[self._rows[vehicle_id]] = stock
+
+    def _price(self, vehicle_id: int) -> float:
+        return self._prices[self._rows[vehicle_id]]
+
+
+def lazy_start(machine: Machine, loader: Loader, index_fn: str) -> None:
+    """
+    Open the vehicles of the loader source in the LazyInventory of the machine, priming the loader
+        so a reload only applies what changed afterwards
+    """
+    loader.prime(loader.vehicles_fn, machine.stock.open(loader.vehicles_fn, index_fn))
@@ -0,0 +1,182 @@
+from contextlib import nullcontext
+from threading import RLock
+from typing import Callable, Dict, List, Optional
+
+
+class Lease:
+    """
+    One unit of a vehicle model out on rent, with the mileage of that unit when it left and when it
+        came back (None while the lease is open), and the terms of its quote: the km included, the
+        price per km over them and the price paid upfront (in cents)
+    """
+    __slots__ = ('id', 'vehicle_id', 'start_mileage', 'end_mileage', 'km_allowance', 'per_km', 'price')
+
+    def __init__(self, id: int, vehicle_id: int, start_mileage: int, km_allowance: int = 0, per_km: int = 0,
+                 price: int = 0):
+        self.id = id
+        self.vehicle_id = vehicle_id
+        self.start_mileage = start_mileage
+        self.end_mileage = None
+        self.km_allowance = km_allowance
+        self.per_km = per_km
+        self.price = price
+
+    @property
+    def is_open(self) -> bool:
+        return self.end_mileage is None
+
+    @property
+    def mileage_charge(self) -> Optional[int]:
+        """
+        The charge (in cents) for the km driven over the allowance, None while the lease is open
+        """
+        if self.end_mileage is None:
+            return None
+
+        return max(0, self.end_mileage - self.start_mileage - self.km_allowance) * self.per_km
+
+    def __str__(self):
+        return f'Lease {self.id} - vehicle {self.vehicle_id} - {self.start_mileage}km'
+
+
+class LeaseTable:
+    """
+    Every lease by its unique id, with the open leases also indexed by vehicle model (oldest first)
+        and the leases split by status, so each lookup is O(1) however many leases are open
+
+    Units coming back remember their mileage, the next lease of the same model takes the unit that
+        came back last instead of starting from the catalogue mileage
+    """
+
+    def __init__(self, thread_safe: bool = False):
+        self._lock = RLock() if thread_safe else nullcontext()
+        self._next_id = 1
+        self._leases = {}
+        self._open = {}
+        self._closed = {}
+        self._open_by_vehicle = {}
+        self._returned_units = {}
+        self._listeners = []
+
+    def __len__(self) -> int:
+        return len(self._leases)
+
+    def __contains__(self, lease_id: int) -> bool:
+        return lease_id in self._leases
+
+    def get(self, lease_id: int) -> Optional[Lease]:
+        return self._leases.get(lease_id)
+
+    def subscribe(self, listener: Callable[[Optional[Lease]], None]) -> None:
+        """
+        Call listener with the lease every time one is opened or closed, with None when the table is
+            restored
+        """
+        self._listeners.append(listener)
+
+    def _notify(self, lease: Optional[Lease]) -> None:
+        for listener in self._listeners:
+            listener(lease)
+
+    def open(self, vehicle_id: int, catalogue_mileage: int, km_allowance: int = 0, per_km: int = 0,
+             price: int = 0) -> Lease:
+        """
+        Open a lease for a unit of the vehicle model with the mileage terms of its quote
+        """
+        with self._lock:
+            units = self._returned_units.get(vehicle_id)
+            mileage = units.pop() if units else catalogue_mileage
+
+            lease = Lease(self._next_id, vehicle_id, mileage, km_allowance, per_km, price)
+            self._next_id += 1
+            self._leases[lease.id] = lease
+            self._open[lease.id] = lease
+            self._open_by_vehicle.setdefault(vehicle_id, {})[lease.id] = lease
+            self._notify(lease)
+
+        return lease
+
+    def close(self, lease_id: int, mileage: int) -> Optional[Lease]:
+        """
+        Close an open lease with the mileage of the unit coming back, None when the lease is not
+            open or the mileage is not above the one the unit left with
+        """
+        with self._lock:
+            lease = self._open.get(lease_id)
+
+            if lease is None or mileage <= lease.start_mileage:
+                return None
+
+            lease.end_mileage = mileage
+            del self._open[lease_id]
+            self._closed[lease_id] = lease
+
+            open_leases = self._open_by_vehicle[lease.vehicle_id]
+            del open_leases[lease_id]
+            if not open_leases:
+                del self._open_by_vehicle[lease.vehicle_id]
+
+            self._returned_units.setdefault(lease.vehicle_id, []).append(mileage)
+            self._notify(lease)
+
+        return lease
+
+    def snapshot(self) -> dict:
+        """
+        The open leases, the mileage of the units back in stock and the next lease id
+        """
+        with self._lock:
+            return {
+                'next_id': self._next_id,
+                'open': [[lease.id, lease.vehicle_id, lease.start_mileage, lease.km_allowance, lease.per_km, lease.price]
+                         for lease in self._open.values()],
+                'returned_units': [[vehicle_id, units] for vehicle_id, units in self._returned_units.items()]
+            }
+
+    def restore(self, snapshot: dict) -> None:
+        """
+        Replace the table with the state of a snapshot, closed leases are not part of it
+        """
+        with self._lock:
+            self._leases, self._open, self._closed, self._open_by_vehicle = {}, {}, {}, {}
+            self._next_id = snapshot['next_id']
+            self._returned_units = {vehicle_id: list(units) for vehicle_id, units in snapshot['returned_units']}
+
+            for lease_id, vehicle_id, start_mileage, *terms in snapshot['open']:
+                lease = Lease(lease_id, vehicle_id, start_mileage, *terms)
+                self._leases[lease.id] = lease
+                self._open[lease.id] = lease
+                self._open_by_vehicle.setdefault(vehicle_id, {})[lease.id] = lease
+
+            self._notify(None)
+
+    def oldest_open(self, vehicle_id: int) -> Optional[Lease]:
+        """
+        The open lease of the vehicle model that started first
+        """
+        with self._lock:
+            return next(iter(self._open_by_vehicle.get(vehicle_id, {}).values()), None)
+
+    def open_for(self, vehicle_id: int) -> List[Lease]:
+        """
+        The open leases of a vehicle model, oldest first
+        """
+        with self._lock:
+            return list(self._open_by_vehicle.get(vehicle_id, {}).values())
+
+    def count_open(self, vehicle_id: Optional[int] = None) -> int:
+        """
+        The number of open leases, of a vehicle model if given
+        """
+        if vehicle_id is None:
+            return len(self._open)
+
+        return len(self._open_by_vehicle.get(vehicle_id, ()))
+
+    @property
+    def open_leases(self) -> Dict[int, Lease]:
+        return self._open
+
+    @property
+    def closed_leases(self) -> Dict[int, Lease]:
+        return self._closed
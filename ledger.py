@@ -0,0 +1,362 @@
+import time
+from array import array
+from contextlib import nullcontext
+from heapq import nlargest
+from threading import RLock
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from classes import Machine
+
+HOUR = 3600
+DAY = 24 * HOUR
+# (bucket resolution in seconds, number of buckets) from the most recent to the oldest: a week of
+# hours then about a year of days, older sales only count in the all time totals
+TIERS = ((HOUR, 7 * 24), (DAY, 366))
+# the columns of a bucket: sales, paid, change (in cents)
+WIDTH = 3
+
+
+class Fenwick:
+    """
+    A Fenwick (binary indexed) tree of capacity rows of width int columns: a row is added to and
+        the sum of a range of rows is taken in O(log n), the rows themselves are kept alongside
+    """
+    __slots__ = ('capacity', 'width', '_tree', '_rows')
+
+    def __init__(self, capacity: int, width: int = 1):
+        self.capacity = capacity
+        self.width = width
+        self._tree = array('q', bytes(8 * width * (capacity + 1)))
+        self._rows = array('q', bytes(8 * width * capacity))
+
+    def add(self, index: int, values: Sequence[int]) -> None:
+        tree, width = self._tree, self.width
+
+        for column, value in enumerate(values):
+            self._rows[index * width + column] += value
+
+        index += 1
+
+        while index <= self.capacity:
+            for column, value in enumerate(values):
+                tree[index * width + column] += value
+            index += index & -index
+
+    def row(self, index: int) -> List[int]:
+        return list(self._rows[index * self.width:(index + 1) * self.width])
+
+    def prefix(self, end: int) -> List[int]:
+        """
+        The sums of the rows before end
+        """
+        tree, width, total = self._tree, self.width, [0] * self.width
+        index = min(max(end, 0), self.capacity)
+
+        while index > 0:
+            for column in range(width):
+                total[column] += tree[index * width + column]
+            index -= index & -index
+
+        return total
+
+    def sum(self, start: int, end: int) -> List[int]:
+        """
+        The sums of the rows from start to end (exclusive)
+        """
+        if end <= start:
+            return [0] * self.width
+
+        return [high - low for high, low in zip(self.prefix(end), self.prefix(start))]
+
+
+class _Tier:
+    """
+    The capacity buckets of one resolution from bucket number base on
+
+    The buckets that had sales are kept in a dict until more than a SPARSE share of them did, then
+        in a ring of rows of a Fenwick tree (bucket number n is row n % capacity), so a model that
+        rarely sells costs a few rows and window sums are O(log n) once it sells often
+    """
+    __slots__ = ('resolution', 'capacity', 'base', 'sums', 'sparse')
+    SPARSE = 1 / 8
+
+    def __init__(self, resolution: int, capacity: int):
+        self.resolution = resolution
+        self.capacity = capacity
+        self.base = None
+        self.sums = None
+        self.sparse: Dict[int, List[int]] = {}
+
+    def add(self, at: int, values: Sequence[int]) -> List[Tuple[int, List[int]]]:
+        """
+        Add to the bucket of a time, returns the buckets evicted to make room for it (their start
+            time and sums); a time before the buckets is returned as is
+        """
+        bucket = at // self.resolution
+
+        if self.base is None:
+            self.base = bucket
+        elif bucket < self.base:
+            return [(at, list(values))]
+
+        evicted = []
+
+        if bucket >= self.base + self.capacity:
+            base = bucket - self.capacity + 1
+
+            if self.sums is None:
+                for number in sorted(number for number in self.sparse if number < base):
+                    evicted.append((number * self.resolution, self.sparse.pop(number)))
+            else:
+                for number in range(self.base, min(base, self.base + self.capacity)):
+                    row = self.sums.row(number % self.capacity)
+
+                    if any(row):
+                        evicted.append((number * self.resolution, row))
+                        self.sums.add(number % self.capacity, [-value for value in row])
+
+            self.base = base
+
+        if self.sums is not None:
+            self.sums.add(bucket % self.capacity, values)
+            return evicted
+
+        row = self.sparse.get(bucket)
+        self.sparse[bucket] = list(values) if row is None else [total + value for total, value in zip(row, values)]
+
+        if len(self.sparse) > self.capacity * self.SPARSE:
+            self.sums = Fenwick(self.capacity, WIDTH)
+
+            for number, row in self.sparse.items():
+                self.sums.add(number % self.capacity, row)
+
+            self.sparse = {}
+
+        return evicted
+
+    def sum(self, start: Optional[int], end: Optional[int]) -> List[int]:
+        """
+        The sums of the buckets starting from start to end (exclusive)
+        """
+        if self.base is None:
+            return [0] * WIDTH
+
+        first = self.base if start is None else max(-(-start // self.resolution), self.base)
+        last = self.base + self.capacity if end is None else min(-(-end // self.resolution), self.base + self.capacity)
+
+        if last <= first:
+            return [0] * WIDTH
+
+        if self.sums is None:
+            total = [0] * WIDTH
+
+            for number, row in self.sparse.items():
+                if first <= number < last:
+                    total = [value + other for value, other in zip(total, row)]
+
+            return total
+
+        position, length = first % self.capacity, last - first
+
+        if position + length <= self.capacity:
+            return self.sums.sum(position, position + length)
+
+        return [head + tail for head, tail in zip(self.sums.sum(position, self.capacity),
+                                                  self.sums.sum(0, position + length - self.capacity))]
+
+    def rows(self) -> List[Tuple[int, List[int]]]:
+        if self.base is None:
+            return []
+
+        if self.sums is None:
+            return [(number * self.resolution, row) for number, row in sorted(self.sparse.items())]
+
+        rows = ((number * self.resolution, self.sums.row(number % self.capacity))
+                for number in range(self.base, self.base + self.capacity))
+
+        return [(at, row) for at, row in rows if any(row)]
+
+
+class _Series:
+    """
+    The buckets of all the tiers of one series of sales, a sale is in exactly one bucket: buckets
+        leaving a tier are added to the next one and the ones leaving the last tier to before
+    """
+    __slots__ = ('tiers', 'before')
+
+    def __init__(self, tiers: Sequence[Tuple[int, int]]):
+        self.tiers = [_Tier(resolution, capacity) for resolution, capacity in tiers]
+        self.before = [0] * WIDTH
+
+    def add(self, at: int, values: Sequence[int], tier: int = 0) -> None:
+        if tier == len(self.tiers):
+            self.before = [total + value for total, value in zip(self.before, values)]
+            return
+
+        for evicted_at, row in self.tiers[tier].add(at, values):
+            self.add(evicted_at, row, tier + 1)
+
+    def sum(self, start: Optional[int], end: Optional[int]) -> List[int]:
+        total = list(self.before) if start is None else [0] * WIDTH
+
+        for tier in self.tiers:
+            total = [value + other for value, other in zip(total, tier.sum(start, end))]
+
+        return total
+
+    def snapshot(self) -> list:
+        """
+        The buckets from the oldest one as [start, sales, paid, change], before with no start
+        """
+        rows = [[None, *self.before]] if any(self.before) else []
+
+        for tier in reversed(self.tiers):
+            rows.extend([at, *row] for at, row in tier.rows())
+
+        return rows
+
+    def restore(self, rows: list) -> None:
+        for at, *values in rows:
+            if at is None:
+                self.add(0, values, len(self.tiers))
+            else:
+                self.add(at, values)
+
+
+class Totals(NamedTuple):
+    sales: int
+    paid: int
+    change: int
+
+    @property
+    def revenue(self) -> int:
+        """
+        What the sales left in the machine (in cents)
+        """
+        return self.paid - self.change
+
+
+class Ledger:
+    """
+    The revenue of the finished sales of a machine (time, vehicle, amount paid and change given)
+        rolled up in time buckets, for the machine and per vehicle model
+
+    Every series keeps its buckets in tiers of Fenwick trees, so the totals of any window are
+        O(log n) and a breakdown per model is O(log n) per model. Buckets that get too old for a
+        tier are downsampled into the next, coarser, one and the ones too old for the last tier
+        only count in the all time totals, so memory stays bounded by the tiers for every model;
+        a model only takes the buckets it sold in until it sells often (see _Tier).
+        A window is counted by whole buckets: the ones starting within it
+
+    Sales are journaled with their time when the machine has a ledger, so it is recovered with the
+        machine
+
+    Usage:
+        ledger = Ledger(machine)  # machine.ledger, before the journal is recovered
+        ledger.totals(time.time() - 86400)  # the last 24 hours
+    """
+
+    def __init__(self, machine: Machine, clock: Callable[[], float] = time.time,
+                 tiers: Sequence[Tuple[int, int]] = TIERS, thread_safe: bool = False):
+        self.machine = machine
+        self.clock = clock
+        self.tiers = tuple(tiers)
+        self._lock = RLock() if thread_safe else nullcontext()
+        self._all = _Series(self.tiers)
+        self._models: Dict[int, _Series] = {}
+        machine.ledger = self
+
+    def record(self, vehicle_id: int, paid: int, change: int) -> int:
+        """
+        Record a sale finished now, returns its time
+        """
+        at = int(self.clock())
+        self._add(at, vehicle_id, (1, paid, change))
+
+        return at
+
+    def _add(self, at: int, vehicle_id: int, values: Sequence[int]) -> None:
+        with self._lock:
+            series = self._models.get(vehicle_id)
+
+            if series is None:
+                series = self._models[vehicle_id] = _Series(self.tiers)
+
+            self._all.add(at, values)
+            series.add(at, values)
+
+    def replay(self, event: dict) -> None:
+        """
+        Apply a journaled sale
+        """
+        change = sum(int(coin) * number for coin, number in event['change'].items())
+        self._add(event['t'], event['id'], (1, event['paid'], change))
+
+    def totals(self, start: Optional[float] = None, end: Optional[float] = None,
+               vehicle_id: Optional[int] = None) -> Totals:
+        """
+        The totals of the sales from start to end (seconds since the epoch, unbounded when None),
+            of a vehicle model if given
+        """
+        start, end = None if start is None else int(start), None if end is None else int(end)
+
+        with self._lock:
+            series = self._all if vehicle_id is None else self._models.get(vehicle_id)
+            return Totals(*series.sum(start, end)) if series is not None else Totals(0, 0, 0)
+
+    def by_model(self, start: Optional[float] = None, end: Optional[float] = None) -> Dict[int, Totals]:
+        """
+        The totals of every vehicle model sold from start to end
+        """
+        with self._lock:
+            totals = {vehicle_id: self.totals(start, end, vehicle_id) for vehicle_id in self._models}
+
+        return {vehicle_id: total for vehicle_id, total in totals.items() if total.sales}
+
+    def top(self, n: int, start: Optional[float] = None, end: Optional[float] = None) -> List[Tuple[int, Totals]]:
+        """
+        The n vehicle models with the highest revenue from start to end
+        """
+        return nlargest(n, self.by_model(start, end).items(), key=lambda item: item[1].revenue)
+
+    def timeline(self, start: float, end: float, step: float = HOUR,
+                 vehicle_id: Optional[int] = None) -> List[Tuple[int, Totals]]:
+        """
+        The totals of every step from start to end, as (step start, totals)
+        """
+        return [(int(at), self.totals(at, min(at + step, end), vehicle_id))
+                for at in range(int(start), int(end), int(step))]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {'all': self._all.snapshot(),
+                    'models': {vehicle_id: series.snapshot() for vehicle_id, series in self._models.items()}}
+
+    def restore(self, snapshot: dict) -> None:
+        """
+        Replace the sales with the ones of a snapshot, whatever the tiers it was taken with
+        """
+        with self._lock:
+            self._all, self._models = _Series(self.tiers), {}
+            self._all.restore(snapshot['all'])
+
+            for vehicle_id, rows in snapshot['models'].items():
+                series = self._models[int(vehicle_id)] = _Series(self.tiers)
+                series.restore(rows)
+
+
+def describe(ledger: Ledger, hours: float = 24, n: int = 5) -> str:
+    """
+    A string representation of the revenue of the last hours and of the n models with the most
+    """
+    start = ledger.clock() - hours * HOUR
+    totals = ledger.totals(start)
+    lines = [f'Last {hours:g}h: {totals.sales} sales, €{totals.paid / 100} paid, €{totals.change / 100} change, '
+             f'€{totals.revenue / 100} revenue']
+
+    for vehicle_id, model in ledger.top(n, start):
+        entry = ledger.machine.stock[vehicle_id] if vehicle_id in ledger.machine.stock else None
+        name = entry['vehicle'].name if entry is not None else 'Unknown'
+        lines.append(f'{vehicle_id} - {name} - €{model.revenue / 100} ({model.sales} sales)')
+
+    return '\n'.join(lines)
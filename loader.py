@@ -0,0 +1,272 @@
+import json
+import os
+from hashlib import blake2b
+from threading import Thread
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from classes import Machine, Vehicle, to_cents
+
+_decoder = json.JSONDecoder()
+_DELIMITERS = frozenset(' \t\n\r,:]}')
+
+
+def entry_hash(raw: str) -> int:
+    """
+    A stable 64 bit hash of the raw text of an entry, the same across runs so it can be stored
+    """
+    return int.from_bytes(blake2b(raw.encode(), digest_size=8).digest(), 'little')
+
+
+def coin_key(value: float) -> str:
+    """
+    The key of a coin of change.json: its value in cents, so adding a coin does not change the key
+        of the ones after it
+    """
+    return str(to_cents(value))
+
+
+def signature(fn: str) -> Tuple[int, int]:
+    stat = os.stat(fn)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def changed_entries(fn: str, hashes: Dict[str, int], full: bool = False) -> Iterator[Tuple[str, int, object]]:
+    """
+    Stream the entries of a file whose hash is not the one in hashes (every entry when full) as
+        (key, hash, value), the entries of an array are coins keyed by coin_key
+    """
+    for key, raw, value in iter_json_entries(fn):
+        key = coin_key(value['value']) if key is None else key
+        raw_hash = entry_hash(raw)
+
+        if full or hashes.get(key) != raw_hash:
+            yield key, raw_hash, value
+
+
+def iter_json_entries(fn: str, chunk_size: int = 1 << 16, encoding: Optional[str] = None,
+                      offsets: bool = False) -> Iterator[tuple]:
+    """
+    Stream the entries of a top-level JSON object or array one at a time as (key, raw text, value),
+        the key being None for array items, without loading the whole document
+
+    With offsets, the offset of the raw text in the file is yielded as a fourth item; it is in
+        characters, which are bytes when the file is read with encoding='latin-1'
+    """
+    with open(fn, 'r', encoding=encoding) as infile:
+        buffer, position, eof, consumed = '', 0, False, 0
+
+        def fill() -> bool:
+            nonlocal buffer, position, eof, consumed
+            chunk = infile.read(chunk_size)
+            consumed += position
+            buffer, position = buffer[position:] + chunk, 0
+            eof = not chunk
+            return not eof
+
+        def skip_whitespace() -> str:
+            nonlocal position
+            while True:
+                while position < len(buffer) and buffer[position].isspace():
+                    position += 1
+                if position < len(buffer) or not fill():
+                    return buffer[position:position + 1]
+
+        def decode() -> Tuple[str, object]:
+            nonlocal position, start
+            while True:
+                try:
+                    value, end = _decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if not fill():
+                        raise
+                    continue
+
+                # a value not followed by a delimiter could be a number cut by the end of the buffer
+                if (end == len(buffer) or buffer[end] not in _DELIMITERS) and not eof and fill():
+                    continue
+
+                raw, start, position = buffer[position:end], consumed + position, end
+                return raw, value
+
+        def expect(token: str) -> None:
+            nonlocal position
+            if skip_whitespace() != token:
+                raise ValueError(f'Expected {token!r} at offset {position} of {fn}')
+            position += 1
+
+        start = 0
+        opening = skip_whitespace()
+        if not opening or opening not in '{[':
+            raise ValueError(f'{fn} is not a JSON object or array')
+        closing = '}' if opening == '{' else ']'
+        position += 1
+
+        while True:
+            token = skip_whitespace()
+            if token == closing:
+                return
+            if token == ',':
+                position += 1
+                skip_whitespace()
+
+            key = None
+            if opening == '{':
+                _, key = decode()
+                expect(':')
+                skip_whitespace()
+
+            raw, value = decode()
+            yield (key, raw, value, start) if offsets else (key, raw, value)
+
+
+class Scan:
+    """
+    The entries of a file that changed since the loader last loaded it, streamed and hashed in a
+        background thread; the loader state is only updated when the scan is applied, the file must
+        not be reloaded meanwhile
+    """
+    __slots__ = ('fn', 'signature', 'hashes', 'entries', 'error', '_thread')
+
+    def __init__(self, loader: 'Loader', fn: str, full: bool = False):
+        self.fn = fn
+        self.signature = None
+        self.hashes: Dict[str, int] = {}
+        self.entries: List[Tuple[str, object]] = []
+        self.error = None
+        self._thread = Thread(target=self._run, args=(loader, full), daemon=True)
+        self._thread.start()
+
+    def _run(self, loader: 'Loader', full: bool) -> None:
+        try:
+            self.signature = signature(self.fn)
+
+            if not full and loader._signatures.get(self.fn) == self.signature:
+                return
+
+            for key, raw_hash, value in changed_entries(self.fn, loader._hashes[self.fn], full):
+                self.hashes[key] = raw_hash
+                self.entries.append((key, value))
+        except (OSError, ValueError) as error:
+            self.error = error
+
+    @property
+    def done(self) -> bool:
+        return not self._thread.is_alive()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        self._thread.join(timeout)
+        return self.done
+
+
+class Loader:
+    """
+    Loads the vehicle stock and the change into a machine, applying on every reload only the
+        entries that changed since the previous load
+
+    A file whose modification time and size did not change is not read at all, otherwise it is
+        streamed entry by entry and each entry is compared by the hash of its raw text (vehicles by
+        id, coins by value)
+
+    A reload can also be scanned in a background thread (see scan) while the machine keeps serving,
+        then applied by the thread that owns the machine: the hashes of the file are swapped in and
+        only the changed entries are applied, so the machine is only busy for the changes
+
+    Usage:
+        loader.scan(loader.vehicles_fn)
+        ...
+        loader.apply_scans(machine)  # between commands, [(fn, applied)] of the finished scans
+    """
+
+    def __init__(self, vehicles_fn: str, change_fn: str):
+        self.vehicles_fn = vehicles_fn
+        self.change_fn = change_fn
+        self._signatures = {}
+        self._hashes = {vehicles_fn: {}, change_fn: {}}
+        self._scans: Dict[str, Scan] = {}
+
+    def reload_vehicles(self, machine: Machine, full: bool = False) -> int:
+        """
+        Add the new or changed vehicles to the machine stock, returns how many were applied
+        """
+        return self._apply(machine, self.vehicles_fn, self._changed_entries(self.vehicles_fn, full))
+
+    def reload_change(self, machine: Machine, full: bool = False) -> int:
+        """
+        Set the new or changed coin counts in the machine cashier, returns how many were applied
+        """
+        return self._apply(machine, self.change_fn, self._changed_entries(self.change_fn, full))
+
+    def scan(self, fn: str, full: bool = False) -> bool:
+        """
+        Start reading the changes of a file in a background thread, False when it already is
+        """
+        if fn in self._scans:
+            return False
+
+        self._scans[fn] = Scan(self, fn, full)
+
+        return True
+
+    def apply_scans(self, machine: Machine, wait: bool = False) -> List[Tuple[str, int]]:
+        """
+        Apply the changes of the finished scans (of all of them when wait), returns the files
+            applied and how many entries each; a scan that failed raises its error
+        """
+        applied = []
+
+        for fn, scan in list(self._scans.items()):
+            if not (scan.wait() if wait else scan.done):
+                continue
+
+            del self._scans[fn]
+
+            if scan.error is not None:
+                raise scan.error
+
+            self._hashes[fn].update(scan.hashes)
+            self._signatures[fn] = scan.signature
+            applied.append((fn, self._apply(machine, fn, scan.entries)))
+
+        return applied
+
+    def _apply(self, machine: Machine, fn: str, entries: Iterable[Tuple[str, dict]]) -> int:
+        applied = 0
+
+        for key, value in entries:
+            if fn == self.change_fn:
+                machine.add_change(value['value'], value['number'])
+            else:
+                machine.add_vehicle(Vehicle(int(key), value['name'], value['price'], value['mileage']), value['stock'])
+            applied += 1
+
+        return applied
+
+    def prime(self, fn: str, hashes: Dict[str, int]) -> None:
+        """
+        Record a file as loaded by other means (see catalogue.py) with the hashes of its entries
+        """
+        stat = os.stat(fn)
+        self._signatures[fn] = (stat.st_mtime_ns, stat.st_size)
+        self._hashes[fn] = hashes
+
+    def mark_loaded(self, fn: str) -> None:
+        """
+        Record a file as applied as it is now without applying it (the machine was recovered from
+            the journal), so a reload only applies what changes in it from now on
+        """
+        for _ in self._changed_entries(fn, True):
+            pass
+
+    def _changed_entries(self, fn: str, full: bool) -> Iterator[Tuple[str, dict]]:
+        file_signature = signature(fn)
+
+        if not full and self._signatures.get(fn) == file_signature:
+            return
+
+        hashes = self._hashes[fn]
+
+        for key, raw_hash, value in changed_entries(fn, hashes, full):
+            hashes[key] = raw_hash
+            yield key, value
+
+        self._signatures[fn] = file_signature
@@ -0,0 +1,176 @@
+import json
+import time
+from bisect import bisect_left
+from functools import wraps
+from threading import Lock
+from typing import Callable, Dict, Optional, Tuple
+
+# Upper bounds (in seconds) of the latency histogram buckets, the last one catches everything
+BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, float('inf'))
+
+PREFIX = 'rentomatic'
+
+
+class Metrics:
+    """
+    Counters and latency histograms of the machine operations
+
+    Nothing is measured until the metrics are attached to a machine with instrument(), which wraps
+        the methods of that machine (and its cashier) only, so an uninstrumented machine runs the
+        plain methods at no cost
+
+    Usage:
+        metrics = instrument(machine, loader)
+        print(metrics.render('json'))
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._counters: Dict[Tuple[str, str], int] = {}
+        self._histograms: Dict[str, list] = {}
+        self._sums: Dict[str, float] = {}
+        self._max: Dict[str, float] = {}
+
+    def inc(self, operation: str, outcome: str = 'ok', number: int = 1) -> None:
+        """
+        Count an operation by its outcome
+        """
+        with self._lock:
+            key = (operation, outcome)
+            self._counters[key] = self._counters.get(key, 0) + number
+
+    def observe(self, operation: str, seconds: float) -> None:
+        """
+        Record how long an operation took
+        """
+        with self._lock:
+            histogram = self._histograms.get(operation)
+            if histogram is None:
+                histogram = self._histograms[operation] = [0] * len(BUCKETS)
+                self._sums[operation] = 0.0
+                self._max[operation] = 0.0
+
+            histogram[bisect_left(BUCKETS, seconds)] += 1
+            self._sums[operation] += seconds
+            self._max[operation] = max(self._max[operation], seconds)
+
+    def wrap(self, operation: str, method: Callable, outcome: Optional[Callable] = None) -> Callable:
+        """
+        The method timed and counted as operation, outcome maps (result, args, kwargs) to the label
+            the call is counted under
+        """
+        clock = time.perf_counter
+
+        @wraps(method)
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                result = method(*args, **kwargs)
+            except Exception:
+                self.observe(operation, clock() - start)
+                self.inc(operation, 'error')
+                raise
+            self.observe(operation, clock() - start)
+            self.inc(operation, 'ok' if outcome is None else outcome(result, args, kwargs))
+            return result
+
+        return timed
+
+    def snapshot(self) -> dict:
+        """
+        The counters and the latency of every operation: calls, total, max and the histogram
+            buckets (cumulative, keyed by their upper bound)
+        """
+        with self._lock:
+            counters = {}
+            for (operation, outcome), number in sorted(self._counters.items()):
+                counters.setdefault(operation, {})[outcome] = number
+
+            latency = {}
+            for operation, histogram in sorted(self._histograms.items()):
+                cumulative, buckets = 0, {}
+                for bound, number in zip(BUCKETS, histogram):
+                    cumulative += number
+                    buckets['+Inf' if bound == float('inf') else repr(bound)] = cumulative
+                latency[operation] = {
+                    'count': cumulative,
+                    'sum': self._sums[operation],
+                    'max': self._max[operation],
+                    'buckets': buckets
+                }
+
+        return {'counters': counters, 'latency': latency}
+
+    def to_prometheus(self) -> str:
+        """
+        The metrics in the Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        lines = [f'# TYPE {PREFIX}_calls_total counter']
+
+        for operation, outcomes in snapshot['counters'].items():
+            for outcome, number in outcomes.items():
+                lines.append(f'{PREFIX}_calls_total{{op="{operation}",outcome="{outcome}"}} {number}')
+
+        lines.append(f'# TYPE {PREFIX}_latency_seconds histogram')
+
+        for operation, latency in snapshot['latency'].items():
+            for bound, number in latency['buckets'].items():
+                lines.append(f'{PREFIX}_latency_seconds_bucket{{op="{operation}",le="{bound}"}} {number}')
+            lines.append(f'{PREFIX}_latency_seconds_sum{{op="{operation}"}} {latency["sum"]}')
+            lines.append(f'{PREFIX}_latency_seconds_count{{op="{operation}"}} {latency["count"]}')
+
+        return '\n'.join(lines)
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), indent=2)
+
+    def render(self, format: str = 'prometheus') -> str:
+        """
+        The metrics as Prometheus text or, with format 'json', as a JSON snapshot
+        """
+        return self.to_json() if format.lower() == 'json' else self.to_prometheus()
+
+
+def _sale_outcome(change, args, kwargs) -> str:
+    if change is not None:
+        return 'change'
+    return 'forced' if kwargs.get('force') or (args and args[0]) else 'no_change'
+
+
+def _found(result, args, kwargs) -> str:
+    return 'ok' if result is not None and result is not False else 'failed'
+
+
+# The instrumented methods: (attribute path of the object, method, outcome)
+INSTRUMENTED = (
+    ('machine', 'start_sale', _found),
+    ('machine', 'finish_sale', _sale_outcome),
+    ('machine', 'cancel_sale', None),
+    ('machine', 'return_vehicle', _found),
+    ('machine', 'return_lease', _found),
+    ('machine', 'get_list', None),
+    ('cashier', 'calculate_change', _found),
+    ('cashier', 'settle', _found),
+    ('loader', 'reload_vehicles', None),
+    ('loader', 'reload_change', None),
+    ('loader', 'apply_scans', None)
+)
+
+
+def instrument(machine, loader=None, metrics: Optional[Metrics] = None) -> Metrics:
+    """
+    Time and count the hot paths of a machine, its cashier and the loader, the metrics are kept in
+        machine.metrics
+    """
+    metrics = metrics or Metrics()
+    targets = {'machine': machine, 'cashier': machine.cashier, 'loader': loader}
+
+    for target, name, outcome in INSTRUMENTED:
+        obj = targets[target]
+        if obj is not None:
+            setattr(obj, name, metrics.wrap(f'{target}_{name}', getattr(obj, name), outcome))
+
+    machine.metrics = metrics
+
+    return metrics
@@ -0,0 +1,57 @@
+from typing import Dict, NamedTuple, Optional, Tuple
+
+
+class Tariff(NamedTuple):
+    """
+    How a rental is charged: the vehicle price is the day rate, charged for days upfront plus a
+        surcharge (a fraction, 0.1 is 10%), and every km over km_allowance per day is charged
+        per_km (in cents) when the vehicle comes back
+
+    The version tells tariffs apart in the quotes cache, a new tariff needs a new version
+    """
+    version: int = 1
+    days: int = 1
+    surcharge: float = 0.0
+    km_allowance: int = 100
+    per_km: int = 0
+
+
+class Quote(NamedTuple):
+    """
+    The terms of a rental: the price paid upfront (in cents) and the mileage terms settled on return
+    """
+    price: int
+    km_allowance: int
+    per_km: int
+
+
+class PricingEngine:
+    """
+    Quotes rentals with the current tariff, memoized per vehicle model (and its price) and tariff
+        version, so checking the money inserted against a quote is O(1)
+    """
+
+    def __init__(self, tariff: Optional[Tariff] = None):
+        self.tariff = tariff or Tariff()
+        self._quotes: Dict[Tuple[int, float, int], Quote] = {}
+
+    def set_tariff(self, tariff: Tariff) -> None:
+        """
+        Quote every rental from now on with a new tariff, leases already open keep their terms
+        """
+        self.tariff = tariff
+        self._quotes = {}
+
+    def quote(self, vehicle) -> Quote:
+        """
+        The terms of renting a unit of the vehicle model with the current tariff
+        """
+        key = (vehicle.id, vehicle.price, self.tariff.version)
+        quote = self._quotes.get(key)
+
+        if quote is None:
+            tariff = self.tariff
+            quote = self._quotes[key] = Quote(int(round(vehicle.price * 100 * tariff.days * (1 + tariff.surcharge))),
+                                              tariff.km_allowance * tariff.days, tariff.per_km)
+
+        return quote
@@ -0,0 +1,97 @@
+from typing import Iterable, Iterator, List
+
+from inventory import Inventory
+
+
+class Listing:
+    """
+    Memoized rendering of the stock: the info and the listing line of every vehicle, and the
+        catalogue listing split in chunks of CHUNK_SIZE lines
+
+    It listens to the inventory, so adding a vehicle or changing its stock only drops the strings
+        of that vehicle and of the chunk it belongs to, everything else is reused as is
+    """
+    CHUNK_SIZE = 256
+
+    def __init__(self, stock: Inventory):
+        self._stock = stock
+        self._info = {}
+        self._lines = {}
+        self._ids: List[int] = []
+        self._positions = {}
+        self._chunks = {}
+        self._full = None
+
+        for vehicle_id in stock:
+            self._track(vehicle_id)
+
+        stock.subscribe(self.invalidate)
+
+    def invalidate(self, vehicle_id: int) -> None:
+        """
+        Drop the strings rendered for a vehicle
+        """
+        position = self._positions.get(vehicle_id)
+        if position is None:
+            position = self._track(vehicle_id)
+
+        self._info.pop(vehicle_id, None)
+        self._lines.pop(vehicle_id, None)
+        self._chunks.pop(position // self.CHUNK_SIZE, None)
+        self._full = None
+
+    def info(self, vehicle_id: int) -> str:
+        """
+        A string representation of the vehicle
+        """
+        info = self._info.get(vehicle_id)
+
+        if info is None:
+            info = self._info[vehicle_id] = f'{self._stock[vehicle_id]["vehicle"]}'
+
+        return info
+
+    def line(self, vehicle_id: int) -> str:
+        """
+        A string representation of the vehicle and its stock
+        """
+        line = self._lines.get(vehicle_id)
+
+        if line is None:
+            line = self._lines[vehicle_id] = f'{self.info(vehicle_id)} - (Stock: {self._stock[vehicle_id]["stock"]})'
+
+        return line
+
+    def render(self, vehicle_ids: Iterable[int]) -> str:
+        """
+        The lines of the given vehicles
+        """
+        return '\n'.join([self.line(vehicle_id) for vehicle_id in vehicle_ids])
+
+    def iter_chunks(self) -> Iterator[str]:
+        """
+        The whole catalogue listing in chunks of up to CHUNK_SIZE lines
+        """
+        for index in range(0, (len(self._ids) + self.CHUNK_SIZE - 1) // self.CHUNK_SIZE):
+            chunk = self._chunks.get(index)
+
+            if chunk is None:
+                start = index * self.CHUNK_SIZE
+                chunk = self._chunks[index] = self.render(self._ids[start:start + self.CHUNK_SIZE])
+
+            yield chunk
+
+    def full(self) -> str:
+        """
+        The whole catalogue listing
+        """
+        if self._full is None:
+            self._full = '\n'.join(self.iter_chunks())
+
+        return self._full
+
+    def _track(self, vehicle_id: int) -> int:
+        position = self._positions[vehicle_id] = len(self._ids)
+        self._ids.append(vehicle_id)
+
+        return position
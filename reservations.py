@@ -0,0 +1,339 @@
+import heapq
+import random
+import time
+from contextlib import nullcontext
+from threading import RLock
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from classes import Machine
+
+DAY = 86400
+BOOKING, RENTAL = 0, 1
+
+
+class _Node:
+    """
+    A treap node: one +1 (start) or -1 (end) event, with the sum of the events of its subtree and
+        the highest running sum over them (in key order)
+    """
+    __slots__ = ('key', 'priority', 'left', 'right', 'delta', 'total', 'peak')
+
+    def __init__(self, key: tuple, delta: int):
+        self.key = key
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        self.delta = delta
+        self.total = delta
+        self.peak = delta
+
+    def update(self) -> None:
+        left, right = self.left, self.right
+        total = peak = self.delta
+
+        if left is not None:
+            peak = max(left.peak, left.total + peak)
+            total += left.total
+
+        if right is not None:
+            peak = max(peak, total + right.peak)
+            total += right.total
+
+        self.total, self.peak = total, peak
+
+
+def _split(node: Optional[_Node], key: tuple) -> Tuple[Optional[_Node], Optional[_Node]]:
+    """
+    The subtrees of the keys below key and of the keys from key onwards
+    """
+    if node is None:
+        return None, None
+
+    if node.key < key:
+        node.right, right = _split(node.right, key)
+        node.update()
+        return node, right
+
+    left, node.left = _split(node.left, key)
+    node.update()
+    return left, node
+
+
+def _merge(left: Optional[_Node], right: Optional[_Node]) -> Optional[_Node]:
+    """
+    One tree of two whose keys are all below the ones of right
+    """
+    if left is None:
+        return right
+
+    if right is None:
+        return left
+
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        left.update()
+        return left
+
+    right.left = _merge(left, right.left)
+    right.update()
+    return right
+
+
+class Timeline:
+    """
+    The intervals [start, end) holding units of one vehicle model, as +1/-1 events in a treap keyed
+        by time; every subtree knows its highest running sum, so the most units held at once in any
+        window is found in O(log n) along with adding and removing intervals
+
+    An interval ending at a time sorts before one starting at that same time, they do not overlap
+    """
+
+    def __init__(self):
+        self._root = None
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, start: int, end: int, tag: tuple) -> None:
+        """
+        Hold a unit from start to end, tag tells apart intervals with the same times
+        """
+        for key, delta in (((start, 1) + tag, 1), ((end, -1) + tag, -1)):
+            left, right = _split(self._root, key)
+            self._root = _merge(_merge(left, _Node(key, delta)), right)
+
+        self._size += 1
+
+    def remove(self, start: int, end: int, tag: tuple) -> None:
+        for key in ((start, 1) + tag, (end, -1) + tag):
+            left, right = _split(self._root, key)
+            _, right = _split(right, key + (0, ))
+            self._root = _merge(left, right)
+
+        self._size -= 1
+
+    def peak(self, start: int, end: int) -> int:
+        """
+        The most units held at the same time between start and end
+        """
+        before, rest = _split(self._root, (start, 2))
+        within, after = _split(rest, (end, -2))
+
+        held = before.total if before is not None else 0
+        peak = held + max(0, within.peak) if within is not None else held
+
+        self._root = _merge(_merge(before, within), after)
+
+        return peak
+
+
+class Reservation(NamedTuple):
+    id: int
+    vehicle_id: int
+    start: int
+    end: int
+
+
+class ReservationBook:
+    """
+    Bookings of vehicle models for future windows [start, end) (seconds since the epoch), checked
+        against the units of the model: the ones in stock and the ones out on rent
+
+    The bookings and the rentals of every model are kept in a Timeline, so the units free in a
+        window and a booking are O(log n) however many bookings there are. A rental holds its unit
+        from the time it starts until the end of its booking or, for walk-in rentals, for the days
+        of the tariff; it is released when the vehicle is returned. start_sale refuses walk-in
+        rentals that would leave a booking without a unit
+
+    Bookings are journaled with the machine, rentals are timed from when the machine starts again
+        when it is recovered
+
+    Usage:
+        book = ReservationBook(machine)  # machine.reservations, before the journal is recovered
+        reservation = book.book(1, start, end)
+        machine.start_sale(1, reservation.id)  # from start to end
+    """
+
+    def __init__(self, machine: Machine, clock: Callable[[], float] = time.time, thread_safe: bool = False):
+        self.machine = machine
+        self.clock = clock
+        self._lock = RLock() if thread_safe else nullcontext()
+        self._next_id = 1
+        self._reservations: Dict[int, Reservation] = {}
+        self._endings: List[Tuple[int, int]] = []
+        self._rentals: Dict[int, Tuple[int, int, int]] = {}
+        self._timelines: Dict[int, Timeline] = {}
+        machine.reservations = self
+
+    def __len__(self) -> int:
+        return len(self._reservations)
+
+    def get(self, reservation_id: int) -> Optional[Reservation]:
+        return self._reservations.get(reservation_id)
+
+    def _timeline(self, vehicle_id: int) -> Timeline:
+        timeline = self._timelines.get(vehicle_id)
+
+        if timeline is None:
+            timeline = self._timelines[vehicle_id] = Timeline()
+
+        return timeline
+
+    def units(self, vehicle_id: int) -> int:
+        """
+        The units of a vehicle model, in stock or out on rent
+        """
+        return self.machine.stock[vehicle_id]['stock'] + self.machine.leases.count_open(vehicle_id)
+
+    def free(self, vehicle_id: int, start: int, end: int) -> Optional[int]:
+        """
+        How many units of a vehicle model are free during the whole window, None when the vehicle
+            does not exist
+        """
+        if vehicle_id not in self.machine.stock:
+            return None
+
+        with self._lock:
+            timeline = self._timelines.get(vehicle_id)
+            held = timeline.peak(start, end) if timeline is not None else 0
+
+        return self.units(vehicle_id) - held
+
+    def book(self, vehicle_id: int, start: int, end: int) -> Optional[Reservation]:
+        """
+        Book a unit of a vehicle model for a window that has not ended yet, None when the vehicle
+            does not exist or no unit is free during the whole window
+        """
+        start, end = int(start), int(end)
+
+        if vehicle_id not in self.machine.stock or end <= max(start, self.clock()):
+            return None
+
+        with self._lock:
+            self.expire()
+
+            if self.free(vehicle_id, start, end) < 1:
+                return None
+
+            reservation = Reservation(self._next_id, vehicle_id, start, end)
+            self._add(reservation)
+
+        self.machine._record({'e': 'reserve', 'id': reservation.id, 'vehicle': vehicle_id, 'start': start,
+                              'end': end})
+
+        return reservation
+
+    def _add(self, reservation: Reservation) -> None:
+        self._reservations[reservation.id] = reservation
+        self._next_id = max(self._next_id, reservation.id + 1)
+        heapq.heappush(self._endings, (reservation.end, reservation.id))
+        self._timeline(reservation.vehicle_id).add(reservation.start, reservation.end, (BOOKING, reservation.id))
+
+    def cancel(self, reservation_id: int) -> bool:
+        """
+        Release the unit of a booking, False when there is no such booking
+        """
+        with self._lock:
+            if not self._discard(reservation_id):
+                return False
+
+        self.machine._record({'e': 'unreserve', 'id': reservation_id})
+
+        return True
+
+    def _discard(self, reservation_id: int) -> Optional[Reservation]:
+        reservation = self._reservations.pop(reservation_id, None)
+
+        if reservation is not None:
+            self._timelines[reservation.vehicle_id].remove(reservation.start, reservation.end,
+                                                           (BOOKING, reservation.id))
+
+        return reservation
+
+    def expire(self) -> int:
+        """
+        Drop the bookings whose window ended without being picked up, returns how many
+        """
+        now, expired = self.clock(), 0
+
+        with self._lock:
+            while self._endings and self._endings[0][0] <= now:
+                _, reservation_id = heapq.heappop(self._endings)
+                expired += self._discard(reservation_id) is not None
+
+        return expired
+
+    def can_rent(self, vehicle_id: int, reservation_id: Optional[int] = None) -> bool:
+        """
+        Whether a unit of the vehicle model can leave now: the one of a booking of it within its
+            window or, walk-in, one not needed by a booking before the tariff days are over
+        """
+        now = self.clock()
+
+        if reservation_id is not None:
+            reservation = self._reservations.get(reservation_id)
+            return reservation is not None and reservation.vehicle_id == vehicle_id and \
+                reservation.start <= now < reservation.end
+
+        return self.free(vehicle_id, int(now), int(now) + self._rental_seconds()) >= 1
+
+    def _rental_seconds(self) -> int:
+        return self.machine.pricing.tariff.days * DAY
+
+    def rent(self, lease_id: int, vehicle_id: int, reservation_id: Optional[int] = None) -> None:
+        """
+        Hold the unit of a lease from now, until the end of the booking it picks up if any
+        """
+        now = int(self.clock())
+
+        with self._lock:
+            reservation = self._discard(reservation_id) if reservation_id is not None else None
+            end = max(reservation.end if reservation is not None else now + self._rental_seconds(), now + 1)
+
+            self._rentals[lease_id] = (vehicle_id, now, end)
+            self._timeline(vehicle_id).add(now, end, (RENTAL, lease_id))
+
+    def release(self, lease_id: int) -> None:
+        """
+        Free the unit of a lease, the vehicle came back
+        """
+        with self._lock:
+            rental = self._rentals.pop(lease_id, None)
+
+            if rental is not None:
+                vehicle_id, start, end = rental
+                self._timelines[vehicle_id].remove(start, end, (RENTAL, lease_id))
+
+    def replay(self, event: dict) -> None:
+        """
+        Apply a journaled booking or cancellation
+        """
+        with self._lock:
+            if event['e'] == 'reserve':
+                self._add(Reservation(event['id'], event['vehicle'], event['start'], event['end']))
+            else:
+                self._discard(event['id'])
+
+    def snapshot(self) -> dict:
+        """
+        The bookings and the next booking id
+        """
+        with self._lock:
+            return {'next_id': self._next_id, 'bookings': [list(reservation)
+                                                           for reservation in self._reservations.values()]}
+
+    def restore(self, snapshot: dict) -> None:
+        """
+        Replace the bookings with the ones of a snapshot and hold a unit from now for every lease
+            open in the machine
+        """
+        with self._lock:
+            self._reservations, self._endings, self._rentals, self._timelines = {}, [], {}, {}
+
+            for booking in snapshot['bookings']:
+                self._add(Reservation(*booking))
+            self._next_id = snapshot['next_id']
+
+            for lease in self.machine.leases.open_leases.values():
+                self.rent(lease.id, lease.vehicle_id)
@@ -1,101 +1,210 @@
+import os
+import sys
+import time
+
+from analytics import report
+from catalogue import fast_start
 from classes import Machine, Vehicle
-import json
+from commands import Command, machine_registry
+from forecast import ChangeForecast, describe
+from journal import Journal
+from lazy import LazyInventory, lazy_start
+from ledger import Ledger, describe as describe_revenue
+from loader import Loader, iter_json_entries
+from metrics import instrument
+from reservations import ReservationBook
 
 VEHICLES_FN = 'vehicles.json'
 CHANGE_FN = 'change.json'
+STATE_DIR = 'state'
+CATALOGUE_FN = os.path.join(STATE_DIR, 'catalogue.bin')
+INDEX_FN = os.path.join(STATE_DIR, 'vehicles.idx')
 
 
 def parse_vehicles():
-    with open(VEHICLES_FN, 'r') as infile:
-        vehicles_json = json.load(infile)
-
     return [
         (Vehicle(int(id), value['name'], value['price'], value['mileage']), value['stock'])
-        for id, value in vehicles_json.items()
+        for id, _, value in iter_json_entries(VEHICLES_FN)
     ]
 
 
 def parse_change():
-    with open(CHANGE_FN, 'r') as infile:
-        change_json = json.load(infile)
+    return [(coin['value'], coin['number']) for _, _, coin in iter_json_entries(CHANGE_FN)]
 
-    change = []
 
-    for coin in change_json:
-        change.append((coin['value'], coin['number']))
+def rent(command: Command, machine: Machine, loader: Loader) -> None:
+    vehicle, *reservation = command.args
 
-    return change
+    if not machine.start_sale(vehicle, *reservation):
+        print('The vehicle you have chosen is sold out or booked.' if not reservation else
+              f'Reservation {reservation[0]} is not for vehicle {vehicle} now.')
+        return
 
+    failing = ChangeForecast(machine).failing_change(machine.current_quote.price / 100)
 
-if __name__ == '__main__':
-    machine = Machine()
+    if failing:
+        print(f"There may be no change of €{', €'.join(str(change / 100) for change in failing)}, "
+              f"inserting the exact amount is safest.")
 
-    for (vehicle, stock) in parse_vehicles():
-        machine.add_vehicle(vehicle, stock)
+    while not machine.is_enough_money():
+        current_sale_info = machine.get_current_sale_info()
+        print(f'You choose vehicle {machine.get_vehicle_info(vehicle)}')
+        coin = input(f'Insert money (€{current_sale_info.paid} of €{current_sale_info.price}): ')
 
-    for (value, number) in parse_change():
-        machine.add_change(value, number)
+        try:
+            machine.insert_coin(coin)
+        except ValueError:
+            print(f"Valid coins are €{', €'.join(f'{coin / 100:g}' for coin in machine.cashier.VALID_COINS)} "
+                  f"and notes €{', €'.join(f'{note / 100:g}' for note in machine.cashier.VALID_NOTES)}.")
 
-    while True:
-        print(machine.get_options())
-        option = input('Enter your option: ')
-        print('')
+    change = machine.finish_sale()
+    option = ''
 
-        if machine.is_valid_option(option):
-            if Machine.is_rent_option(option):
-                command, vehicle = option.split()
-                if not machine.start_sale(vehicle):
-                    print('The vehicle you have chosen is sold out.')
-                    print('')
-                    continue
+    if change is None:
+        while not Machine.is_cancel_option(option) and not Machine.is_finish_option(option):
+            message = f"Not enough change {machine.total_change()} or the coins available don't match " \
+                      f"the change.\nYou can either Cancel (C) or Finish (F) without change: "
 
-                while not machine.is_enough_money():
-                    current_sale_info = machine.get_current_sale_info()
-                    print(f'You choose vehicle {machine.get_vehicle_info(vehicle)}')
-                    coin = input(f'Insert money (€{current_sale_info.paid} of €{current_sale_info.price}): ')
-                    machine.insert_coin(coin)
+            print(machine.cashier.change)
+            option = input(message)
 
-                change = machine.finish_sale()
+            if Machine.is_cancel_option(option):
+                machine.cancel_sale()
+            elif Machine.is_finish_option(option):
+                machine.finish_sale(force=True)
+            else:
+                print('Please enter a valid option.')
 
-                if change is None:
-                    while not Machine.is_cancel_option(option) and not Machine.is_finish_option(option):
-                        message = f"Not enough change {machine.total_change()} or the coins available don't match " \
-                                  f"the change.\nYou can either Cancel (C) or Finish (F) without change: "
 
-                        print(machine.cashier.change)
-                        option = input(message)
+def list_vehicles(command: Command, machine: Machine, loader: Loader) -> None:
+    if command.args:
+        chunks = machine.iter_list(in_stock=True, max_price=command.args[0])
+    else:
+        chunks = machine.iter_list()
 
-                        if Machine.is_cancel_option(option):
-                            machine.cancel_sale()
-                        elif Machine.is_finish_option(option):
-                            machine.finish_sale(force=True)
-                        else:
-                            print('Please enter a valid option.')
+    for chunk in chunks:
+        print(chunk)
 
-            elif Machine.is_reload_vehicles_option(option):
-                for (vehicle, stock) in parse_vehicles():
-                    machine.add_vehicle(vehicle, stock)
 
-            elif Machine.is_reload_change_option(option):
-                for (value, number) in parse_change():
-                    machine.add_change(value, number)
+def window(hours_from_now: float, hours: float) -> tuple:
+    start = int(time.time() + hours_from_now * 3600)
+    return start, start + int(hours * 3600)
 
-            elif Machine.is_list_option(option):
-                print(machine.get_list())
 
-            elif Machine.is_info_option(option):
-                command, vehicle = option.split()
-                print(machine.get_vehicle_info(vehicle))
+def reserve(command: Command, machine: Machine, loader: Loader) -> None:
+    vehicle, hours_from_now, hours = command.args
+    reservation = machine.reservations.book(vehicle, *window(hours_from_now, hours))
 
-            elif Machine.is_help_option(option):
-                continue
+    if reservation is None:
+        print(f'Vehicle {vehicle} is not available for the whole of that time.')
+        return
 
-            elif Machine.is_return_option(option):
-                command, vehicle, mileage = option.split(' ')
-                machine.return_vehicle(vehicle, mileage)
+    start, end = (time.strftime('%Y-%m-%d %H:%M', time.localtime(at)) for at in reservation[2:])
+    print(f'Reservation {reservation.id}: vehicle {vehicle} from {start} to {end}.')
 
-            else:
-                print(f'{option} is not a valid option.')
 
+def reload(command: Command, machine: Machine, loader: Loader) -> None:
+    fn = loader.vehicles_fn if command.name == 'rv' else loader.change_fn
+
+    print(f'Reloading {fn}, it is applied once read.' if loader.scan(fn) else f'{fn} is already being reloaded.')
+
+
+def apply_reloads(machine: Machine, loader: Loader) -> None:
+    for fn, applied in loader.apply_scans(machine):
+        print(f"{applied} {'vehicles' if fn == loader.vehicles_fn else 'coins'} updated.")
+
+
+def free(command: Command, machine: Machine, loader: Loader) -> None:
+    vehicle, hours_from_now, hours = command.args
+    units = machine.reservations.free(vehicle, *window(hours_from_now, hours))
+
+    print(f'Invalid option: no vehicle with ID {vehicle}.' if units is None else f'{units} units free.')
+
+
+HANDLERS = {
+    'rv': reload,
+    'rc': reload,
+    'help': lambda command, machine, loader: None,
+    'list': list_vehicles,
+    'info': lambda command, machine, loader: print(machine.get_vehicle_info(*command.args)),
+    'rent': rent,
+    'return': lambda command, machine, loader: machine.return_vehicle(*command.args),
+    'forecast': lambda command, machine, loader: print(describe(ChangeForecast(machine), machine)),
+    'metrics': lambda command, machine, loader: print(machine.metrics.render(*command.args)),
+    'stats': lambda command, machine, loader: print(report(machine, *command.args)),
+    'reserve': reserve,
+    'free': free,
+    'unreserve': lambda command, machine, loader: print(
+        'Reservation cancelled.' if machine.reservations.cancel(*command.args) else 'No such reservation.'),
+    'revenue': lambda command, machine, loader: print(describe_revenue(machine.ledger, *command.args)),
+    'search': lambda command, machine, loader: print(machine.search(' '.join(command.args)))
+}
+
+
+def run(machine: Machine, loader: Loader) -> None:
+    registry = machine_registry(machine.options, HANDLERS)
+
+    while True:
+        # reloads are read in the background, the machine only applies their changes between commands
+        apply_reloads(machine, loader)
+        print(machine.get_options())
+        option = input('Enter your option: ')
         print('')
 
+        apply_reloads(machine, loader)
+        command = registry.parse(option)
+
+        if command is None:
+            print(f'{option} is not a valid option.')
+        else:
+            registry.dispatch(command, machine, loader)
+
+        print('')
+
+
+if __name__ == '__main__':
+    lazy = '--lazy' in sys.argv[1:]
+    machine = Machine(stock=LazyInventory() if lazy else None)
+    loader = Loader(VEHICLES_FN, CHANGE_FN)
+    journal = Journal(STATE_DIR)
+    ReservationBook(machine)
+    Ledger(machine)
+
+    if lazy:
+        lazy_start(machine, loader, INDEX_FN)
+
+    journal.recover(machine)
+
+    if lazy:
+        # so a start without --lazy has the vehicles the sales of this run took units of
+        machine._record({'e': 'catalogue', 'fn': VEHICLES_FN})
+
+    machine.add_option('forecast', 'Vehicles that may not get change and the coins to reload')
+    machine.add_option('stats', 'Fleet analytics: [mileage|rentals|revenue|utilization|distance] and [top n] models')
+    machine.add_option('rent', 'Rent a vehicle with [id], picking up [reservation] if given')
+    machine.add_option('reserve', 'Book vehicle [id] starting [hours] from now for [hours]')
+    machine.add_option('free', 'Units of vehicle [id] free starting [hours] from now for [hours]')
+    machine.add_option('unreserve', 'Cancel [reservation]')
+    machine.add_option('search', 'Vehicles in stock whose name matches [words], typos allowed')
+    machine.add_option('revenue', 'Revenue of the last [hours] (24) and of the [top n] models (5)')
+
+    if '--metrics' in sys.argv[1:]:
+        instrument(machine, loader)
+        machine.add_option('metrics', 'Metrics of the machine, as [json] if given')
+
+    if not len(machine.stock):
+        fast_start(machine, loader, CATALOGUE_FN)
+    else:
+        # the journal is ahead of the files, a reload only applies what changes in them from now on
+        if not lazy:
+            loader.mark_loaded(loader.vehicles_fn)
+
+        if machine.cashier.change:
+            loader.mark_loaded(loader.change_fn)
+        else:
+            loader.reload_change(machine)
+
+    try:
+        run(machine, loader)
+    finally:
+        journal.close()
@@ -0,0 +1,237 @@
+import re
+import unicodedata
+from collections import deque
+from contextlib import nullcontext
+from threading import RLock
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from inventory import Inventory
+
+_WORD = re.compile(r'\w+')
+
+
+def words(text: str) -> Tuple[str, ...]:
+    """
+    The words of a text, case folded and without accents ('Café Car' is ('cafe', 'car'))
+    """
+    text = unicodedata.normalize('NFKD', str(text).casefold())
+    return tuple(_WORD.findall(''.join(char for char in text if not unicodedata.combining(char))))
+
+
+class _TrieNode:
+    """
+    A trie node: the vehicles with the word ending here and how many (word, vehicle) pairs its
+        subtree holds
+    """
+    __slots__ = ('children', 'ids', 'count')
+
+    def __init__(self):
+        self.children: Dict[str, _TrieNode] = {}
+        self.ids: Set[int] = set()
+        self.count = 0
+
+
+class SearchIndex:
+    """
+    The vehicles of an inventory by the words of their name: a prefix trie of the words, for
+        matches as the name is typed, and an index of the n-grams of the words for matches with
+        typos ('hnoda' finds Honda)
+
+    It listens to the inventory: a vehicle added, replaced or whose stock changed is only looked
+        at again on the next search and indexed again when its name changed, so sales cost nothing
+        and the whole catalogue is indexed once, by the first search
+
+    Results are ranked: words matching the query as typed first, the ones closest in length to it
+        first, then words with typos, the most similar first
+    """
+
+    def __init__(self, stock: Inventory, n: int = 2, similarity: float = 0.5):
+        self._stock = stock
+        self.n = n
+        self.similarity = similarity
+        self._lock = RLock() if stock.thread_safe else nullcontext()
+        self._root = _TrieNode()
+        self._names: Dict[int, Tuple[str, ...]] = {}
+        self._vocabulary: Dict[str, int] = {}
+        self._grams: Dict[str, Set[str]] = {}
+        self._pending = set(stock)
+
+        stock.subscribe(self._pending.add)
+
+    def grams(self, word: str) -> Set[str]:
+        padded = f' {word} '
+        return {padded[index:index + self.n] for index in range(len(padded) - self.n + 1)}
+
+    def _refresh(self) -> None:
+        """
+        Index again the vehicles whose name changed since the last search
+        """
+        while self._pending:
+            vehicle_id = self._pending.pop()
+            indexed = self._names.get(vehicle_id)
+            name = words(self._stock[vehicle_id]['vehicle'].name) if vehicle_id in self._stock else None
+
+            if name == indexed:
+                continue
+
+            if indexed is not None:
+                self._remove(vehicle_id, indexed)
+
+            if name is not None:
+                self._insert(vehicle_id, name)
+
+    def _insert(self, vehicle_id: int, name: Tuple[str, ...]) -> None:
+        self._names[vehicle_id] = name
+
+        for word in set(name):
+            node = self._root
+            node.count += 1
+
+            for char in word:
+                child = node.children.get(char)
+                if child is None:
+                    child = node.children[char] = _TrieNode()
+                node = child
+                node.count += 1
+
+            node.ids.add(vehicle_id)
+            self._vocabulary[word] = self._vocabulary.get(word, 0) + 1
+
+            if self._vocabulary[word] == 1:
+                for gram in self.grams(word):
+                    self._grams.setdefault(gram, set()).add(word)
+
+    def _remove(self, vehicle_id: int, name: Tuple[str, ...]) -> None:
+        del self._names[vehicle_id]
+
+        for word in set(name):
+            path = [self._root]
+
+            for char in word:
+                path.append(path[-1].children[char])
+
+            path[-1].ids.discard(vehicle_id)
+
+            for node in path:
+                node.count -= 1
+
+            # drop the nodes left without words below them
+            for depth in range(len(word), 0, -1):
+                if path[depth].count:
+                    break
+                del path[depth - 1].children[word[depth - 1]]
+
+            self._vocabulary[word] -= 1
+
+            if not self._vocabulary[word]:
+                del self._vocabulary[word]
+
+                for gram in self.grams(word):
+                    self._grams[gram].discard(word)
+                    if not self._grams[gram]:
+                        del self._grams[gram]
+
+    def _find(self, prefix: str) -> Optional[_TrieNode]:
+        node = self._root
+
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return None
+
+        return node
+
+    def _completed(self, prefix: str) -> int:
+        """
+        How many (word, vehicle) pairs the words starting with prefix have
+        """
+        node = self._find(prefix)
+        return node.count if node is not None else 0
+
+    def _candidates(self, token: str) -> Iterator[Set[int]]:
+        """
+        The vehicles of the words starting with token, shortest words first, then the ones of the
+            words similar to it, the most similar first
+        """
+        node = self._find(token)
+        queue = deque([node] if node is not None else [])
+
+        while queue:
+            node = queue.popleft()
+
+            if node.ids:
+                yield node.ids
+
+            queue.extend(node.children[char] for char in sorted(node.children))
+
+        for word in self._similar(token):
+            if not word.startswith(token):
+                yield self._find(word).ids
+
+    def _similar(self, token: str) -> List[str]:
+        """
+        The words of the catalogue sharing enough n-grams with token, the most similar first
+        """
+        grams = self.grams(token)
+        shared: Dict[str, int] = {}
+
+        for gram in grams:
+            for word in self._grams.get(gram, ()):
+                shared[word] = shared.get(word, 0) + 1
+
+        scored = [(2 * count / (len(grams) + len(self.grams(word))), word) for word, count in shared.items()]
+
+        return [word for score, word in sorted(scored, key=lambda item: (-item[0], item[1]))
+                if score >= self.similarity]
+
+    def _matches(self, token: str, name: Tuple[str, ...]) -> bool:
+        grams = self.grams(token)
+
+        for word in name:
+            if word.startswith(token):
+                return True
+
+            other = self.grams(word)
+            if 2 * len(grams & other) / (len(grams) + len(other)) >= self.similarity:
+                return True
+
+        return False
+
+    def search(self, query: str, limit: int = 10, in_stock: bool = True) -> List[int]:
+        """
+        The ids of the vehicles best matching every word of a query, only the ones in stock unless
+            told otherwise
+        """
+        tokens = words(query)
+
+        if not tokens or limit <= 0:
+            return []
+
+        found, seen = [], set()
+
+        with self._lock:
+            self._refresh()
+
+            # the vehicles of the word with the fewest completions are checked for the others, the
+            # longest word when none is completed (it has typos)
+            token = min(tokens, key=lambda token: (self._completed(token) or float('inf'), -len(token)))
+            others = list(tokens)
+            others.remove(token)
+
+            for ids in self._candidates(token):
+                for vehicle_id in ids:
+                    if vehicle_id in seen:
+                        continue
+
+                    seen.add(vehicle_id)
+
+                    if in_stock and not self._stock.is_available(vehicle_id):
+                        continue
+
+                    if all(self._matches(other, self._names[vehicle_id]) for other in others):
+                        found.append(vehicle_id)
+
+                        if len(found) == limit:
+                            return found
+
+        return found
@@ -0,0 +1,198 @@
+"""
+Line protocol front-end serving many kiosks from one Machine, every connection getting its own
+Session. Each response is one or more lines followed by an empty line.
+
+Usage: python server.py [--host 127.0.0.1] [--port 8765] [--vehicles vehicles.json] [--change change.json]
+"""
+import argparse
+import asyncio
+from typing import List
+
+from classes import Machine, Session
+from commands import Command, CommandRegistry, machine_registry
+from loader import Loader
+from runner import CHANGE_FN, VEHICLES_FN
+
+SESSION_OPTIONS = {
+    'insert': 'Insert a coin with [value] in the current sale',
+    'c': 'Cancel the current sale',
+    'f': 'Finish the current sale without change',
+    'quit': 'Close the connection'
+}
+
+
+def rent(command: Command, session: Session, loader: Loader) -> List[str]:
+    if session.vehicle is not None:
+        return ['Please finish or cancel the current sale first.']
+    if not session.start_sale(*command.args):
+        return ['The vehicle you have chosen is sold out.']
+    return [f'You choose vehicle {session.vehicle}', f'Insert money (€{session.paid} of €{session.price})']
+
+
+def insert(command: Command, session: Session, loader: Loader) -> List[str]:
+    if session.vehicle is None:
+        return ['Please select a vehicle first.']
+    try:
+        session.insert_coin(*command.args)
+    except ValueError:
+        return [f'{command.args[0]} is not a valid coin.']
+    if not session.is_enough_money():
+        return [f'Insert money (€{session.paid} of €{session.price})']
+    return finish(session, force=False)
+
+
+def force_finish(command: Command, session: Session, loader: Loader) -> List[str]:
+    if not session.is_enough_money():
+        return ['Please select a vehicle and insert enough money first.']
+    return finish(session, force=True)
+
+
+def cancel(command: Command, session: Session, loader: Loader) -> List[str]:
+    session.cancel_sale()
+    return ['Sale cancelled.']
+
+
+def return_vehicle(command: Command, session: Session, loader: Loader) -> List[str]:
+    vehicle, mileage = command.args
+    lease = session.machine.return_vehicle(vehicle, mileage)
+    if lease is None:
+        return [f'Vehicle {vehicle} cannot be returned with mileage {mileage}.']
+    lines = [f'Vehicle {vehicle} returned successfully with new mileage {mileage}']
+    if lease.mileage_charge:
+        lines.append(f'€{lease.mileage_charge / 100} is due for the km over the {lease.km_allowance}km included.')
+    return lines
+
+
+def reload(command: Command, session: Session, loader: Loader) -> List[str]:
+    fn = loader.vehicles_fn if command.name == 'rv' else loader.change_fn
+
+    return [f'Reloading {fn}, it is applied once read.' if loader.scan(fn) else f'{fn} is already being reloaded.']
+
+
+def list_vehicles(command: Command, session: Session, loader: Loader) -> List[str]:
+    if command.args:
+        return [session.machine.get_list(in_stock=True, max_price=command.args[0])]
+    return [session.machine.get_list()]
+
+
+HANDLERS = {
+    'rv': reload,
+    'rc': reload,
+    'list': list_vehicles,
+    'info': lambda command, session, loader: [session.machine.get_vehicle_info(*command.args)],
+    'rent': rent,
+    'return': return_vehicle,
+    'insert': insert,
+    'c': cancel,
+    'f': force_finish
+}
+
+
+def session_registry(machine: Machine) -> CommandRegistry:
+    """
+    The machine commands plus the ones driving a session, 'help' describing all of them
+    """
+    registry = machine_registry(machine.options, HANDLERS)
+    registry.register('insert', insert, required=(float, ), description=SESSION_OPTIONS['insert'])
+    for name in ('c', 'f', 'quit'):
+        registry.register(name, HANDLERS.get(name), description=SESSION_OPTIONS[name])
+    registry.handle('help', lambda command, session, loader: [registry.describe()])
+
+    return registry
+
+
+def handle_command(registry: CommandRegistry, session: Session, loader: Loader, option: str) -> List[str]:
+    """
+    Apply a command of one connection, returns the response lines; the reloads read since the
+        previous command are applied first
+    """
+    updated = []
+
+    if loader is not None:
+        updated = [f"{applied} {'vehicles' if fn == loader.vehicles_fn else 'coins'} updated."
+                   for fn, applied in loader.apply_scans(session.machine)]
+
+    command = registry.parse(option)
+
+    if command is None:
+        return [*updated, f'{option} is not a valid option.']
+
+    return [*updated, *registry.dispatch(command, session, loader)]
+
+
+def finish(session: Session, force: bool) -> List[str]:
+    name = session.vehicle.name
+    change = session.finish_sale(force=force)
+
+    if change is None and not force:
+        return [f"Not enough change {session.machine.total_change()} or the coins available don't match the change.",
+                'You can either Cancel (C) or Finish (F) without change']
+
+    return [f'You just bought a {name} and got €{change if change is not None else 0.0} change. '
+            f'Your lease is {session.lease.id}.']
+
+
+async def handle_client(registry: CommandRegistry, machine: Machine, loader: Loader, reader: asyncio.StreamReader,
+                        writer: asyncio.StreamWriter) -> None:
+    """
+    Serve one connection until it quits or disconnects, an unfinished sale is cancelled
+    """
+    session = Session(machine)
+
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+
+            option = line.decode().strip()
+            if not option:
+                continue
+            if option.lower() == 'quit':
+                break
+
+            try:
+                response = handle_command(registry, session, loader, option)
+            except KeyError:
+                response = [f'{option} is not a valid option.']
+
+            writer.write(('\n'.join(response) + '\n\n').encode())
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        session.cancel_sale()
+        writer.close()
+
+
+async def serve(machine: Machine, loader: Loader, host: str = '127.0.0.1', port: int = 8765) -> asyncio.AbstractServer:
+    """
+    Start serving the machine, every connection with its own session
+    """
+    registry = session_registry(machine)
+
+    return await asyncio.start_server(lambda reader, writer: handle_client(registry, machine, loader, reader, writer),
+                                      host, port)
+
+
+async def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description='Serve a machine to many kiosks over a line protocol')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--vehicles', default=VEHICLES_FN)
+    parser.add_argument('--change', default=CHANGE_FN)
+    args = parser.parse_args(argv)
+
+    machine = Machine(verbose=False)
+    loader = Loader(args.vehicles, args.change)
+    loader.reload_vehicles(machine)
+    loader.reload_change(machine)
+
+    server = await serve(machine, loader, args.host, args.port)
+
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,259 @@
+"""
+Discrete-event load simulation of a machine: customers arrive at the kiosk (a Poisson stream), wait
+for the customer before them, rent a vehicle inserting coins and bring it back after a while with
+more mileage, all in virtual time and against a real Machine and Cashier
+
+It answers how long customers queue, how often the machine has no change or no stock and how many
+sales it can make per hour for a given catalogue and drawer.
+
+Usage: python simulate.py [--vehicles vehicles.json --change change.json | --fleet 1000] [--customers 100000]
+                          [--arrivals 30] [--rental-hours 48] [--km 150] [--pattern random] [--force 0.5]
+                          [--seed 0] [--json]
+"""
+import argparse
+import heapq
+import json
+import random
+import sys
+import time
+from array import array
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from bench import build_machine
+from classes import Cashier, Machine, to_cents
+from loader import Loader
+
+HOUR = 3600.0
+# what customers pay with, in euros: the coins of the drawer and notes
+_COINS = sorted((coin / 100 for coin in Cashier.VALID_COINS + Cashier.VALID_NOTES), reverse=True)
+_CENTS = [to_cents(coin) for coin in _COINS]
+
+
+def pay_exact(due: int, rng: random.Random) -> float:
+    """
+    The largest coin not above what is still due, the smallest coin once less than it is due
+    """
+    return next((coin for coin, cents in zip(_COINS, _CENTS) if cents <= due), _COINS[-1])
+
+
+def pay_large(due: int, rng: random.Random) -> float:
+    """
+    One of the three smallest coins covering what is still due, as customers paying with notes do
+    """
+    covering = [coin for coin, cents in zip(_COINS, _CENTS) if cents >= due][-3:]
+    return rng.choice(covering or _COINS[:1])
+
+
+def pay_random(due: int, rng: random.Random) -> float:
+    """
+    Any coin up to the smallest one covering what is still due
+    """
+    covering = next((index for index in reversed(range(len(_CENTS))) if _CENTS[index] >= due), 0)
+    return rng.choice(_COINS[covering:])
+
+
+PATTERNS: Dict[str, Callable[[int, random.Random], float]] = {
+    'exact': pay_exact,
+    'large': pay_large,
+    'random': pay_random
+}
+
+
+class Scenario(NamedTuple):
+    """
+    How customers behave: arrivals per hour, the mean rental duration (hours) and km driven, how
+        coins are inserted (one of PATTERNS), the chance a customer rents anyway when there is no
+        change and the time (seconds) the kiosk takes per sale and per coin inserted
+    """
+    arrivals: float = 30.0
+    rental_hours: float = 48.0
+    km: float = 150.0
+    pattern: str = 'random'
+    force: float = 0.5
+    seconds_per_sale: float = 30.0
+    seconds_per_coin: float = 2.0
+
+
+class Report(NamedTuple):
+    customers: int
+    sales: int
+    stock_outs: int
+    change_failures: int
+    forced: int
+    walked_away: int
+    returns: int
+    hours: float
+    mean_wait: float
+    p95_wait: float
+    max_wait: float
+    busy: float
+    wall_seconds: float
+
+    @property
+    def sales_per_hour(self) -> float:
+        return self.sales / self.hours if self.hours else 0.0
+
+    @property
+    def change_failure_rate(self) -> float:
+        """
+        The share of the sales attempted (the vehicle was in stock) without change for them
+        """
+        attempts = self.customers - self.stock_outs
+        return self.change_failures / attempts if attempts else 0.0
+
+    @property
+    def stock_out_rate(self) -> float:
+        return self.stock_outs / self.customers if self.customers else 0.0
+
+    def as_dict(self) -> dict:
+        return dict(self._asdict(), sales_per_hour=self.sales_per_hour, change_failure_rate=self.change_failure_rate,
+                    stock_out_rate=self.stock_out_rate)
+
+
+def simulate(machine: Machine, customers: int, scenario: Scenario = Scenario(), seed: int = 0) -> Report:
+    """
+    Serve customers (first come, first served) at a machine with the behaviour of a scenario; the
+        machine stock, drawer and leases are changed as they would be by real customers
+
+    Time only exists as events: the next arrival and the returns due before it are taken from a
+        heap, so the simulation runs as fast as the machine serves the sales
+    """
+    rng = random.Random(seed)
+    pay = PATTERNS[scenario.pattern]
+    vehicle_ids = list(machine.stock)
+    arrival_gap, rental_rate, km_rate = HOUR / scenario.arrivals, 1 / (scenario.rental_hours * HOUR), 1 / scenario.km
+
+    returns: List[tuple] = []
+    waits = array('d')
+    sales = stock_outs = change_failures = forced = walked_away = returned = 0
+    now = free_at = busy = 0.0
+    started = time.perf_counter()
+
+    for _ in range(customers):
+        now += rng.expovariate(1 / arrival_gap)
+        start = max(now, free_at)
+        waits.append(start - now)
+
+        while returns and returns[0][0] <= start:
+            _, lease_id, mileage = heapq.heappop(returns)
+            returned += machine.return_lease(lease_id, mileage) is not None
+
+        if not machine.start_sale(rng.choice(vehicle_ids)):
+            stock_outs += 1
+            free_at = start
+            continue
+
+        coins = 0
+        while not machine.is_enough_money():
+            machine.insert_coin(pay(machine.current_quote.price - to_cents(machine.cashier.current_amount), rng))
+            coins += 1
+
+        sold = machine.finish_sale() is not None
+
+        if not sold:
+            change_failures += 1
+            sold = rng.random() < scenario.force
+
+            if sold:
+                machine.finish_sale(force=True)
+                forced += 1
+            else:
+                machine.cancel_sale()
+                walked_away += 1
+
+        if sold:
+            lease = machine.last_lease
+            sales += 1
+            heapq.heappush(returns, (start + rng.expovariate(rental_rate), lease.id,
+                                     lease.start_mileage + 1 + int(rng.expovariate(km_rate))))
+
+        service = scenario.seconds_per_sale + scenario.seconds_per_coin * coins
+        free_at = start + service
+        busy += service
+
+    waits = sorted(waits)
+    hours = max(now, free_at) / HOUR
+
+    return Report(customers, sales, stock_outs, change_failures, forced, walked_away, returned, hours,
+                  sum(waits) / len(waits) if waits else 0.0, waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+                  waits[-1] if waits else 0.0, busy / max(now, free_at) if customers else 0.0,
+                  time.perf_counter() - started)
+
+
+def describe(report: Report) -> str:
+    """
+    A string representation of a simulation report
+    """
+    return '\n'.join([
+        f'{report.customers} customers over {report.hours:.1f}h simulated in {report.wall_seconds:.2f}s',
+        f'Sales: {report.sales} ({report.sales_per_hour:.1f}/h), {report.returns} vehicles returned',
+        f'Queue wait: mean {report.mean_wait:.1f}s, p95 {report.p95_wait:.1f}s, max {report.max_wait:.1f}s, '
+        f'kiosk busy {report.busy:.0%}',
+        f'No change: {report.change_failure_rate:.2%} ({report.forced} rented anyway, {report.walked_away} walked away)',
+        f'Out of stock: {report.stock_out_rate:.2%}'
+    ])
+
+
+def synthetic_scenario(fleet_size: int, rng: random.Random, depth: int = 100) -> Machine:
+    """
+    A machine with a synthetic fleet (see bench.py) and up to depth coins of every valid coin on top
+        of the synthetic drawer
+    """
+    machine = build_machine(fleet_size, rng)
+
+    for coin in Cashier.VALID_COINS:
+        machine.add_change(coin / 100, machine.cashier.change.get(int(coin), 0) + rng.randint(depth // 2, depth))
+
+    return machine
+
+
+def load_scenario(vehicles_fn: str, change_fn: str) -> Machine:
+    """
+    A machine with the stock and the change of a vehicles.json and a change.json
+    """
+    machine = Machine(verbose=False)
+    loader = Loader(vehicles_fn, change_fn)
+    loader.reload_vehicles(machine)
+    loader.reload_change(machine)
+
+    return machine
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    defaults = Scenario()
+    parser = argparse.ArgumentParser(description='Simulate customers at a machine in virtual time')
+    parser.add_argument('--vehicles', help='vehicles.json of the scenario, a synthetic fleet when not given')
+    parser.add_argument('--change', help='change.json of the scenario')
+    parser.add_argument('--fleet', type=int, default=1000, help='Size of the synthetic fleet')
+    parser.add_argument('--customers', type=int, default=100000)
+    parser.add_argument('--arrivals', type=float, default=defaults.arrivals, help='Customers per hour')
+    parser.add_argument('--rental-hours', type=float, default=defaults.rental_hours)
+    parser.add_argument('--km', type=float, default=defaults.km, help='Mean km driven per rental')
+    parser.add_argument('--pattern', choices=list(PATTERNS), default=defaults.pattern)
+    parser.add_argument('--force', type=float, default=defaults.force,
+                        help='Chance a customer rents anyway when there is no change')
+    parser.add_argument('--seconds-per-sale', type=float, default=defaults.seconds_per_sale)
+    parser.add_argument('--seconds-per-coin', type=float, default=defaults.seconds_per_coin)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args(argv)
+
+    if bool(args.vehicles) != bool(args.change):
+        parser.error('--vehicles and --change go together')
+
+    if args.vehicles:
+        machine = load_scenario(args.vehicles, args.change)
+    else:
+        machine = synthetic_scenario(args.fleet, random.Random(args.seed))
+
+    scenario = Scenario(args.arrivals, args.rental_hours, args.km, args.pattern, args.force, args.seconds_per_sale,
+                        args.seconds_per_coin)
+    report = simulate(machine, args.customers, scenario, args.seed)
+
+    print(json.dumps(report.as_dict(), indent=2) if args.json else describe(report))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,97 @@
-from classes import Cashier, CurrentSaleInfo, Machine, Vehicle
+from analytics import FleetFrame, report
+from batch import run_batch
+from bench import BENCHMARKS, compare, run_benchmarks
+from catalogue import fast_start, load_catalogue
+from classes import Cashier, CurrentSaleInfo, Machine, Session, Vehicle
+from commands import Command, CommandRegistry, machine_registry
+from compact import CompactInventory
+from fleet import Fleet
+from forecast import ChangeForecast, likely_change
+from inventory import Inventory, SortedIndex
+from journal import Journal
+from lazy import LazyInventory, lazy_start
+from ledger import Fenwick, Ledger, Totals, describe as describe_revenue
+from leases import Lease, LeaseTable
+from loader import Loader, iter_json_entries
+from metrics import Metrics, instrument
+from pricing import PricingEngine, Tariff
+from reservations import ReservationBook, Timeline
+from search import words
+from server import serve
+from simulate import PATTERNS, Scenario, load_scenario, simulate, synthetic_scenario
+from typing import Optional, Sequence
 from unittest import TestCase
+import asyncio
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+
+
+def rent(machine: Machine, vehicle_id: int = 1, coins: Sequence[float] = (10, ), reservation: Optional[int] = None,
+         force: bool = False) -> Optional[Lease]:
+    """
+    Sell a unit of a vehicle with the coins given, forced without change when asked and cancelled
+        otherwise; the lease, None when it was not sold
+    """
+    if not machine.start_sale(vehicle_id, reservation):
+        return None
+
+    for coin in coins:
+        machine.insert_coin(coin)
+
+    if machine.finish_sale() is None:
+        if not force:
+            machine.cancel_sale()
+            return None
+        machine.finish_sale(force=True)
+
+    return machine.last_lease
+
+
+class ClockMixin:
+    """
+    A clock the tests move by hand, self.now starts at hour 1000
+    """
+    HOUR = 3600
+    now = 1000 * HOUR
+
+    def at(self, hours: float) -> int:
+        return int(self.now + hours * self.HOUR)
+
+
+class LoaderFilesMixin:
+    """
+    A vehicles.json and a change.json in a temporary directory, with a machine and a loader of them
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.vehicles_fn = os.path.join(self.directory.name, 'vehicles.json')
+        self.change_fn = os.path.join(self.directory.name, 'change.json')
+        self.write(self.vehicles_fn, {
+            '1': {'name': 'Car', 'stock': 1, 'price': 20, 'mileage': 100},
+            '2': {'name': 'Bike', 'stock': 10, 'price': 100, 'mileage': 200}
+        })
+        self.write(self.change_fn, [{'value': 0.01, 'number': 500}, {'value': 2, 'number': 50}])
+        self.machine = Machine()
+        self.loader = Loader(self.vehicles_fn, self.change_fn)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, fn, content):
+        with open(fn, 'w') as outfile:
+            json.dump(content, outfile, indent=2)
+        os.utime(fn, ns=(0, os.stat(fn).st_mtime_ns + 1))
 
 
 class TestCashier(TestCase):
 
     def setUp(self):
-        self.cashier = Cashier()
+        self.cashier = Cashier(debug=True)
         self.cashier.add_change(0.01, 0)
         self.cashier.add_change(0.02, 0)
         self.cashier.add_change(0.05, 0)
@@ -32,12 +118,106 @@ class TestCashier(TestCase):
         self.assertTrue(coin_value * 100 in self.cashier.change)
         self.assertEquals(self.cashier.change[coin_value * 100], 100)
 
+    def test_total_change(self):
+        self.cashier.add_change(0.10, 3)
+        self.cashier.add_change(2.0, 2)
+
+        self.assertEqual(self.cashier.total_change, 4.3)
+
+        self.cashier.add_change(2.0, 1)
+
+        self.assertEqual(self.cashier.total_change, 2.3)
+
+    def test_total_change_after_sale(self):
+        self.cashier.add_change(2.0, 2)
+        self.cashier.insert_coin(5)
+        self.cashier.calculate_change(3.0)
+        self.cashier.finish_sale()
+
+        self.assertEqual(self.cashier.total_change, 7.0)
+        self.assertEqual(self.cashier.change[500], 1)
+
+    def test_finish_sale_drawer_changed(self):
+        self.cashier.add_change(2.0, 1)
+        self.cashier.insert_coin(5)
+
+        self.assertEqual(self.cashier.calculate_change(3.0), 2.0)
+
+        self.cashier.add_change(2.0, 0)
+
+        self.assertIsNone(self.cashier.finish_sale())
+        self.assertEqual(self.cashier.change[200], 0)
+        self.assertEqual(self.cashier.current_amount, 5.0)
+
+        self.cashier.add_change(1.0, 2)
+
+        self.assertEqual(self.cashier.finish_sale(), {100: 2})
+        self.assertEqual((self.cashier.change[100], self.cashier.change[200], self.cashier.change[500]), (0, 0, 1))
+        self.assertEqual(self.cashier.total_change, 5.0)
+
+    def test_total_change_debug_check(self):
+        self.cashier.add_change(1.0, 1)
+        self.cashier.change[100] = 5
+
+        with self.assertRaises(AssertionError):
+            self.cashier.total_change
+
     def test_insert_coin_invalid(self):
         with self.assertRaises(ValueError):
             self.cashier.insert_coin('d')
 
         self.assertEquals(self.cashier.current_amount, 0.0)
 
+    def test_insert_coin_not_valid_coin(self):
+        with self.assertRaises(ValueError):
+            self.cashier.insert_coin(3)
+
+        self.assertEqual(self.cashier.current_amount, 0.0)
+        self.assertEqual(self.cashier.inserted, {})
+
+    def test_insert_coin_denominations(self):
+        self.cashier.insert_coin(0.5)
+        self.cashier.insert_coin(0.01)
+        self.cashier.insert_coin(20)
+
+        with self.assertRaises(ValueError):
+            self.cashier.insert_coin(500)
+
+        self.assertEqual(self.cashier.inserted, {50: 1, 1: 1, 2000: 1})
+
+    def test_insert_coin_counts(self):
+        self.cashier.insert_coin(2)
+        self.cashier.insert_coin('2')
+        self.cashier.insert_coin(5)
+
+        self.assertEqual(self.cashier.inserted, {200: 2, 500: 1})
+        self.assertEqual(self.cashier.current_amount, 9.0)
+
+    def test_calculate_change_with_inserted_coins(self):
+        self.cashier.insert_coin(5)
+        self.cashier.insert_coin(1)
+
+        self.assertEqual(self.cashier.calculate_change(5.0), 1.0)
+        self.assertEqual(self.cashier.pending_change, {100: 1})
+
+        self.cashier.finish_sale()
+
+        self.assertEqual(self.cashier.change[500], 1)
+        self.assertEqual(self.cashier.change[100], 0)
+        self.assertEqual(self.cashier.total_change, 5.0)
+
+    def test_cancel_sale_returns_coins(self):
+        self.cashier.insert_coin(5)
+        self.cashier.insert_coin(1)
+
+        self.assertEqual(self.cashier.cancel_sale(), {500: 1, 100: 1})
+        self.assertEqual(self.cashier.change[500], 0)
+        self.assertEqual(self.cashier.total_change, 0.0)
+
+        self.cashier.insert_coin(5)
+
+        self.assertEqual(self.cashier.calculate_change(4.0), None)
+
     def test_insert_coin(self):
         coin_value = 10.0
 
@@ -80,12 +260,91 @@ class TestCashier(TestCase):
 
         self.assertEqual(self.cashier.calculate_change(0.97), None)
 
-    def test_calculate_change(self):
+    def test_calculate_change_not_enough_small_coins(self):
         self.cashier.add_change(0.01, 2)
 
         self.cashier.insert_coin(5)
 
+        self.assertEqual(self.cashier.calculate_change(3.0), None)
+
+    def test_calculate_change(self):
+        self.cashier.add_change(2.0, 1)
+
+        self.cashier.insert_coin(5)
+
+        self.assertEqual(self.cashier.calculate_change(3.0), 2.0)
+        self.assertEqual(self.cashier.pending_change, {200: 1})
+
+    def test_calculate_change_float_drift(self):
+        self.cashier.add_change(0.10, 3)
+
+        self.cashier.insert_coin(1)
+
+        self.assertEqual(self.cashier.calculate_change(0.7), 0.3)
+
+    def test_calculate_change_not_greedy(self):
+        self.cashier.add_change(0.50, 1)
+        self.cashier.add_change(0.20, 3)
+
+        self.cashier.insert_coin(1)
+
+        self.assertEqual(self.cashier.calculate_change(0.4), 0.6)
+        self.assertEqual(self.cashier.pending_change, {20: 3})
+
+    def test_calculate_change_search_budget(self):
+        self.cashier.add_change(0.01, 500)
+        self.cashier.add_change(0.50, 2)
+        self.cashier.add_change(1.0, 1)
+        self.cashier._solver.SEARCH_BUDGET = 0
+
+        self.cashier.insert_coin(5)
+
+        self.assertEqual(self.cashier.calculate_change(3.99), 1.01)
+        self.assertEqual(self.cashier.pending_change, {100: 1, 1: 1})
+
+    def test_calculate_change_fewest_coins(self):
+        self.cashier.add_change(0.01, 500)
+        self.cashier.add_change(0.50, 2)
+        self.cashier.add_change(1.0, 1)
+
+        self.cashier.insert_coin(5)
+
+        self.assertEqual(self.cashier.calculate_change(3.99), 1.01)
+        self.assertEqual(self.cashier.pending_change, {100: 1, 1: 1})
+
+    def test_calculate_change_keeps_drawer_until_finish(self):
+        self.cashier.add_change(2.0, 1)
+        self.cashier.insert_coin(5)
+
+        self.cashier.calculate_change(3.0)
+
+        self.assertEqual(self.cashier.change[200], 1)
+
+        self.cashier.finish_sale()
+
+        self.assertEqual(self.cashier.change[200], 0)
+        self.assertEqual(self.cashier.pending_change, None)
+
+    def test_calculate_change_cancel_keeps_drawer(self):
+        self.cashier.add_change(2.0, 1)
+        self.cashier.insert_coin(5)
+
+        self.cashier.calculate_change(3.0)
+        self.cashier.cancel_sale()
+
+        self.assertEqual(self.cashier.change[200], 1)
+        self.assertEqual(self.cashier.pending_change, None)
+
+    def test_calculate_change_after_drawer_update(self):
+        self.cashier.add_change(1.0, 1)
+        self.cashier.insert_coin(5)
+
+        self.assertEqual(self.cashier.calculate_change(3.0), None)
+
+        self.cashier.add_change(1.0, 2)
+
         self.assertEqual(self.cashier.calculate_change(3.0), 2.0)
+        self.assertEqual(self.cashier.pending_change, {100: 2})
 
 
 class TestMachine(TestCase):
@@ -142,11 +401,24 @@ class TestMachine(TestCase):
         self.assertTrue(self.machine.current_sale is None)
         self.assertTrue(self.machine.cashier.current_amount == 0.0)
 
+    def test_get_list(self):
+        self.machine.add_vehicle(self.vehicle, 10)
+        self.machine.add_vehicle(Vehicle(2, 'Other Vehicle', 50, 10), 0)
+
+        self.assertEqual(self.machine.get_list(), '1 - Test Vehicle - €10 - 100km - (Stock: 10)\n'
+                                                  '2 - Other Vehicle - €50 - 10km - (Stock: 0)')
+        self.assertEqual(self.machine.get_list(in_stock=True, max_price=20), '1 - Test Vehicle - €10 - 100km - (Stock: 10)')
+
+    def test_is_list_option(self):
+        self.assertTrue(Machine.is_list_option('list'))
+        self.assertTrue(Machine.is_list_option('list 20.5'))
+        self.assertFalse(Machine.is_list_option('list cheap'))
+
     def test_get_choices(self):
         options = 'rv - Reload Vehicle Stock\n' \
                   'rc - Reload Change\n' \
                   'help - All options\n' \
-                  'list - List all vehicles available\n' \
+                  'list - List all vehicles available, in stock under [max price] if given\n' \
                   'info - Info about vehicle with [id]\n' \
                   'rent - Rent a vehicle with [id]\n' \
                   'return - Return a vehicle [id] with [mileage]'
@@ -195,3 +467,1674 @@ class TestMachine(TestCase):
         self.assertEquals(self.machine.stock[self.vehicle.id]['stock'], 9)
         self.assertEquals(self.machine.current_sale, None)
         self.assertEquals(self.machine.cashier.current_amount, 0.0)
+
+
+class TestInventory(TestCase):
+    def setUp(self):
+        self.inventory = Inventory()
+        self.inventory.add(Vehicle(1, 'Car', 20, 100), 1)
+        self.inventory.add(Vehicle(2, 'Bike', 100, 200), 0)
+        self.inventory.add(Vehicle(3, 'BMX', 30, 10), 5)
+
+    def test_add(self):
+        self.assertEqual(len(self.inventory), 3)
+        self.assertEqual(self.inventory[3]['stock'], 5)
+        self.assertEqual(self.inventory.available, {1, 3})
+
+    def test_add_replaces(self):
+        self.inventory.add(Vehicle(1, 'Car', 200, 100), 0)
+
+        self.assertEqual(len(self.inventory), 3)
+        self.assertEqual(self.inventory.available, {3})
+        self.assertEqual([entry['vehicle'].id for entry in self.inventory.query(max_price=150)], [3, 2])
+
+    def test_take(self):
+        self.assertTrue(self.inventory.take(1))
+        self.assertFalse(self.inventory.take(1))
+        self.assertFalse(self.inventory.is_available(1))
+        self.assertEqual(self.inventory[1]['stock'], 0)
+
+    def test_put_back(self):
+        self.inventory.put_back(2)
+
+        self.assertTrue(self.inventory.is_available(2))
+        self.assertEqual([entry['vehicle'].id for entry in self.inventory.query(in_stock=True)], [1, 3, 2])
+
+    def test_query(self):
+        self.assertEqual([entry['vehicle'].id for entry in self.inventory.query()], [1, 2, 3])
+        self.assertEqual([entry['vehicle'].id for entry in self.inventory.query(offset=1, limit=1)], [2])
+        self.assertEqual([entry['vehicle'].id for entry in self.inventory.query(in_stock=True, max_price=30)], [1, 3])
+        self.assertEqual([entry['vehicle'].id for entry in self.inventory.query(min_price=25, limit=1)], [3])
+        self.assertEqual([entry['vehicle'].id for entry in self.inventory.query(min_price=25, offset=1)], [2])
+
+
+class TestSortedIndex(TestCase):
+    def setUp(self):
+        self.index = SortedIndex()
+        self.index.LOAD = 2
+        for key in [(5, 1), (1, 2), (3, 3), (3, 4), (9, 5), (7, 6), (2, 7)]:
+            self.index.add(key)
+
+    def test_add(self):
+        self.assertEqual(list(self.index), [(1, 2), (2, 7), (3, 3), (3, 4), (5, 1), (7, 6), (9, 5)])
+        self.assertEqual(len(self.index), 7)
+
+    def test_discard(self):
+        self.index.discard((3, 3))
+        self.index.discard((4, 4))
+
+        self.assertEqual(list(self.index), [(1, 2), (2, 7), (3, 4), (5, 1), (7, 6), (9, 5)])
+
+    def test_range(self):
+        self.assertEqual(list(self.index.range((2, ), (7, float('inf')))), [(2, 7), (3, 3), (3, 4), (5, 1), (7, 6)])
+        self.assertEqual(list(self.index.range((2, ), (7, float('inf')), offset=3, limit=1)), [(5, 1)])
+        self.assertEqual(list(self.index.range((2, ), (3, float('inf')), offset=3)), [])
+
+
+class TestCompactInventory(TestCase):
+    def setUp(self):
+        self.machine = Machine(stock=CompactInventory())
+        self.machine.add_change(5.0, 10)
+        self.machine.add_vehicle(Vehicle(1, 'Car', 20.0, 100), 1)
+        self.machine.add_vehicle(Vehicle(2, 'Car', 10.0, 50), 3)
+
+    def test_add_vehicle(self):
+        vehicle = self.machine.stock[2]['vehicle']
+
+        self.assertTrue(isinstance(vehicle, Vehicle))
+        self.assertEqual(str(vehicle), '2 - Car - €10.0 - 50km')
+        self.assertEqual(self.machine.stock[2]['stock'], 3)
+        self.assertEqual(self.machine.stock._names, ['Car'])
+
+    def test_add_vehicle_replaces(self):
+        self.machine.add_vehicle(Vehicle(1, 'Van', 30.0, 10), 0)
+
+        self.assertEqual(len(self.machine.stock), 2)
+        self.assertEqual(str(self.machine.stock[1]['vehicle']), '1 - Van - €30.0 - 10km')
+        self.assertFalse(self.machine.stock.is_available(1))
+
+    def test_rent_and_return(self):
+        self.machine.start_sale(1)
+        self.machine.insert_coin(20)
+        self.machine.insert_coin(5)
+        self.machine.finish_sale()
+
+        self.assertEqual(self.machine.stock[1]['stock'], 0)
+        self.assertEqual(self.machine.get_list(in_stock=True), '2 - Car - €10.0 - 50km - (Stock: 3)')
+
+        self.machine.return_vehicle('1', '150')
+
+        self.assertEqual(self.machine.stock[1]['stock'], 1)
+        self.assertEqual(self.machine.leases.get(1).end_mileage, 150)
+
+    def test_indexes(self):
+        rng = random.Random(7)
+        compact, inventory = CompactInventory(), Inventory()
+        compact._by_price.LOAD = compact._available_by_price.LOAD = 2
+
+        for _ in range(500):
+            vehicle_id = rng.randrange(60)
+
+            if vehicle_id in inventory and rng.random() < 0.5:
+                stock = rng.randrange(3)
+                compact.set_stock(vehicle_id, stock)
+                inventory.set_stock(vehicle_id, stock)
+            else:
+                vehicle, stock = Vehicle(vehicle_id, 'Car', rng.randrange(1, 20) * 5.0, 100), rng.randrange(3)
+                compact.add(vehicle, stock)
+                inventory.add(vehicle, stock)
+
+        self.assertEqual(compact.available, inventory.available)
+        self.assertEqual([compact.is_available(vehicle_id) for vehicle_id in range(61)],
+                         [inventory.is_available(vehicle_id) for vehicle_id in range(61)])
+
+        for query in [dict(in_stock=True), dict(max_price=40), dict(in_stock=True, min_price=25, max_price=70),
+                      dict(min_price=50, offset=3, limit=5), dict(in_stock=True, offset=100), dict(offset=7)]:
+            self.assertEqual(compact.query_ids(**query), inventory.query_ids(**query))
+
+
+class TestLoader(LoaderFilesMixin, TestCase):
+    def test_mark_loaded(self):
+        self.loader.reload_vehicles(self.machine)
+        self.machine.start_sale(2)
+        self.machine.insert_coin(100)
+        self.machine.finish_sale(force=True)
+        loader = Loader(self.vehicles_fn, self.change_fn)
+        loader.mark_loaded(self.vehicles_fn)
+
+        self.assertEqual(loader.reload_vehicles(self.machine), 0)
+        self.assertEqual(self.machine.stock[2]['stock'], 9)
+
+        self.write(self.vehicles_fn, {
+            '1': {'name': 'Car', 'stock': 1, 'price': 20, 'mileage': 100},
+            '2': {'name': 'Bike', 'stock': 10, 'price': 90, 'mileage': 200}
+        })
+
+        self.assertEqual(loader.reload_vehicles(self.machine), 1)
+
+    def test_iter_json_entries(self):
+        entries = [(key, value) for key, _, value in iter_json_entries(self.change_fn, chunk_size=3)]
+
+        self.assertEqual(entries, [(None, {'value': 0.01, 'number': 500}), (None, {'value': 2, 'number': 50})])
+
+    def test_iter_json_entries_object(self):
+        entries = [(key, raw) for key, raw, _ in iter_json_entries(self.vehicles_fn, chunk_size=5)]
+
+        self.assertEqual([key for key, _ in entries], ['1', '2'])
+        self.assertEqual(json.loads(entries[0][1])['name'], 'Car')
+
+    def test_reload_vehicles(self):
+        self.assertEqual(self.loader.reload_vehicles(self.machine), 2)
+        self.assertEqual(self.machine.stock[2]['stock'], 10)
+
+        self.machine.stock.take(2)
+
+        self.assertEqual(self.loader.reload_vehicles(self.machine), 0)
+        self.assertEqual(self.machine.stock[2]['stock'], 9)
+
+        self.write(self.vehicles_fn, {
+            '1': {'name': 'Car', 'stock': 3, 'price': 20, 'mileage': 100},
+            '2': {'name': 'Bike', 'stock': 10, 'price': 100, 'mileage': 200}
+        })
+
+        self.assertEqual(self.loader.reload_vehicles(self.machine), 1)
+        self.assertEqual(self.machine.stock[1]['stock'], 3)
+        self.assertEqual(self.machine.stock[2]['stock'], 9)
+
+    def test_reload_vehicles_full(self):
+        self.loader.reload_vehicles(self.machine)
+        self.machine.stock.take(2)
+
+        self.assertEqual(self.loader.reload_vehicles(self.machine, full=True), 2)
+        self.assertEqual(self.machine.stock[2]['stock'], 10)
+
+    def test_reload_change(self):
+        self.assertEqual(self.loader.reload_change(self.machine), 2)
+        self.assertEqual(self.machine.total_change(), 105.0)
+
+        self.write(self.change_fn, [{'value': 0.01, 'number': 500}, {'value': 2, 'number': 10}])
+
+        self.assertEqual(self.loader.reload_change(self.machine), 1)
+        self.assertEqual(self.machine.total_change(), 25.0)
+
+        self.write(self.change_fn, [{'value': 0.01, 'number': 500}, {'value': 1, 'number': 5},
+                                    {'value': 2, 'number': 10}])
+
+        self.assertEqual(self.loader.reload_change(self.machine), 1)
+        self.assertEqual(self.machine.total_change(), 30.0)
+
+    def test_scan(self):
+        self.loader.reload_vehicles(self.machine)
+        self.write(self.vehicles_fn, {
+            '1': {'name': 'Car', 'stock': 3, 'price': 20, 'mileage': 100},
+            '2': {'name': 'Bike', 'stock': 10, 'price': 100, 'mileage': 200},
+            '3': {'name': 'Van', 'stock': 2, 'price': 50, 'mileage': 300}
+        })
+
+        self.assertTrue(self.loader.scan(self.vehicles_fn))
+        self.assertFalse(self.loader.scan(self.vehicles_fn))
+        self.assertTrue(self.loader.scan(self.change_fn))
+        self.assertEqual(self.machine.stock[1]['stock'], 1)
+
+        applied = self.loader.apply_scans(self.machine, wait=True)
+
+        self.assertEqual(sorted(applied), [(self.change_fn, 2), (self.vehicles_fn, 2)])
+        self.assertEqual((self.machine.stock[1]['stock'], self.machine.stock[3]['stock']), (3, 2))
+        self.assertEqual(self.machine.total_change(), 105.0)
+        self.assertEqual(self.loader.reload_vehicles(self.machine), 0)
+        self.assertTrue(self.loader.scan(self.vehicles_fn))
+        self.assertEqual(self.loader.apply_scans(self.machine, wait=True), [(self.vehicles_fn, 0)])
+
+
+class TestBatch(TestCase):
+    def setUp(self):
+        self.machine = Machine(verbose=False)
+        self.machine.add_vehicle(Vehicle(1, 'Test Vehicle', 10, 100), 1)
+        self.machine.add_change(5.0, 1)
+
+    def run_operations(self, *operations):
+        return [json.loads(result) for result in run_batch(self.machine, [json.dumps(op) for op in operations])]
+
+    def test_rent_and_return(self):
+        results = self.run_operations(
+            {'op': 'rent', 'id': 1},
+            {'op': 'insert', 'coin': 10},
+            {'op': 'insert', 'coin': 5},
+            {'op': 'finish'},
+            {'op': 'rent', 'id': 1},
+            {'op': 'return', 'id': 1, 'mileage': 150},
+            {'op': 'return', 'id': 1, 'mileage': 150}
+        )
+
+        self.assertEqual(results, [
+            {'op': 'rent', 'ok': True},
+            {'op': 'insert', 'ok': True, 'paid': 10.0, 'enough': True},
+            {'op': 'insert', 'ok': True, 'paid': 15.0, 'enough': True},
+            {'op': 'finish', 'ok': True, 'change': 5.0, 'lease': 1},
+            {'op': 'rent', 'ok': False, 'error': 'The vehicle is sold out.'},
+            {'op': 'return', 'ok': True, 'lease': 1, 'mileage_charge': 0.0},
+            {'op': 'return', 'ok': False, 'error': 'The vehicle cannot be returned.'}
+        ])
+
+    def test_finish_without_change(self):
+        results = self.run_operations(
+            {'op': 'rent', 'id': 1},
+            {'op': 'insert', 'coin': 20},
+            {'op': 'finish'},
+            {'op': 'finish', 'force': True}
+        )
+
+        self.assertEqual(results[2], {'op': 'finish', 'ok': False, 'error': 'No change available.'})
+        self.assertEqual(results[3], {'op': 'finish', 'ok': True, 'change': None, 'lease': 1})
+        self.assertEqual(self.machine.stock[1]['stock'], 0)
+
+    def test_return_mileage_charge(self):
+        self.machine.pricing.set_tariff(Tariff(version=2, km_allowance=50, per_km=20))
+        results = self.run_operations(
+            {'op': 'rent', 'id': 1},
+            {'op': 'insert', 'coin': 10},
+            {'op': 'finish'},
+            {'op': 'return_lease', 'lease': 1, 'mileage': 250}
+        )
+
+        self.assertEqual(results[3], {'op': 'return_lease', 'ok': True, 'lease': 1, 'mileage_charge': 20.0})
+
+    def test_invalid(self):
+        results = self.run_operations({'op': 'insert', 'coin': 2}, {'op': 'fly'}, {'op': 'rent', 'id': 99})
+
+        self.assertEqual([result['ok'] for result in results], [False, False, False])
+        self.assertEqual(results[1]['error'], 'fly is not a valid operation.')
+
+
+class TestSession(TestCase):
+    def setUp(self):
+        self.machine = Machine(verbose=False)
+        self.machine.add_vehicle(Vehicle(1, 'Test Vehicle', 10, 100), 2)
+        self.machine.add_change(5.0, 1)
+
+    def test_start_sale_reserves(self):
+        first, second, third = Session(self.machine), Session(self.machine), Session(self.machine)
+
+        self.assertTrue(first.start_sale(1))
+        self.assertTrue(second.start_sale('1'))
+        self.assertFalse(third.start_sale(1))
+        self.assertEqual(self.machine.stock[1]['stock'], 0)
+
+    def test_finish_sale(self):
+        first, second = Session(self.machine), Session(self.machine)
+        first.start_sale(1)
+        second.start_sale(1)
+        first.insert_coin(10)
+        first.insert_coin(5)
+        second.insert_coin(10)
+
+        self.assertEqual(first.paid, 15.0)
+        self.assertEqual(self.machine.cashier.current_amount, 0.0)
+        self.assertEqual(first.finish_sale(), 5.0)
+        self.assertEqual(second.finish_sale(), 0.0)
+        self.assertEqual(self.machine.cashier.total, 25.0)
+        self.assertEqual(self.machine.cashier.change, {500: 1, 1000: 2})
+        self.assertEqual(first.vehicle, None)
+
+    def test_cancel_sale_returns_coins(self):
+        session = Session(self.machine)
+        session.start_sale(1)
+        session.insert_coin(20)
+
+        with self.assertRaises(ValueError):
+            session.insert_coin(500)
+
+        session.insert_coin(0.5)
+
+        self.assertEqual(session.cancel_sale(), {2000: 1, 50: 1})
+        self.assertEqual(self.machine.cashier.change, {500: 1})
+
+    def test_finish_sale_no_change(self):
+        session = Session(self.machine)
+        session.start_sale(1)
+        session.insert_coin(20)
+
+        self.assertEqual(session.finish_sale(), None)
+        self.assertEqual(self.machine.cashier.total, 0.0)
+        self.assertEqual(session.finish_sale(force=True), None)
+        self.assertEqual(self.machine.cashier.total, 20.0)
+        self.assertEqual(self.machine.cashier.change[500], 1)
+
+    def test_cancel_sale(self):
+        session = Session(self.machine)
+        session.start_sale(1)
+        session.insert_coin(2)
+        session.cancel_sale()
+
+        self.assertEqual(self.machine.stock[1]['stock'], 2)
+        self.assertEqual(session.amount, 0)
+
+    def test_machine_sale_holds(self):
+        session = Session(self.machine)
+        session.start_sale(1)
+
+        self.assertTrue(self.machine.start_sale(1))
+        self.assertFalse(Session(self.machine).start_sale(1))
+        self.assertEqual(self.machine.stock.counts(), {1: 2})
+
+        self.machine.insert_coin(10)
+        self.assertEqual(self.machine.finish_sale(), 0.0)
+        self.assertEqual(self.machine.stock.counts(), {1: 1})
+
+        session.cancel_sale()
+        self.assertTrue(self.machine.start_sale(1))
+        self.machine.cancel_sale()
+        self.assertEqual(self.machine.stock[1]['stock'], 1)
+
+
+class TestServer(TestCase):
+    def setUp(self):
+        self.machine = Machine(verbose=False)
+        self.machine.add_vehicle(Vehicle(1, 'Test Vehicle', 10, 100), 1)
+        self.machine.add_change(5.0, 1)
+        self.machine.pricing.set_tariff(Tariff(version=2, per_km=10))
+
+    async def request(self, reader, writer, option):
+        writer.write(f'{option}\n'.encode())
+        response = []
+        while (line := (await reader.readline()).decode().rstrip('\n')) != '':
+            response.append(line)
+        return response
+
+    def test_sessions(self):
+        async def scenario():
+            server = await serve(self.machine, None, port=0)
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                first = await asyncio.open_connection('127.0.0.1', port)
+                second = await asyncio.open_connection('127.0.0.1', port)
+                responses = [
+                    await self.request(*first, 'rent 1'),
+                    await self.request(*second, 'rent 1'),
+                    await self.request(*first, 'insert 2'),
+                    await self.request(*first, 'c'),
+                    await self.request(*second, 'rent 1'),
+                    await self.request(*second, 'insert 10'),
+                    await self.request(*first, 'return 1 250')
+                ]
+                first[1].close()
+                second[1].close()
+            return responses
+
+        responses = asyncio.run(scenario())
+
+        self.assertEqual(responses, [
+            ['You choose vehicle 1 - Test Vehicle - €10 - 100km', 'Insert money (€0.0 of €10.0)'],
+            ['The vehicle you have chosen is sold out.'],
+            ['Insert money (€2.0 of €10.0)'],
+            ['Sale cancelled.'],
+            ['You choose vehicle 1 - Test Vehicle - €10 - 100km', 'Insert money (€0.0 of €10.0)'],
+            ['You just bought a Test Vehicle and got €0.0 change. Your lease is 1.'],
+            ['Vehicle 1 returned successfully with new mileage 250', '€5.0 is due for the km over the 100km included.']
+        ])
+        self.assertEqual(self.machine.stock[1]['stock'], 1)
+        self.assertEqual(self.machine.cashier.total, 10.0)
+
+
+class TestThreadSafeMachine(TestCase):
+    THREADS = 8
+    SALES = 300
+
+    def setUp(self):
+        self.machine = Machine(verbose=False, thread_safe=True)
+        self.initial_stock = {vehicle_id: 40 for vehicle_id in range(1, 6)}
+        for vehicle_id, stock in self.initial_stock.items():
+            self.machine.add_vehicle(Vehicle(vehicle_id, f'Vehicle {vehicle_id}', vehicle_id * 1.5, 100), stock)
+        for coin_value, number in [(0.5, 40), (1.0, 40), (2.0, 20), (5.0, 10)]:
+            self.machine.add_change(coin_value, number)
+        self.initial_change = self.machine.total_change()
+
+    def customer(self, seed, results):
+        rng = random.Random(seed)
+        sold, paid, change_given = {}, 0.0, 0.0
+
+        for _ in range(self.SALES):
+            session = Session(self.machine)
+            vehicle_id = rng.choice(list(self.initial_stock))
+            if not session.start_sale(vehicle_id):
+                continue
+
+            session.insert_coin(rng.choice([10, 20]))
+
+            if rng.random() < 0.2:
+                session.cancel_sale()
+                continue
+
+            amount = session.paid
+            change = session.finish_sale(force=rng.random() < 0.5)
+            if session.vehicle is not None:
+                session.cancel_sale()
+                continue
+
+            paid += amount
+            change_given += change or 0.0
+
+            if rng.random() < 0.3 and self.machine.return_lease(session.lease.id, 1000):
+                continue
+
+            sold[vehicle_id] = sold.get(vehicle_id, 0) + 1
+
+        results.append((sold, paid, change_given))
+
+    def test_stress_conservation(self):
+        results = []
+        threads = [threading.Thread(target=self.customer, args=(seed, results)) for seed in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for vehicle_id, stock in self.initial_stock.items():
+            sold = sum(result[0].get(vehicle_id, 0) for result in results)
+            self.assertEqual(self.machine.stock[vehicle_id]['stock'] + sold, stock)
+            self.assertTrue(self.machine.stock[vehicle_id]['stock'] >= 0)
+
+        self.assertAlmostEqual(self.machine.cashier.total, sum(result[1] for result in results))
+        self.assertAlmostEqual(self.machine.total_change() - self.initial_change,
+                               sum(result[1] - result[2] for result in results))
+        self.assertEqual(self.machine.stock.available,
+                         {vehicle_id for vehicle_id in self.initial_stock if self.machine.stock[vehicle_id]['stock'] > 0})
+        self.assertEqual(self.machine.leases.count_open(),
+                         sum(sum(result[0].values()) for result in results))
+
+
+class TestLeaseTable(TestCase):
+    def setUp(self):
+        self.leases = LeaseTable()
+
+    def test_open(self):
+        first = self.leases.open(1, 100)
+        second = self.leases.open(1, 100)
+
+        self.assertNotEqual(first.id, second.id)
+        self.assertEqual(self.leases.open_for(1), [first, second])
+        self.assertEqual(self.leases.count_open(1), 2)
+        self.assertEqual(self.leases.count_open(2), 0)
+
+    def test_close(self):
+        first = self.leases.open(1, 100)
+        second = self.leases.open(1, 100)
+
+        self.assertEqual(self.leases.close(second.id, 100), None)
+        self.assertEqual(self.leases.close(second.id, 150), second)
+        self.assertEqual(self.leases.close(second.id, 200), None)
+        self.assertEqual(self.leases.oldest_open(1), first)
+        self.assertEqual(list(self.leases.closed_leases), [second.id])
+        self.assertEqual(second.end_mileage, 150)
+        self.assertFalse(second.is_open)
+
+    def test_returned_unit_mileage(self):
+        self.leases.close(self.leases.open(1, 100).id, 150)
+
+        self.assertEqual(self.leases.open(1, 100).start_mileage, 150)
+        self.assertEqual(self.leases.open(1, 100).start_mileage, 100)
+
+
+class TestMachineLeases(TestCase):
+    def setUp(self):
+        self.machine = Machine(verbose=False)
+        self.vehicle = Vehicle(1, 'Test Vehicle', 10, 100)
+        self.machine.add_vehicle(self.vehicle, 2)
+
+    def test_rent_many_units(self):
+        first, second = rent(self.machine), rent(self.machine)
+
+        self.assertEqual(self.machine.leases.count_open(1), 2)
+        self.assertEqual(self.machine.stock[1]['stock'], 0)
+
+        self.assertTrue(self.machine.return_lease(second.id, 300))
+        self.assertTrue(self.machine.return_vehicle('1', '200'))
+        self.assertIsNone(self.machine.return_vehicle('1', '400'))
+
+        self.assertEqual((first.end_mileage, second.end_mileage), (200, 300))
+        self.assertEqual(self.machine.stock[1]['stock'], 2)
+        self.assertEqual(self.vehicle.mileage, 100)
+
+    def test_return_lease_invalid(self):
+        lease = rent(self.machine)
+
+        self.assertIsNone(self.machine.return_lease(lease.id, 50))
+        self.assertIsNone(self.machine.return_lease(99, 500))
+        self.assertEqual(self.machine.stock[1]['stock'], 1)
+
+
+class TestJournal(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def machine(self, **kwargs):
+        machine = Machine(verbose=False)
+        journal = Journal(self.directory.name, **kwargs)
+        replayed = journal.recover(machine)
+        return machine, journal, replayed
+
+    def populate(self, machine):
+        machine.add_vehicle(Vehicle(1, 'Test Vehicle', 10, 100), 3)
+        machine.add_change(5.0, 2)
+        for _ in range(2):
+            machine.start_sale(1)
+            machine.insert_coin(10)
+            machine.insert_coin(5)
+            machine.finish_sale()
+        session = Session(machine)
+        session.start_sale(1)
+        session.insert_coin(10)
+        session.finish_sale()
+        machine.return_lease(2, 300)
+
+    def state(self, machine):
+        return (machine.stock[1]['stock'], dict(machine.cashier.change), machine.cashier.total,
+                [(lease.id, lease.start_mileage) for lease in machine.leases.open_leases.values()])
+
+    def test_recover_from_log(self):
+        machine, journal, _ = self.machine()
+        self.populate(machine)
+        journal.close()
+
+        recovered, journal, replayed = self.machine()
+
+        self.assertEqual(replayed, 6)
+        self.assertEqual(self.state(recovered), (1, {500: 2, 1000: 3}, 40.0, [(1, 100), (3, 100)]))
+        self.assertEqual(self.state(recovered), self.state(machine))
+
+        recovered.start_sale(1)
+        recovered.insert_coin(10)
+        recovered.finish_sale()
+
+        self.assertEqual(recovered.last_lease.start_mileage, 300)
+        self.assertEqual(recovered.last_lease.id, 4)
+
+    def test_recover_from_snapshot(self):
+        machine, journal, _ = self.machine(snapshot_every=4)
+        self.populate(machine)
+        journal.close()
+
+        recovered, journal, replayed = self.machine()
+
+        self.assertEqual(replayed, 2)
+        self.assertEqual(self.state(recovered), self.state(machine))
+
+    def test_recover_skips_logged_snapshot_events(self):
+        machine, journal, _ = self.machine()
+        self.populate(machine)
+        with open(journal.log_fn, 'r') as infile:
+            log = infile.read()
+        journal.snapshot()
+        journal.close()
+        with open(journal.log_fn, 'w') as outfile:
+            outfile.write(log + '{"seq": 7, "e": "ret')
+
+        recovered, journal, replayed = self.machine()
+
+        self.assertEqual(replayed, 0)
+        self.assertEqual(self.state(recovered), self.state(machine))
+
+    def test_sync_tail(self):
+        machine, journal, _ = self.machine(sync_every=100, sync_interval=0.05)
+        machine.add_vehicle(Vehicle(1, 'Test Vehicle', 10, 100), 5)
+        journal.sync()
+        machine.add_change(5.0, 2)
+
+        self.assertEqual(journal._unsynced, 1)
+
+        time.sleep(0.2)
+
+        self.assertEqual(journal._unsynced, 0)
+        with open(journal.log_fn, 'r') as infile:
+            self.assertEqual(len(infile.readlines()), 2)
+
+        journal.close()
+
+    def test_snapshot_mid_sale(self):
+        machine, journal, _ = self.machine()
+        machine.add_vehicle(Vehicle(1, 'Test Vehicle', 10, 100), 5)
+        sold, cancelled = Session(machine), Session(machine)
+        sold.start_sale(1)
+        cancelled.start_sale(1)
+        journal.snapshot()
+        cancelled.cancel_sale()
+        sold.insert_coin(10)
+        sold.finish_sale()
+        journal.close()
+
+        recovered, journal, _ = self.machine()
+        journal.close()
+
+        self.assertEqual(machine.stock[1]['stock'], 4)
+        self.assertEqual(self.state(recovered), self.state(machine))
+
+    def test_replay_after_snapshot_mid_sale(self):
+        machine, journal, _ = self.machine()
+        machine.add_vehicle(Vehicle(1, 'Test Vehicle', 10, 100), 5)
+        session = Session(machine)
+        session.start_sale(1)
+        journal.snapshot()
+        session.insert_coin(10)
+        session.finish_sale()
+        journal.close()
+
+        recovered, journal, replayed = self.machine()
+        journal.close()
+
+        self.assertEqual(replayed, 1)
+        self.assertEqual(self.state(recovered), self.state(machine))
+        self.assertEqual(recovered.stock[1]['stock'], 4)
+
+    def test_recover_torn_tail(self):
+        machine, journal, _ = self.machine()
+        machine.add_change(5.0, 2)
+        journal.close()
+
+        with open(journal.log_fn, 'a') as outfile:
+            outfile.write('{"seq":2,"e":"chan')
+
+        recovered, journal, replayed = self.machine()
+        recovered.add_vehicle(Vehicle(1, 'Test Vehicle', 10, 100), 3)
+        journal.close()
+
+        recovered, journal, replayed = self.machine()
+        journal.close()
+
+        self.assertEqual(replayed, 2)
+        self.assertEqual(recovered.stock[1]['stock'], 3)
+        self.assertEqual(recovered.cashier.change, {500: 2})
+
+
+class TestCommandRegistry(TestCase):
+    def setUp(self):
+        self.registry = machine_registry(Machine().options, {'info': lambda command, result: result.append(command)})
+
+    def test_parse(self):
+        self.assertEqual(self.registry.parse('rv'), Command('rv', ()))
+        self.assertEqual(self.registry.parse('RENT 2'), Command('rent', (2, )))
+        self.assertEqual(self.registry.parse('return 1 300'), Command('return', (1, 300)))
+        self.assertEqual(self.registry.parse('list'), Command('list', ()))
+        self.assertEqual(self.registry.parse('list 20.5'), Command('list', (20.5, )))
+
+    def test_parse_invalid(self):
+        self.assertEqual(self.registry.parse(''), None)
+        self.assertEqual(self.registry.parse('fly'), None)
+        self.assertEqual(self.registry.parse('rent'), None)
+        self.assertEqual(self.registry.parse('rent x'), None)
+        self.assertEqual(self.registry.parse('return 1'), None)
+        self.assertEqual(self.registry.parse('list cheap'), None)
+        self.assertEqual(self.registry.parse('rv now'), None)
+
+    def test_build(self):
+        self.assertEqual(self.registry.build('rent', [3]), Command('rent', (3, )))
+        self.assertEqual(self.registry.build('list', ['12']), Command('list', (12.0, )))
+
+    def test_dispatch(self):
+        result = []
+
+        self.registry.dispatch(self.registry.parse('info 3'), result)
+
+        self.assertEqual(result, [Command('info', (3, ))])
+
+    def test_register(self):
+        registry = CommandRegistry()
+        registry.register('insert', required=(float, ), description='Insert a coin')
+        registry.handle('insert', lambda command: command.args[0] * 2)
+
+        self.assertEqual(registry.dispatch(registry.parse('insert 0.5')), 1.0)
+        self.assertEqual(registry.describe(), 'insert - Insert a coin')
+
+    def test_register_rest(self):
+        registry = CommandRegistry()
+        registry.register('pay', required=(str, ), optional=(int, ), rest=float)
+
+        self.assertEqual(registry.parse('pay card'), Command('pay', ('card', )))
+        self.assertEqual(registry.parse('pay card 2 0.5 1 2.5'), Command('pay', ('card', 2, 0.5, 1.0, 2.5)))
+        self.assertEqual(registry.parse('pay card 2 0.5 x'), None)
+        self.assertEqual(registry.parse('pay'), None)
+
+        registry = machine_registry({'search': 'Search vehicles'})
+        query = 'the old red fiat panda with a roof rack'
+
+        self.assertEqual(registry.parse(f'search {query}'), Command('search', tuple(query.split())))
+        self.assertEqual(registry.parse('search'), None)
+
+
+class TestListing(TestCase):
+    def setUp(self):
+        self.machine = Machine(verbose=False)
+        self.machine.listing.CHUNK_SIZE = 2
+        for vehicle_id in range(1, 6):
+            self.machine.add_vehicle(Vehicle(vehicle_id, f'Vehicle {vehicle_id}', vehicle_id * 10, 100), 1)
+
+    def test_get_list(self):
+        self.assertEqual(self.machine.get_list(), '\n'.join(
+            [f'{vehicle_id} - Vehicle {vehicle_id} - €{vehicle_id * 10} - 100km - (Stock: 1)' for vehicle_id in range(1, 6)]
+        ))
+
+    def test_invalidate(self):
+        self.machine.get_list()
+        chunks = list(self.machine.listing.iter_chunks())
+
+        self.machine.stock.take(3)
+        self.machine.add_vehicle(Vehicle(6, 'Vehicle 6', 60, 100), 0)
+        updated = list(self.machine.listing.iter_chunks())
+
+        self.assertTrue(updated[0] is chunks[0])
+        self.assertEqual(updated[1], '3 - Vehicle 3 - €30 - 100km - (Stock: 0)\n4 - Vehicle 4 - €40 - 100km - (Stock: 1)')
+        self.assertEqual(updated[2], chunks[2] + '\n6 - Vehicle 6 - €60 - 100km - (Stock: 0)')
+        self.assertEqual(self.machine.get_list(), '\n'.join(updated))
+
+    def test_iter_list(self):
+        self.machine.stock.take(2)
+
+        self.assertEqual(list(self.machine.iter_list(in_stock=True, max_price=40)), [
+            '1 - Vehicle 1 - €10 - 100km - (Stock: 1)\n3 - Vehicle 3 - €30 - 100km - (Stock: 1)',
+            '4 - Vehicle 4 - €40 - 100km - (Stock: 1)'
+        ])
+
+    def test_get_vehicle_info(self):
+        self.assertEqual(self.machine.get_vehicle_info('2'), '2 - Vehicle 2 - €20 - 100km')
+
+        self.machine.add_vehicle(Vehicle(2, 'Renamed', 20, 100), 1)
+
+        self.assertEqual(self.machine.get_vehicle_info('2'), '2 - Renamed - €20 - 100km')
+        self.assertEqual(self.machine.get_vehicle_info('9'), 'No vehicle with ID 9 found.')
+
+    def test_get_options(self):
+        options = self.machine.get_options()
+        self.machine.add_option('search', 'Search vehicles')
+
+        self.assertEqual(self.machine.get_options(), options + '\nsearch - Search vehicles')
+
+
+class TestBench(TestCase):
+
+    def test_run_benchmarks(self):
+        results = run_benchmarks(list(BENCHMARKS), scale=0.002)
+
+        self.assertEqual(set(results), set(BENCHMARKS))
+        for result in results.values():
+            self.assertGreater(result['ops_per_sec'], 0)
+            self.assertLessEqual(result['p50_us'], result['p95_us'])
+            self.assertLessEqual(result['p95_us'], result['p99_us'])
+
+    def test_compare(self):
+        baseline = {'get_list': {'ops_per_sec': 1000.0}, 'finish_sale': {'ops_per_sec': 1000.0}}
+        results = {'get_list': {'ops_per_sec': 700.0}, 'finish_sale': {'ops_per_sec': 900.0},
+                   'parse_vehicles': {'ops_per_sec': 1.0}}
+
+        self.assertEqual(compare(results, baseline, 0.25), ['get_list: 700 ops/sec vs 1000 baseline'])
+        self.assertEqual(compare(results, baseline, 0.5), [])
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        self.machine = Machine(verbose=False)
+        self.machine.add_vehicle(Vehicle(1, 'Vehicle 1', 10, 100), 5)
+        self.machine.add_change(1.0, 1)
+        self.metrics = instrument(self.machine)
+
+    def test_counters(self):
+        rent(self.machine, 1, (10, 1))
+        rent(self.machine, 1, (50, ))
+        rent(self.machine, 1, (50, ), force=True)
+        self.machine.return_vehicle(1, 200)
+        self.machine.return_vehicle(1, 200)
+        self.machine.return_vehicle(1, 200)
+
+        counters = self.metrics.snapshot()['counters']
+
+        self.assertEqual(counters['machine_finish_sale'], {'change': 1, 'forced': 1, 'no_change': 2})
+        self.assertEqual(counters['machine_cancel_sale'], {'ok': 1})
+        self.assertEqual(counters['machine_return_vehicle'], {'failed': 1, 'ok': 2})
+        self.assertEqual(counters['cashier_calculate_change'], {'failed': 3, 'ok': 1})
+        self.assertTrue(self.machine.metrics is self.metrics)
+
+    def test_latency(self):
+        rent(self.machine, 1, (10, 1))
+
+        latency = self.metrics.snapshot()['latency']['machine_finish_sale']
+
+        self.assertEqual(latency['count'], 1)
+        self.assertEqual(latency['buckets']['+Inf'], 1)
+        self.assertGreaterEqual(latency['max'], 0)
+
+    def test_render(self):
+        self.metrics.inc('op', 'ok', 2)
+        self.metrics.observe('op', 0.002)
+
+        text = self.metrics.render()
+
+        self.assertIn('rentomatic_calls_total{op="op",outcome="ok"} 2', text)
+        self.assertIn('rentomatic_latency_seconds_bucket{op="op",le="0.001"} 0', text)
+        self.assertIn('rentomatic_latency_seconds_bucket{op="op",le="0.005"} 1', text)
+        self.assertIn('rentomatic_latency_seconds_count{op="op"} 1', text)
+        self.assertEqual(json.loads(self.metrics.render('json'))['counters']['op'], {'ok': 2})
+
+    def test_uninstrumented(self):
+        machine = Machine(verbose=False)
+
+        self.assertIsNone(machine.metrics)
+        self.assertEqual(Machine.finish_sale.__name__, 'finish_sale')
+        self.assertFalse('finish_sale' in vars(machine))
+        self.assertIsInstance(Metrics().snapshot(), dict)
+
+
+class TestFleet(TestCase):
+
+    def setUp(self):
+        self.fleet = Fleet(workers=2)
+        for machine_id in range(4):
+            self.fleet.add_machine(machine_id, [(Vehicle(1, 'Ford Fiesta', 20, 100), 2),
+                                                (Vehicle(2, 'BMX', 30, 10), machine_id)], [(1.0, machine_id * 10)])
+
+    def tearDown(self):
+        self.fleet.close()
+
+    def test_apply(self):
+        self.assertEqual(self.fleet.apply(1, {'op': 'rent', 'id': 1}), {'ok': True})
+        self.assertEqual(self.fleet.apply(1, {'op': 'insert', 'coin': 20}), {'ok': True, 'paid': 20.0, 'enough': True})
+        self.assertEqual(self.fleet.apply(1, {'op': 'finish'}), {'ok': True, 'change': 0.0, 'lease': 1})
+        self.assertFalse(self.fleet.apply(9, {'op': 'rent', 'id': 1})['ok'])
+
+    def test_run(self):
+        requests = []
+        for machine_id in range(4):
+            requests += [{'machine': machine_id, 'op': 'rent', 'id': 1},
+                         {'machine': machine_id, 'op': 'insert', 'coin': 20},
+                         {'machine': machine_id, 'op': 'insert', 'coin': 5},
+                         {'machine': machine_id, 'op': 'finish'}]
+
+        results = self.fleet.run(requests)
+
+        self.assertEqual([result['ok'] for result in results[3::4]], [True, True, True, True])
+        self.assertEqual(results[7], {'ok': True, 'change': 5.0, 'lease': 1})
+        self.assertEqual(self.fleet.total_revenue(), 100.0)
+        self.assertEqual(self.fleet.model_stock('ford fiesta'), 4)
+        self.assertEqual(self.fleet.model_stock('BMX'), 6)
+        self.assertEqual(sorted(self.fleet.low_on_change(35)), [0, 1])
+
+    def test_run_failing_operation(self):
+        results = self.fleet.run([{'machine': 0, 'op': 'rent', 'id': 99},
+                                  {'machine': 0, 'op': 'rent', 'id': 1},
+                                  {'machine': 0, 'op': 'cancel'}])
+
+        self.assertEqual((results[0]['ok'], results[0]['error'].startswith('Invalid request')), (False, True))
+        self.assertEqual(results[1:], [{'ok': True}, {'ok': True}])
+
+
+class TestForecast(TestCase):
+
+    def setUp(self):
+        self.machine = Machine(verbose=False)
+        self.machine.add_vehicle(Vehicle(1, 'Vehicle 1', 20, 100), 1)
+        self.machine.add_vehicle(Vehicle(2, 'Vehicle 2', 18.5, 100), 1)
+        self.machine.add_vehicle(Vehicle(3, 'Vehicle 3', 17, 100), 0)
+        self.machine.add_change(0.5, 1)
+        self.machine.add_change(1.0, 2)
+        self.machine.add_change(2.0, 1)
+
+    def test_likely_change(self):
+        self.assertEqual(likely_change(2000), [0, 3000, 8000])
+        self.assertEqual(likely_change(1850), [0, 50, 150, 3150, 8150])
+
+    def test_at_risk(self):
+        forecast = ChangeForecast(self.machine)
+
+        self.assertEqual(forecast.failing_change(20), [3000, 8000])
+        self.assertEqual(forecast.failing_change(18.5), [3150, 8150])
+        self.assertEqual(forecast.at_risk(), {1: 1 / 3, 2: 0.6})
+        self.assertEqual(forecast.at_risk(0.5), {1: 1 / 3})
+
+    def test_reload_plan(self):
+        plan = ChangeForecast(self.machine).reload_plan()
+
+        for coin, number in plan.items():
+            self.machine.add_change(coin / 100, self.machine.cashier.change[coin] + number)
+
+        self.assertEqual(plan, {50: 1, 100: 1, 200: 38})
+        self.assertEqual(ChangeForecast(self.machine).at_risk(), {})
+
+
+class TestCatalogue(LoaderFilesMixin, TestCase):
+    @property
+    def cache_fn(self):
+        return os.path.join(self.directory.name, 'catalogue.bin')
+
+    def state(self, machine):
+        return ({vehicle_id: (str(entry['vehicle']), entry['stock']) for vehicle_id, entry in machine.stock.items()},
+                dict(machine.cashier.change))
+
+    def test_fast_start(self):
+        self.assertFalse(fast_start(self.machine, self.loader, self.cache_fn))
+        self.assertTrue(os.path.exists(self.cache_fn))
+
+        machine, loader = Machine(verbose=False), Loader(self.vehicles_fn, self.change_fn)
+
+        self.assertTrue(fast_start(machine, loader, self.cache_fn))
+        self.assertEqual(self.state(machine), self.state(self.machine))
+        self.assertEqual(loader.reload_vehicles(machine), 0)
+        self.assertEqual(loader.reload_change(machine), 0)
+
+    def test_changed_source(self):
+        fast_start(self.machine, self.loader, self.cache_fn)
+        self.write(self.vehicles_fn, {
+            '1': {'name': 'Café Car', 'stock': 1, 'price': 20.5, 'mileage': 100},
+            '2': {'name': 'Bike', 'stock': 10, 'price': 100, 'mileage': 200}
+        })
+
+        machine, loader = Machine(verbose=False), Loader(self.vehicles_fn, self.change_fn)
+
+        self.assertFalse(load_catalogue(machine, loader, self.cache_fn))
+        self.assertFalse(fast_start(machine, loader, self.cache_fn))
+        self.assertTrue(load_catalogue(Machine(verbose=False), Loader(self.vehicles_fn, self.change_fn), self.cache_fn))
+
+        self.machine.stock.take(2)
+        self.assertEqual(self.loader.reload_vehicles(self.machine), 1)
+        self.assertEqual(self.machine.stock[2]['stock'], 9)
+        self.assertEqual(str(machine.stock[1]['vehicle']), '1 - Café Car - €20.5 - 100km')
+
+    def test_corrupt_cache(self):
+        with open(self.cache_fn, 'wb') as outfile:
+            outfile.write(b'garbage')
+
+        self.assertFalse(load_catalogue(self.machine, self.loader, self.cache_fn))
+        self.assertEqual(len(self.machine.stock), 0)
+
+
+class TestLazy(LoaderFilesMixin, TestCase):
+    @property
+    def index_fn(self):
+        return os.path.join(self.directory.name, 'vehicles.idx')
+
+    def start(self, capacity=1024):
+        machine, loader = Machine(stock=LazyInventory(capacity=capacity), verbose=False), \
+            Loader(self.vehicles_fn, self.change_fn)
+        lazy_start(machine, loader, self.index_fn)
+        loader.reload_change(machine)
+
+        return machine, loader
+
+    def test_offsets(self):
+        with open(self.vehicles_fn, 'rb') as infile:
+            data = infile.read()
+
+        for _, raw, _, offset in iter_json_entries(self.vehicles_fn, chunk_size=5, offsets=True):
+            self.assertEqual(data[offset:offset + len(raw)].decode(), raw)
+
+    def test_index(self):
+        machine, _ = self.start()
+        mtime_ns = os.stat(self.index_fn).st_mtime_ns
+
+        self.assertEqual(machine.stock.live, 0)
+        self.assertEqual(len(machine.stock), 2)
+        self.assertEqual(machine.stock.query_ids(in_stock=True, max_price=50), [1])
+
+        self.start()
+        self.assertEqual(os.stat(self.index_fn).st_mtime_ns, mtime_ns)
+
+    def test_sale(self):
+        machine, loader = self.start(capacity=1)
+
+        self.assertEqual(machine.get_vehicle_info(1), '1 - Car - €20 - 100km')
+        self.assertTrue(machine.start_sale(2))
+        machine.insert_coin(2)
+        machine.add_change(2, 50)
+
+        for _ in range(49):
+            machine.insert_coin(2)
+
+        self.assertEqual(machine.finish_sale(), 0)
+        self.assertEqual(machine.stock[2]['stock'], 9)
+        self.assertEqual(machine.stock.live, 1)
+        self.assertEqual(loader.reload_vehicles(machine), 0)
+
+    def test_queries(self):
+        machine, _ = self.start()
+
+        self.assertEqual(''.join(machine.iter_list(in_stock=True, max_price=50)), machine.get_list(True, 50))
+        self.assertIn('1 - Car - €20 - 100km - (Stock: 1)', machine.get_list(True, 50))
+        self.assertNotIn('Bike', machine.get_list(True, 50))
+        self.assertEqual(machine.stock.live, 1)
+
+    def test_reload(self):
+        machine, loader = self.start()
+        vehicles_fn = f'{self.vehicles_fn}.new'
+        self.write(vehicles_fn, {
+            '1': {'name': 'Car', 'stock': 1, 'price': 20, 'mileage': 100},
+            '2': {'name': 'Bike', 'stock': 10, 'price': 90, 'mileage': 200},
+            '3': {'name': 'Van', 'stock': 2, 'price': 60, 'mileage': 0}
+        })
+        os.replace(vehicles_fn, self.vehicles_fn)
+
+        self.assertEqual(loader.reload_vehicles(machine), 2)
+        self.assertEqual(machine.stock.live, 0)
+        self.assertEqual(str(machine.stock[2]['vehicle']), '2 - Bike - €90 - 200km')
+        self.assertEqual(str(machine.stock[3]['vehicle']), '3 - Van - €60 - 0km')
+        self.assertEqual(str(machine.stock[1]['vehicle']), '1 - Car - €20 - 100km')
+        # vehicle 3 was added before the source was mapped again, it is kept in memory
+        self.assertEqual(machine.stock.live, 2)
+
+        machine.add_vehicle(Vehicle(1, 'Car', 20, 150), 1)
+        self.assertEqual(machine.stock.live, 1)
+        self.assertEqual(str(machine.stock[1]['vehicle']), '1 - Car - €20 - 150km')
+
+    def test_non_ascii(self):
+        with open(self.vehicles_fn, 'w', encoding='utf-8') as outfile:
+            json.dump({'1': {'name': 'Café Fiat', 'stock': 1, 'price': 20.5, 'mileage': 100},
+                       '2': {'name': 'Bicicleta Ágil', 'stock': 3, 'price': 10, 'mileage': 0}},
+                      outfile, ensure_ascii=False)
+
+        machine, loader = self.start()
+
+        self.assertEqual(str(machine.stock[2]['vehicle']), '2 - Bicicleta Ágil - €10 - 0km')
+        self.assertEqual(str(machine.stock[1]['vehicle']), '1 - Café Fiat - €20.5 - 100km')
+        self.assertEqual(loader.reload_vehicles(machine), 0)
+
+    def test_recover(self):
+        machine, _ = self.start()
+        journal = Journal(self.directory.name)
+        journal.recover(machine)
+        machine.add_vehicle(Vehicle(4, 'Scooter', 15, 10), 2)
+        machine.start_sale(1)
+
+        for _ in range(10):
+            machine.insert_coin(2)
+
+        machine.finish_sale()
+        journal.close()
+
+        machine = Machine(stock=LazyInventory(), verbose=False)
+        lazy_start(machine, Loader(self.vehicles_fn, self.change_fn), self.index_fn)
+        journal = Journal(self.directory.name)
+        journal.recover(machine)
+        journal.close()
+
+        self.assertEqual(machine.stock[1]['stock'], 0)
+        self.assertEqual(str(machine.stock[4]['vehicle']), '4 - Scooter - €15 - 10km')
+
+    def journaled_run(self, snapshot: bool):
+        machine, _ = self.start()
+        journal = Journal(self.directory.name)
+        journal.recover(machine)
+        machine._record({'e': 'catalogue', 'fn': self.vehicles_fn})
+        machine.add_vehicle(Vehicle(4, 'Scooter', 15, 10), 2)
+        machine.start_sale(1)
+
+        for _ in range(10):
+            machine.insert_coin(2)
+
+        machine.finish_sale()
+
+        if snapshot:
+            journal.snapshot()
+
+        journal.close()
+
+        return machine
+
+    def test_counts(self):
+        machine, _ = self.start()
+        machine.start_sale(2)
+
+        self.assertEqual(machine.stock.counts(), {1: 1, 2: 10})
+        self.assertEqual(machine.stock.live, 1)
+
+    def test_restore_snapshot(self):
+        self.journaled_run(snapshot=True)
+
+        machine = Machine(stock=LazyInventory(), verbose=False)
+        lazy_start(machine, Loader(self.vehicles_fn, self.change_fn), self.index_fn)
+        journal = Journal(self.directory.name)
+        journal.recover(machine)
+        journal.close()
+
+        with open(os.path.join(self.directory.name, 'snapshot.json')) as infile:
+            self.assertEqual([vehicle[0] for vehicle in json.load(infile)['vehicles']], [4])
+
+        self.assertEqual(machine.stock.live, 0)
+        self.assertEqual((machine.stock[1]['stock'], machine.stock[2]['stock']), (0, 10))
+        self.assertEqual(str(machine.stock[4]['vehicle']), '4 - Scooter - €15 - 10km')
+
+    def test_plain_recovery(self):
+        for snapshot in (False, True):
+            with self.subTest(snapshot=snapshot):
+                lazy = self.journaled_run(snapshot)
+
+                machine = Machine(verbose=False)
+                journal = Journal(self.directory.name)
+                journal.recover(machine)
+                journal.close()
+
+                for name in os.listdir(self.directory.name):
+                    if name in ('journal.log', 'snapshot.json'):
+                        os.remove(os.path.join(self.directory.name, name))
+
+                self.assertEqual({vehicle_id: (str(entry['vehicle']), entry['stock'])
+                                  for vehicle_id, entry in machine.stock.items()},
+                                 {vehicle_id: (str(entry['vehicle']), entry['stock'])
+                                  for vehicle_id, entry in lazy.stock.items()})
+                self.assertEqual(len(machine.leases.open_leases), 1)
+
+
+class TestPricing(TestCase):
+    def setUp(self):
+        self.machine = Machine(verbose=False)
+        self.machine.add_vehicle(Vehicle(1, 'Test Vehicle', 10, 100), 2)
+        self.machine.pricing.set_tariff(Tariff(version=2, days=2, surcharge=0.1, km_allowance=50, per_km=20))
+
+    def test_quote(self):
+        quote = self.machine.pricing.quote(self.machine.stock[1]['vehicle'])
+
+        self.assertEqual(quote, (2200, 100, 20))
+        self.assertTrue(self.machine.pricing.quote(self.machine.stock[1]['vehicle']) is quote)
+
+        self.machine.add_vehicle(Vehicle(1, 'Test Vehicle', 20, 100), 2)
+
+        self.assertEqual(self.machine.pricing.quote(self.machine.stock[1]['vehicle']).price, 4400)
+
+    def test_default_tariff(self):
+        self.assertEqual(PricingEngine().quote(Vehicle(1, 'Test Vehicle', 10.5, 100)), (1050, 100, 0))
+
+    def test_rent_and_return(self):
+        self.machine.start_sale(1)
+        self.machine.insert_coin(20)
+
+        self.assertFalse(self.machine.is_enough_money())
+
+        self.machine.insert_coin(2)
+
+        self.assertTrue(self.machine.is_enough_money())
+        self.assertEqual(self.machine.get_current_sale_info().price, 22.0)
+
+        self.machine.finish_sale()
+        self.machine.pricing.set_tariff(Tariff(version=3, per_km=1000))
+
+        lease = self.machine.return_lease(self.machine.last_lease.id, 250)
+
+        self.assertIs(lease, self.machine.leases.get(1))
+        self.assertEqual(lease.mileage_charge, 1000)
+
+    def test_session(self):
+        session = Session(self.machine)
+        session.start_sale(1)
+        session.insert_coin(20)
+
+        self.assertEqual(session.price, 22.0)
+        self.assertFalse(session.is_enough_money())
+
+        session.insert_coin(2)
+        session.finish_sale()
+
+        self.assertEqual(session.lease.km_allowance, 100)
+        self.assertEqual(self.machine.cashier.total, 22.0)
+
+    def test_recover_terms(self):
+        with tempfile.TemporaryDirectory() as directory:
+            journal = Journal(directory)
+            journal.recover(self.machine)
+            self.machine.start_sale(1)
+            self.machine.insert_coin(50)
+            self.machine.finish_sale(force=True)
+            journal.snapshot()
+            self.machine.start_sale(1)
+            self.machine.insert_coin(50)
+            self.machine.finish_sale(force=True)
+            journal.close()
+
+            recovered = Machine(verbose=False)
+            journal = Journal(directory)
+            journal.recover(recovered)
+            journal.close()
+
+        self.assertEqual([(lease.km_allowance, lease.per_km) for lease in recovered.leases.open_leases.values()],
+                         [(100, 20), (100, 20)])
+
+
+class TestAnalytics(TestCase):
+    def setUp(self):
+        self.machine = Machine(verbose=False)
+        self.machine.add_vehicle(Vehicle(1, 'Car', 10, 100), 1)
+        self.machine.add_vehicle(Vehicle(2, 'Bike', 5, 300), 3)
+        self.machine.add_vehicle(Vehicle(3, 'Car', 20, 200), 2)
+        self.machine.pricing.set_tariff(Tariff(version=2, km_allowance=100, per_km=10))
+
+        for vehicle_id in (1, 3, 3, 2):
+            session = Session(self.machine)
+            session.start_sale(vehicle_id)
+            session.insert_coin(20)
+            session.finish_sale(force=True)
+
+        self.machine.return_vehicle(3, 450)
+
+    def test_per_model(self):
+        frame = FleetFrame(self.machine)
+
+        self.assertEqual(frame.per_model('rentals'), {'Car': 3, 'Bike': 1})
+        self.assertEqual(frame.per_model('revenue'), {'Car': 50.0, 'Bike': 5.0})
+        self.assertEqual(frame.per_model('distance'), {'Car': 250, 'Bike': 0})
+        self.assertEqual(frame.per_model('utilization'), {'Car': 2 / 3, 'Bike': 1 / 3})
+
+    def test_top(self):
+        frame = FleetFrame(self.machine)
+
+        self.assertEqual(frame.top('revenue', 1), [('Car', 50.0)])
+        self.assertEqual(frame.top('utilization'), [('Car', 2 / 3), ('Bike', 1 / 3)])
+
+        with self.assertRaises(ValueError):
+            frame.top('colour')
+
+    def test_mileage_percentiles(self):
+        self.assertEqual(FleetFrame(self.machine).mileage_percentiles((0, 50, 100)), {0: 100, 50: 200, 100: 300})
+        self.assertEqual(FleetFrame(Machine(verbose=False)).mileage_percentiles(), {})
+
+    def test_live(self):
+        frame = FleetFrame(self.machine, live=True)
+
+        self.assertIs(self.machine.fleet_frame, frame)
+
+        self.machine.return_vehicle(1, 300)
+        self.machine.add_vehicle(Vehicle(4, 'Van', 30, 50), 1)
+        session = Session(self.machine)
+        session.start_sale(4)
+        session.insert_coin(50)
+        session.finish_sale(force=True)
+
+        for metric in FleetFrame.METRICS:
+            self.assertEqual(frame.per_model(metric), FleetFrame(self.machine).per_model(metric))
+
+        self.assertEqual(frame.per_model('rentals'), {'Car': 3, 'Bike': 1, 'Van': 1})
+
+        self.machine.add_vehicle(Vehicle(2, 'Scooter', 5, 300), 3)
+
+        self.assertEqual(frame.per_model('rentals'), {'Car': 3, 'Scooter': 1, 'Van': 1})
+
+        self.machine.leases.restore({'next_id': 10, 'open': [], 'returned_units': []})
+
+        self.assertEqual(frame.per_model('rentals'), {'Car': 0, 'Scooter': 0, 'Van': 0})
+        self.assertEqual(frame.mileage_percentiles((100, )), {100: 300})
+
+    def test_report(self):
+        self.assertEqual(report(self.machine, 'rentals', 1), 'Car - 3')
+        self.assertEqual(report(self.machine, 'mileage'), 'p50 - 200km\np90 - 300km\np99 - 300km')
+        self.assertIn('not a valid query', report(self.machine, 'colour'))
+        self.assertIsNotNone(self.machine.fleet_frame)
+
+
+class TestSimulate(TestCase):
+
+    def test_simulate(self):
+        machine = synthetic_scenario(50, random.Random(0))
+        report = simulate(machine, 2000, Scenario(arrivals=60, rental_hours=2))
+
+        self.assertEqual(report.customers, 2000)
+        self.assertEqual(report.customers, report.sales + report.stock_outs + report.walked_away)
+        self.assertEqual(report.change_failures, report.forced + report.walked_away)
+        self.assertEqual(report.sales, report.returns + machine.leases.count_open())
+        self.assertLessEqual(report.mean_wait, report.max_wait)
+        self.assertGreater(report.hours, 0)
+
+    def test_deterministic(self):
+        first = simulate(synthetic_scenario(20, random.Random(1)), 500, seed=3)
+        second = simulate(synthetic_scenario(20, random.Random(1)), 500, seed=3)
+
+        self.assertEqual(first._replace(wall_seconds=0), second._replace(wall_seconds=0))
+
+    def test_stock_out(self):
+        machine = Machine(verbose=False)
+        machine.add_vehicle(Vehicle(1, 'Vehicle 1', 10, 100), 1)
+        report = simulate(machine, 10, Scenario(arrivals=60, rental_hours=1000, pattern='exact'))
+
+        self.assertEqual((report.sales, report.stock_outs), (1, 9))
+        self.assertEqual(report.stock_out_rate, 0.9)
+
+    def test_no_change(self):
+        machine = Machine(verbose=False)
+        machine.add_vehicle(Vehicle(1, 'Vehicle 1', 15, 100), 100)
+        report = simulate(machine, 100, Scenario(pattern='large', force=0))
+
+        self.assertEqual(report.sales, 0)
+        self.assertEqual(report.change_failure_rate, 1.0)
+        self.assertEqual(machine.cashier.total_change, 0)
+
+    def test_queue(self):
+        machine = Machine(verbose=False)
+        machine.add_vehicle(Vehicle(1, 'Vehicle 1', 10, 100), 1000)
+
+        idle = simulate(machine, 100, Scenario(arrivals=0.1, pattern='exact'))
+        busy = simulate(machine, 100, Scenario(arrivals=1000, pattern='exact'))
+
+        self.assertLess(idle.mean_wait, busy.mean_wait)
+        self.assertGreater(busy.busy, 0.9)
+
+    def test_patterns(self):
+        for pay in PATTERNS.values():
+            coin = pay(1550, random.Random(0))
+            self.assertIn(coin * 100, Cashier.VALID_COINS + Cashier.VALID_NOTES)
+
+        self.assertEqual(PATTERNS['exact'](1550, random.Random(0)), 10.0)
+        self.assertEqual(PATTERNS['exact'](50, random.Random(0)), 0.5)
+
+    def test_load_scenario(self):
+        machine = load_scenario('vehicles.json', 'change.json')
+        report = simulate(machine, 200)
+
+        self.assertEqual(len(machine.stock), 3)
+        self.assertEqual(report.customers, 200)
+
+
+class TestTimeline(TestCase):
+
+    def test_peak(self):
+        timeline = Timeline()
+        timeline.add(0, 10, (0, 1))
+        timeline.add(5, 15, (0, 2))
+        timeline.add(10, 20, (0, 3))
+
+        self.assertEqual(timeline.peak(0, 5), 1)
+        self.assertEqual(timeline.peak(0, 6), 2)
+        self.assertEqual(timeline.peak(10, 11), 2)
+        self.assertEqual(timeline.peak(15, 30), 1)
+        self.assertEqual(timeline.peak(20, 30), 0)
+
+        timeline.remove(5, 15, (0, 2))
+
+        self.assertEqual(timeline.peak(0, 30), 1)
+        self.assertEqual(len(timeline), 2)
+
+    def test_against_sweep(self):
+        rng = random.Random(0)
+        timeline, intervals = Timeline(), {}
+
+        for tag in range(400):
+            start = rng.randint(0, 1000)
+            intervals[tag] = (start, start + rng.randint(1, 100))
+            timeline.add(*intervals[tag], (0, tag))
+            if rng.random() < 0.3:
+                removed = rng.choice(list(intervals))
+                timeline.remove(*intervals.pop(removed), (0, removed))
+
+        for _ in range(200):
+            start = rng.randint(0, 1100)
+            end = start + rng.randint(1, 200)
+            expected = max(sum(1 for low, high in intervals.values() if low <= time < high) for time in range(start, end))
+            self.assertEqual(timeline.peak(start, end), expected)
+
+
+class TestReservations(ClockMixin, TestCase):
+    def setUp(self):
+        self.machine = Machine(verbose=False)
+        self.machine.add_vehicle(Vehicle(1, 'Vehicle 1', 10, 100), 2)
+        self.machine.add_vehicle(Vehicle(2, 'Vehicle 2', 10, 100), 1)
+        self.book = ReservationBook(self.machine, clock=lambda: self.now)
+
+    def test_book(self):
+        first = self.book.book(1, self.at(24), self.at(48))
+        second = self.book.book(1, self.at(36), self.at(60))
+
+        self.assertEqual((first.id, second.id), (1, 2))
+        self.assertEqual(self.book.free(1, self.at(36), self.at(48)), 0)
+        self.assertEqual(self.book.free(1, self.at(48), self.at(60)), 1)
+        self.assertIsNone(self.book.book(1, self.at(40), self.at(41)))
+        self.assertIsNotNone(self.book.book(1, self.at(0), self.at(24)))
+
+    def test_book_invalid(self):
+        self.assertIsNone(self.book.book(3, self.at(1), self.at(2)))
+        self.assertIsNone(self.book.book(1, self.at(2), self.at(1)))
+        self.assertIsNone(self.book.book(1, self.at(-2), self.at(-1)))
+        self.assertIsNone(self.book.free(3, self.at(1), self.at(2)))
+
+    def test_start_sale_honors_bookings(self):
+        self.book.book(2, self.at(12), self.at(24))
+
+        self.assertFalse(self.machine.start_sale(2))
+        self.assertTrue(self.machine.start_sale(1))
+
+    def test_walk_in_after_booking(self):
+        self.book.book(2, self.at(1), self.at(2))
+        self.now = self.at(2)
+
+        self.assertTrue(rent(self.machine, 2))
+
+    def test_pick_up(self):
+        reservation = self.book.book(2, self.at(1), self.at(5))
+
+        self.assertFalse(self.machine.start_sale(2, reservation.id))
+
+        self.now = self.at(2)
+
+        self.assertFalse(self.machine.start_sale(1, reservation.id))
+        self.assertTrue(rent(self.machine, 2, reservation=reservation.id))
+        self.assertIsNone(self.book.get(reservation.id))
+        self.assertEqual(self.book.free(2, self.now, self.at(3)), 0)
+        self.assertEqual(self.book.free(2, self.at(3), self.at(4)), 1)
+
+    def test_return_releases_unit(self):
+        self.assertTrue(rent(self.machine, 2))
+        self.assertIsNone(self.book.book(2, self.at(1), self.at(2)))
+
+        self.machine.return_vehicle(2, 200)
+
+        self.assertIsNotNone(self.book.book(2, self.at(1), self.at(2)))
+
+    def test_cancel(self):
+        reservation = self.book.book(2, self.at(12), self.at(24))
+
+        self.assertTrue(self.book.cancel(reservation.id))
+        self.assertFalse(self.book.cancel(reservation.id))
+        self.assertTrue(self.machine.start_sale(2))
+
+    def test_expire(self):
+        self.book.book(2, self.at(1), self.at(2))
+        self.now = self.at(3)
+
+        self.assertEqual(self.book.expire(), 1)
+        self.assertEqual(len(self.book), 0)
+
+    def test_session(self):
+        reservation = self.book.book(2, self.at(0), self.at(5))
+        session = Session(self.machine)
+
+        self.assertFalse(session.start_sale(2))
+        self.assertTrue(session.start_sale(2, reservation.id))
+
+        session.insert_coin(10)
+        session.finish_sale()
+
+        self.assertEqual(len(self.book), 0)
+
+    def test_recover(self):
+        with tempfile.TemporaryDirectory() as directory:
+            journal = Journal(directory)
+            journal.recover(self.machine)
+            kept = self.book.book(1, self.at(24), self.at(48))
+            cancelled = self.book.book(1, self.at(24), self.at(48))
+            picked_up = self.book.book(2, self.at(0), self.at(5))
+            self.book.cancel(cancelled.id)
+            rent(self.machine, 2, reservation=picked_up.id)
+            journal.snapshot()
+            later = self.book.book(1, self.at(30), self.at(40))
+            journal.close()
+
+            machine = Machine(verbose=False)
+            book = ReservationBook(machine, clock=lambda: self.now)
+            journal = Journal(directory)
+            journal.recover(machine)
+            journal.close()
+
+        self.assertEqual([book.get(id) for id in (kept.id, cancelled.id, picked_up.id, later.id)],
+                         [kept, None, None, later])
+        self.assertEqual(book.free(1, self.at(30), self.at(40)), 0)
+        self.assertEqual(book.free(2, self.now, self.at(1)), 0)
+        self.assertEqual(book.book(1, self.at(100), self.at(101)).id, later.id + 1)
+
+
+class TestFenwick(TestCase):
+    def test_sums(self):
+        rng = random.Random(7)
+        rows = [[rng.randint(0, 9), rng.randint(-5, 5)] for _ in range(37)]
+        tree = Fenwick(40, 2)
+
+        for index, row in enumerate(rows):
+            tree.add(index, row)
+
+        for _ in range(50):
+            index, values = rng.randrange(40), [rng.randint(0, 9), rng.randint(-5, 5)]
+            tree.add(index, values)
+            if index < len(rows):
+                rows[index] = [row + value for row, value in zip(rows[index], values)]
+            else:
+                rows.extend([[0, 0]] * (index - len(rows)) + [values])
+
+        rows.extend([[0, 0]] * (40 - len(rows)))
+
+        self.assertEqual([tree.row(index) for index in range(40)], rows)
+        for start, end in ((0, 40), (3, 17), (39, 40), (10, 5), (-3, 99)):
+            expected = [sum(row[column] for row in rows[max(start, 0):end]) for column in range(2)]
+            self.assertEqual(tree.sum(start, end), expected)
+
+
+class TestLedger(ClockMixin, TestCase):
+    def setUp(self):
+        self.machine = Machine(verbose=False)
+        self.machine.add_vehicle(Vehicle(1, 'Car', 20, 100), 100)
+        self.machine.add_vehicle(Vehicle(2, 'Bike', 5, 100), 100)
+        self.machine.add_change(0.5, 100)
+        self.ledger = Ledger(self.machine, clock=lambda: self.now, tiers=((self.HOUR, 4), (4 * self.HOUR, 4)))
+
+    def test_record(self):
+        rent(self.machine, 1, [20])
+        self.now += self.HOUR
+        rent(self.machine, 2, [2, 2, 2])
+        rent(self.machine, 2, [5])
+
+        self.assertEqual(self.ledger.totals(), Totals(3, 3100, 100))
+        self.assertEqual(self.ledger.totals().revenue, 3000)
+        self.assertEqual(self.ledger.totals(self.at(0)), Totals(2, 1100, 100))
+        self.assertEqual(self.ledger.totals(self.at(-1), self.at(0)), Totals(1, 2000, 0))
+        self.assertEqual(self.ledger.totals(vehicle_id=2), Totals(2, 1100, 100))
+        self.assertEqual(self.ledger.totals(vehicle_id=3), Totals(0, 0, 0))
+        self.assertEqual(self.ledger.by_model(self.at(0)), {2: Totals(2, 1100, 100)})
+        self.assertEqual(self.ledger.top(1), [(1, Totals(1, 2000, 0))])
+        self.assertEqual([totals.sales for _, totals in self.ledger.timeline(self.at(-1), self.at(1))], [1, 2])
+
+    def rent_hourly(self, hours: int) -> None:
+        for hour in range(hours):
+            rent(self.machine, *((1, [20]) if hour % 2 else (2, [5, 2])))
+            self.now += self.HOUR
+
+    def test_downsampling(self):
+        self.rent_hourly(40)
+
+        self.assertEqual(self.ledger.totals(), Totals(40, 20 * 2000 + 20 * 700, 20 * 200))
+        self.assertEqual(self.ledger.totals(vehicle_id=1).sales, 20)
+        # the last hours are kept by the hour, the ones before by 4 hours and the oldest in total only
+        self.assertEqual(self.ledger.totals(self.at(-3)).sales, 3)
+        self.assertEqual(self.ledger.totals(self.at(-8), self.at(-2)).sales, 6)
+        self.assertEqual(self.ledger.totals(self.at(-40)).sales, 20)
+        self.assertEqual(len(self.ledger.snapshot()['all']), 9)
+
+    def test_sparse_models(self):
+        ledger = Ledger(Machine(verbose=False), clock=lambda: self.now)
+
+        for hour in range(48):
+            ledger.record(1, 100, 0)
+            if hour % 12 == 0:
+                ledger.record(2, 500, 0)
+            self.now += self.HOUR
+
+        frequent, rare = ledger._models[1].tiers[0], ledger._models[2].tiers[0]
+
+        self.assertIsNotNone(frequent.sums)
+        self.assertIsNone(rare.sums)
+        self.assertEqual(len(rare.sparse), 4)
+        self.assertEqual(ledger.totals(self.at(-24), vehicle_id=1), Totals(24, 2400, 0))
+        self.assertEqual(ledger.totals(self.at(-24), vehicle_id=2), Totals(2, 1000, 0))
+        self.assertEqual(ledger.totals(), Totals(52, 6800, 0))
+
+    def test_recover(self):
+        with tempfile.TemporaryDirectory() as directory:
+            journal = Journal(directory)
+            journal.recover(self.machine)
+
+            self.rent_hourly(6)
+            journal.snapshot()
+            self.rent_hourly(4)
+
+            journal.close()
+
+            machine = Machine(verbose=False)
+            ledger = Ledger(machine, clock=lambda: self.now, tiers=((self.HOUR, 4), (4 * self.HOUR, 4)))
+            journal = Journal(directory)
+            journal.recover(machine)
+            journal.close()
+
+        self.assertEqual(ledger.snapshot(), self.ledger.snapshot())
+        self.assertEqual(ledger.by_model(self.at(-6)), self.ledger.by_model(self.at(-6)))
+        self.assertEqual(machine.cashier.total * 100, ledger.totals().paid)
+
+    def test_describe(self):
+        rent(self.machine, 1, [20])
+        rent(self.machine, 2, [5])
+
+        self.assertEqual(describe_revenue(self.ledger, 24, 1), 'Last 24h: 2 sales, €25.0 paid, €0.0 change, '
+                                                                 '€25.0 revenue\n1 - Car - €20.0 (1 sales)')
+
+
+class TestSearch(TestCase):
+    def setUp(self):
+        self.machine = Machine(verbose=False)
+
+        for vehicle_id, name, stock in ((1, 'Ford Fiesta', 1), (2, 'Honda Bike', 10), (3, 'BMX', 20),
+                                        (4, 'Honda Civic', 0), (5, 'Café Racer', 2), (6, 'Ford Focus', 3)):
+            self.machine.add_vehicle(Vehicle(vehicle_id, name, 10, 0), stock)
+
+        self.index = self.machine.search_index
+
+    def test_words(self):
+        self.assertEqual(words('Café  Racer-2'), ('cafe', 'racer', '2'))
+
+    def test_prefix(self):
+        self.assertEqual(sorted(self.index.search('ford')), [1, 6])
+        self.assertEqual(sorted(self.index.search('FO')), [1, 6])
+        self.assertEqual(self.index.search('fiesta ford'), [1])
+        self.assertEqual(self.index.search('cafe'), [5])
+        self.assertEqual(self.index.search('ford', limit=1), [self.index.search('ford')[0]])
+
+    def test_in_stock(self):
+        self.assertEqual(self.index.search('honda'), [2])
+        self.assertEqual(sorted(self.index.search('honda', in_stock=False)), [2, 4])
+
+        self.machine.add_vehicle(Vehicle(4, 'Honda Civic', 10, 0), 1)
+        self.assertEqual(sorted(self.index.search('honda')), [2, 4])
+
+    def test_typos(self):
+        self.assertEqual(self.index.search('hnoda bike'), [2])
+        self.assertEqual(self.index.search('ford fcus'), [6])
+        self.assertEqual(self.index.search('bnx'), [3])
+        self.assertEqual(self.index.search('xyz'), [])
+
+    def test_ranking(self):
+        self.machine.add_vehicle(Vehicle(7, 'Bikes', 10, 0), 1)
+        self.machine.add_vehicle(Vehicle(8, 'Bik', 10, 0), 1)
+
+        self.assertEqual(self.index.search('bik'), [8, 2, 7])
+        # the closest words first: bike, bik then bikes
+        self.assertEqual(self.index.search('bikse'), [2, 8, 7])
+
+    def test_rename(self):
+        self.index.search('bmx')
+        self.machine.add_vehicle(Vehicle(3, 'Mountain Bike', 10, 0), 20)
+
+        self.assertEqual(self.index.search('bmx'), [])
+        self.assertEqual(sorted(self.index.search('bike')), [2, 3])
+        self.assertIsNone(self.index._find('b').children.get('m'))
+
+    def test_machine_search(self):
+        self.assertEqual(self.machine.search('bmx'), '3 - BMX - €10 - 0km - (Stock: 20)')
+        self.assertEqual(self.machine.search('xyz'), 'No vehicle in stock matches xyz.')